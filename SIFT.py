@@ -7,14 +7,52 @@ Robert Szafarczyk, 201307211
 
 """
 
+import argparse
 import cv2
 import math
 import time
 import os
 import numpy as np
-from functools import cmp_to_key
+import multiprocessing as mp
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from helper import load_images_in_directory, DATASET_DIR, CLASSES
+from helper import save_to_pickles_atomically, DATASET_DIR, CLASSES, DEFAULT_IMAGE_FORMAT
+
+
+################################################################################
+# Keypoints
+################################################################################
+# Keypoints are passed around as records of a structured array, with the same fields
+# (and precision) as OpenCV KeyPoint objects. Convert them only when the caller needs OpenCV.
+KEYPOINT_DTYPE = np.dtype([
+    ('x', 'float32'),
+    ('y', 'float32'),
+    ('size', 'float32'),
+    ('angle', 'float32'),
+    ('response', 'float32'),
+    ('octave', 'int32'),
+])
+
+def to_cv2_keypoints(keypoints):
+    """
+    Convert a keypoint array to a list of KeyPoint OpenCV objects.
+    """
+    return [cv2.KeyPoint(float(k['x']), float(k['y']), float(k['size']), float(k['angle']),
+                         float(k['response']), int(k['octave'])) for k in keypoints]
+
+def from_cv2_keypoints(cv2_keypoints):
+    """
+    Convert a list of KeyPoint OpenCV objects to a keypoint array.
+    """
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave) for k in cv2_keypoints],
+                    dtype=KEYPOINT_DTYPE)
+
+def to_saved_keypoints(keypoints):
+    """
+    Convert a keypoint array to the format in which keypoints are saved, i.e. [(x, y), diameter].
+    """
+    return np.array([[(float(k['x']), float(k['y'])), float(k['size'])] for k in keypoints], dtype=object)
 
 
 ################################################################################
@@ -24,6 +62,9 @@ def convolution(img, kernel, average=False):
     """
     Convolute an image with a kernel. If the passed in image has 3 colour channels,
     then convert it to grayscale.
+
+    This is the slow, pixel-by-pixel reference implementation. Gaussian kernels are
+    separable, so the scale-space pyramid is built with separable_convolution instead.
     """
     if len(img.shape) == 3:
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -51,6 +92,50 @@ def convolution(img, kernel, average=False):
 
     return output
 
+def convolution_1D(img, kernel_1D, axis):
+    """
+    Convolute a 2D image with a 1D kernel along a single {axis} (0 - columns, 1 - rows).
+    The image is zero-padded beyond borders, same as in convolution.
+    """
+    pad = len(kernel_1D) // 2
+    pad_width = [(0, 0), (0, 0)]
+    pad_width[axis] = (pad, pad)
+    padded_img = np.pad(img, pad_width)
+
+    # A strided view of shape (img_row, img_col, kernel_size) with the neighbourhood of
+    # every pixel along {axis} in the last dimension. No data is copied here.
+    windows = np.lib.stride_tricks.sliding_window_view(padded_img, len(kernel_1D), axis=axis)
+
+    return windows @ kernel_1D
+
+def separable_convolution(img, kernel_1D, average=False, executor=None, num_blocks=4):
+    """
+    Convolute an image with the 2D kernel np.outer(kernel_1D, kernel_1D) as two 1D passes.
+    Gives the same result as convolution(img, np.outer(kernel_1D, kernel_1D), average),
+    up to floating point rounding, in O(kernel_size) instead of O(kernel_size^2) per pixel.
+    If an {executor} is given, each pass is split into {num_blocks} blocks which are convoluted on it
+    concurrently. The result is the same.
+    """
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    img = img.astype(np.float64)
+    if executor is None:
+        output = convolution_1D(img, kernel_1D, axis=1)
+        output = convolution_1D(output, kernel_1D, axis=0)
+    else:
+        # Rows are convoluted independently of each other along the rows, and columns along the columns.
+        row_blocks = executor.map(partial(convolution_1D, kernel_1D=kernel_1D, axis=1),
+                                  np.array_split(img, num_blocks, axis=0))
+        output = np.concatenate(list(row_blocks), axis=0)
+        col_blocks = executor.map(partial(convolution_1D, kernel_1D=kernel_1D, axis=0),
+                                  np.array_split(output, num_blocks, axis=1))
+        output = np.concatenate(list(col_blocks), axis=1)
+    if average:
+        output /= len(kernel_1D) ** 2
+
+    return output
+
 def get_dnorm(x, mu, sd):
     return 1 / (np.sqrt(2 * np.pi) * sd) * np.e ** (-np.power((x - mu) / sd, 2) / 2)
 
@@ -78,6 +163,22 @@ def gen_gaussian_kernel(sigma):
 
     return kernel_2D
 
+def gen_gaussian_kernel_1D(sigma, normalise=False):
+    """
+    Given a sigma value, generate the 1D Gaussian kernel whose outer product with
+    itself is the 2D kernel returned by gen_gaussian_kernel(sigma).
+    If {normalise} is True, the kernel is scaled to sum to 1 instead, so that blurring
+    with it doesn't change the brightness of the image.
+    """
+    size = round_up_to_odd(3 * sigma)
+    kernel_1D = get_dnorm(np.linspace(-(size//2), size//2, size), 0, sigma)
+    if normalise:
+        return kernel_1D / kernel_1D.sum()
+
+    # The 2D kernel is scaled so that its maximum is 1. Since max(outer(k, k)) == max(k)^2,
+    # scaling the 1D kernel by max(k) gives the same 2D kernel.
+    return kernel_1D / kernel_1D.max()
+
 
 ################################################################################
 # (1) Scale-space extrema detection
@@ -104,47 +205,104 @@ def gen_gaussian_sigmas_in_octaves(sigma):
 def apply_gaussian_kernels(img, num_octaves, sigmas):
     """
     Generate scale-space pyramid of Gaussian images.
+
+    Return a list with one contiguous float32 array of shape (len(sigmas), rows, cols) per octave,
+    i.e. gaussian_imgs[octave][layer] is a view of a single Gaussian image in that array.
     """
-    gaussian_imgs = []
+    return list(iter_gaussian_octaves(img, num_octaves, sigmas))
 
-    for _ in range(num_octaves):
-        gaussian_imgs_in_octave = []
+def gen_pyramid(img, num_octaves, sigmas):
+    """
+    Same as apply_gaussian_kernels, but also return the DoG images (see do_dog). The Gaussian and
+    the DoG images of an octave are views of a single float32 block, so no other memory is allocated.
+    """
+    gaussian_imgs, dog_imgs = zip(*iter_gaussian_octaves(img, num_octaves, sigmas, with_dog=True))
 
-         # The sigmas[0] kernel won't change the image, so skip it.
-        gaussian_imgs_in_octave.append(img)
-        for sigma in sigmas[1:]:
-            gaussian_kernel = gen_gaussian_kernel(sigma)
-            gaussian_imgs_in_octave.append(convolution(img, gaussian_kernel))
+    return list(gaussian_imgs), list(dog_imgs)
 
-        gaussian_imgs.append(gaussian_imgs_in_octave)
+def iter_gaussian_octaves(img, num_octaves, sigmas, executor=None, with_dog=False):
+    """
+    Same as apply_gaussian_kernels, but yield the octaves one by one, as soon as each is ready.
+    If an {executor} (e.g. concurrent.futures.ThreadPoolExecutor) is given, each blur is split
+    into blocks which are convoluted on it concurrently.
+    If {with_dog} is True, yield (Gaussian images, DoG images) pairs of views of one block per octave.
+    """
+    # The kernels are the same in every octave. They sum to 1, so that each layer can be blurred
+    # from the previous one with the incremental sigmas without changing the brightness.
+    gaussian_kernels = [gen_gaussian_kernel_1D(sigma, normalise=True) for sigma in sigmas[1:]]
+    num_layers = len(sigmas)
+
+    for _ in range(num_octaves):
+        # The Gaussian images, followed by the DoG images if needed.
+        octave_block = np.empty((2 * num_layers - 1 if with_dog else num_layers,) + img.shape, dtype='float32')
+        gaussian_imgs_in_octave = octave_block[:num_layers]
+
+        # The sigmas[0] kernel won't change the image, so skip it.
+        gaussian_imgs_in_octave[0] = img
+        # Each layer is the previous one blurred with the incremental sigma, i.e. with a narrower
+        # kernel than the total blur of the layer.
+        for layer, gaussian_kernel in enumerate(gaussian_kernels, 1):
+            gaussian_imgs_in_octave[layer] = separable_convolution(gaussian_imgs_in_octave[layer - 1],
+                                                                   gaussian_kernel, executor=executor)
+
+        if with_dog:
+            yield gaussian_imgs_in_octave, do_dog([gaussian_imgs_in_octave], [octave_block[num_layers:]])[0]
+        else:
+            yield gaussian_imgs_in_octave
         # Octave base will be in the middle.
         octave_base = gaussian_imgs_in_octave[len(gaussian_imgs_in_octave)//2 - 1]
         img = cv2.resize(octave_base, (int(octave_base.shape[1] / 2), int(octave_base.shape[0] / 2)),
                          interpolation=cv2.INTER_NEAREST)
 
-    return np.array(gaussian_imgs, dtype=object)
+def do_dog(gaussian_imgs, out=None):
+    """
+    Return one float32 array of shape (layers - 1, rows, cols) of Difference-of-Gaussian
+    images per octave, where dog_images[octave][layer] is
+    gaussian_imgs[octave][layer + 1] - gaussian_imgs[octave][layer].
+    If {out} is given, the DoG images of each octave are written to the array out[octave] and
+    returned as views of it, instead of allocating new arrays.
+    """
+    if out is None:
+        out = [None for _ in gaussian_imgs]
 
-def do_dog(gaussian_imgs):
-    dog_images = []
+    # Subtract the whole octave, shifted by one layer, from itself in one go.
+    return [np.subtract(gaussian_imgs_octave[1:], gaussian_imgs_octave[:-1], out=dog_imgs_octave)
+            for gaussian_imgs_octave, dog_imgs_octave in zip(gaussian_imgs, out)]
 
-    for gaussian_imgs_octave in gaussian_imgs:
-        dog_octave = []
+def gen_gradient_map(gaussian_image):
+    """
+    Compute the gradient magnitude and orientation (in degrees, in (-180, 180] range)
+    of every pixel of {gaussian_image}. Border pixels have no gradient and are set to 0.
+    Also works on a whole octave, i.e. an array of shape (layers, rows, cols).
+    """
+    dx = np.zeros(gaussian_image.shape, dtype=gaussian_image.dtype)
+    dy = np.zeros(gaussian_image.shape, dtype=gaussian_image.dtype)
+    dx[..., 1:-1, 1:-1] = gaussian_image[..., 1:-1, 2:] - gaussian_image[..., 1:-1, :-2]
+    dy[..., 1:-1, 1:-1] = gaussian_image[..., :-2, 1:-1] - gaussian_image[..., 2:, 1:-1]
 
-        # Loop through evry pair in the octave.
-        for first_image, second_image in zip(gaussian_imgs_octave, gaussian_imgs_octave[1:]):
-            # Use np. subract because we're working with uint8 dtypes.
-            dog = np.subtract(second_image, first_image)
-            dog_octave.append(dog)
+    gradient_magnitude = np.sqrt(dx * dx + dy * dy)
+    gradient_orientation = np.rad2deg(np.arctan2(dy, dx))
 
-        dog_images.append(dog_octave)
+    return gradient_magnitude, gradient_orientation
 
-    return np.array(dog_images, dtype=object)
+def gen_gradient_maps(gaussian_images):
+    """
+    Compute the gradient maps of every image in the Gaussian pyramid once, so that
+    the following steps don't need to recompute them for each keypoint.
+    gradient_maps[octave][layer] is a (magnitude, orientation) pair.
+    """
+    gradient_maps = []
+    for gaussian_imgs_octave in gaussian_images:
+        gradient_magnitude, gradient_orientation = gen_gradient_map(gaussian_imgs_octave)
+        gradient_maps.append(list(zip(gradient_magnitude, gradient_orientation)))
+
+    return gradient_maps
 
 
 ################################################################################
 # (2) Keypoint localization
 ################################################################################
-def identify_keypoints(gaussian_images, dog_images):
+def identify_keypoints(gaussian_images, dog_images, gradient_maps=None, first_octave=0, origin=(0, 0)):
     """
     Keypoints are identified as local minima/maxima of the DoG images across scales
     – by comparing each pixel in the DoG images to its eight neighbors at the
@@ -153,7 +311,11 @@ def identify_keypoints(gaussian_images, dog_images):
     – if the pixel value is the maximum or minimum among all compared pixels,
       it is selected as a candidate keypoint
 
-    Return as list of KeyPoint OpenCV objects, representing SIFT keypoints.
+    Return as an array of KEYPOINT_DTYPE records, representing SIFT keypoints.
+
+    If the pyramid was built from a crop of a larger image, {origin} is the (row, col) of the crop
+    in that image, and {first_octave} is the octave of the larger image's pyramid that
+    gaussian_images[0] corresponds to. Keypoints are then returned in the larger image's coordinates.
     """
     # Constants from OpenCV and following Lowe's SIFT paper.
     contrast_threshold = 0.04
@@ -162,41 +324,106 @@ def identify_keypoints(gaussian_images, dog_images):
     num_intervals = 3
     threshold = np.floor(0.5 * contrast_threshold / num_intervals * 255)
 
-    keypoints = []
+    if gradient_maps is None:
+        gradient_maps = gen_gradient_maps(gaussian_images)
+
+    keypoints = [np.zeros(0, dtype=KEYPOINT_DTYPE)]
+    # Only the candidates, i.e. pixels that are extrema among their 26 neighbours, are localized.
+    octave_idxs, layer_idxs, row_idxs, col_idxs = find_extremum_candidates(dog_images, threshold,
+                                                                           image_border_width)
+    for local_octave_index, dog_images_in_octave in enumerate(dog_images):
+        in_octave = octave_idxs == local_octave_index
+        if not np.any(in_octave):
+            continue
+
+        octave_index = first_octave + local_octave_index
+        localized_keypoints, localized_image_idxs = \
+            localize_keypoints_in_octave(layer_idxs[in_octave], row_idxs[in_octave],
+                                         col_idxs[in_octave], octave_index, num_intervals,
+                                         dog_images_in_octave, sigma,
+                                         contrast_threshold, image_border_width, origin)
+
+        for keypoint, localized_image_index in zip(localized_keypoints, localized_image_idxs):
+            keypoints_with_orientation = assign_orientations(keypoint, octave_index,
+                                                            gradient_maps[local_octave_index][localized_image_index],
+                                                            origin)
+
+            keypoints.append(keypoints_with_orientation)
+
+    return np.concatenate(keypoints)
+
+def filter_3x3x3(volume, reduce_func):
+    """
+    Reduce each 3x3x3 neighbourhood of a 3D {volume} with {reduce_func} (np.maximum or np.minimum).
+    The result has shape (layers - 2, rows - 2, cols - 2), where element [l, i, j] corresponds
+    to the neighbourhood centred at volume[l + 1, i + 1, j + 1].
+    """
+    # Max and min are separable, so reduce along one axis at a time (9 instead of 26 comparisons).
+    volume = reduce_func(reduce_func(volume[:-2], volume[1:-1]), volume[2:])
+    volume = reduce_func(reduce_func(volume[:, :-2], volume[:, 1:-1]), volume[:, 2:])
+    volume = reduce_func(reduce_func(volume[:, :, :-2], volume[:, :, 1:-1]), volume[:, :, 2:])
+
+    return volume
+
+def find_extremum_candidates_in_octave(dog_images_in_octave, threshold, image_border_width):
+    """
+    Vectorized equivalent of calling is_px_extremum for every pixel of every DoG triple
+    in an octave, ignoring pixels closer than {image_border_width} to the border.
+
+    Return (layer_idxs, row_idxs, col_idxs) arrays of the candidate keypoints, where the layer
+    is the index of the middle DoG image of the triple.
+    """
+    # One 3D (layer, row, col) volume for the whole octave. Keep the dtype of the DoG images,
+    # so that the comparisons give exactly the same result as is_px_extremum.
+    # The DoG pyramid already stores each octave as one volume, so this doesn't copy.
+    dog_volume = np.asarray(dog_images_in_octave)
+    num_layers, num_rows, num_cols = dog_volume.shape
+    if num_layers < 3 or num_rows <= 2 * image_border_width or num_cols <= 2 * image_border_width:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, empty
+
+    center_px = dog_volume[1:-1, 1:-1, 1:-1]
+    is_maximum = (center_px > threshold) & (center_px >= filter_3x3x3(dog_volume, np.maximum))
+    is_minimum = (center_px < -threshold) & (center_px <= filter_3x3x3(dog_volume, np.minimum))
+    is_extremum = is_maximum | is_minimum
+
+    # Don't take pixels at the border under consideration.
+    border = image_border_width - 1
+    is_extremum[:, :border, :] = False
+    is_extremum[:, num_rows - 2 - border:, :] = False
+    is_extremum[:, :, :border] = False
+    is_extremum[:, :, num_cols - 2 - border:] = False
+
+    layer_idxs, row_idxs, col_idxs = np.nonzero(is_extremum)
+
+    # Account for the 1 pixel (and 1 layer) shift of center_px.
+    return layer_idxs + 1, row_idxs + 1, col_idxs + 1
+
+def find_extremum_candidates(dog_images, threshold, image_border_width):
+    """
+    Find the candidate keypoints in all octaves of the DoG pyramid.
+
+    Return (octave_idxs, layer_idxs, row_idxs, col_idxs) arrays, ordered by octave,
+    layer, row and column, i.e. in the same order as the pixel-by-pixel scan.
+    """
+    octave_idxs, layer_idxs, row_idxs, col_idxs = [], [], [], []
     for octave_index, dog_images_in_octave in enumerate(dog_images):
-        img_tripple = zip(dog_images_in_octave,
-                          dog_images_in_octave[1:],
-                          dog_images_in_octave[2:])
-        for image_index, (first_image, second_image, third_image) in enumerate(img_tripple):
-
-            # (i, j) is the center of the 3x3 array
-            # Don't take pixels at the border under consideration
-            for i in range(image_border_width, first_image.shape[0] - image_border_width):
-                for j in range(image_border_width, first_image.shape[1] - image_border_width):
-                    # Compare with 27 neighbours, i.e. 9 neighbours from each:
-                    # octave_index-1, octave_index, octave_index+1
-                    if is_px_extremum(first_image[i-1:i+2, j-1:j+2],
-                                      second_image[i-1:i+2, j-1:j+2],
-                                      third_image[i-1:i+2, j-1:j+2],
-                                      threshold):
-                        localization_result = find_extrema(i, j, image_index + 1,
-                                                           octave_index, num_intervals,
-                                                           dog_images_in_octave, sigma,
-                                                           contrast_threshold, image_border_width)
-
-                        if localization_result is not None:
-                            keypoint, localized_image_index = localization_result
-                            keypoints_with_orientation = assign_orientations(keypoint, octave_index,
-                                                                            gaussian_images[octave_index][localized_image_index])
-
-                            keypoints += keypoints_with_orientation
-
-    return keypoints
+        layers, rows, cols = find_extremum_candidates_in_octave(dog_images_in_octave, threshold,
+                                                                image_border_width)
+        octave_idxs.append(np.full(len(layers), octave_index, dtype=np.intp))
+        layer_idxs.append(layers)
+        row_idxs.append(rows)
+        col_idxs.append(cols)
+
+    return (np.concatenate(octave_idxs), np.concatenate(layer_idxs),
+            np.concatenate(row_idxs), np.concatenate(col_idxs))
 
 def is_px_extremum(img1, img2, img3, threshold):
     """
     Return True if the center element of the 3x3x3 input array is the maximum
     or minimum among all compared pixels.
+
+    Reference implementation for a single pixel, see find_extremum_candidates_in_octave.
     """
     center_pixel_value = img2[1, 1]
 
@@ -221,44 +448,48 @@ def is_px_extremum(img1, img2, img3, threshold):
 def do_gradient(pixel_array):
     """
     Approximate gradient at center pixel [1, 1, 1] of 3x3x3 array.
+    Also works on a stack of 3x3x3 arrays, i.e. an array of shape (n, 3, 3, 3).
     """
     # f'(x) = (f(x + h) - f(x - h)) / (2 * h)
     # where h = 1, so f'(x) = (f(x + 1) - f(x - 1)) / 2
-    dx = 0.5 * (pixel_array[1, 1, 2] - pixel_array[1, 1, 0])
-    dy = 0.5 * (pixel_array[1, 2, 1] - pixel_array[1, 0, 1])
-    ds = 0.5 * (pixel_array[2, 1, 1] - pixel_array[0, 1, 1])
+    dx = 0.5 * (pixel_array[..., 1, 1, 2] - pixel_array[..., 1, 1, 0])
+    dy = 0.5 * (pixel_array[..., 1, 2, 1] - pixel_array[..., 1, 0, 1])
+    ds = 0.5 * (pixel_array[..., 2, 1, 1] - pixel_array[..., 0, 1, 1])
 
-    return np.array([dx, dy, ds])
+    return np.stack([dx, dy, ds], axis=-1)
 
 def do_hessian(pixel_array):
     """
     Approximate Hessian at center pixel [1, 1, 1] of 3x3x3 array.
+    Also works on a stack of 3x3x3 arrays, i.e. an array of shape (n, 3, 3, 3).
     """
     # f''(x) = (f(x + h) - 2 * f(x) + f(x - h)) / (h ^ 2)
     # where h = 1, so f''(x) = f(x + 1) - 2 * f(x) + f(x - 1)
     # (d^2) f(x, y) / (dx dy) = (f(x + 1, y + 1) - f(x + 1, y - 1) - f(x - 1, y + 1) + f(x - 1, y - 1)) / 4
-    center_pixel_value = pixel_array[1, 1, 1]
+    center_pixel_value = pixel_array[..., 1, 1, 1]
 
-    dxx = pixel_array[1, 1, 2] - 2 * center_pixel_value + pixel_array[1, 1, 0]
-    dyy = pixel_array[1, 2, 1] - 2 * center_pixel_value + pixel_array[1, 0, 1]
-    dss = pixel_array[2, 1, 1] - 2 * center_pixel_value + pixel_array[0, 1, 1]
+    dxx = pixel_array[..., 1, 1, 2] - 2 * center_pixel_value + pixel_array[..., 1, 1, 0]
+    dyy = pixel_array[..., 1, 2, 1] - 2 * center_pixel_value + pixel_array[..., 1, 0, 1]
+    dss = pixel_array[..., 2, 1, 1] - 2 * center_pixel_value + pixel_array[..., 0, 1, 1]
 
-    dxy = 0.25 * (pixel_array[1, 2, 2] - pixel_array[1, 2, 0] -
-                  pixel_array[1, 0, 2] + pixel_array[1, 0, 0])
-    dxs = 0.25 * (pixel_array[2, 1, 2] - pixel_array[2, 1, 0] -
-                  pixel_array[0, 1, 2] + pixel_array[0, 1, 0])
-    dys = 0.25 * (pixel_array[2, 2, 1] - pixel_array[2, 0, 1] -
-                  pixel_array[0, 2, 1] + pixel_array[0, 0, 1])
+    dxy = 0.25 * (pixel_array[..., 1, 2, 2] - pixel_array[..., 1, 2, 0] -
+                  pixel_array[..., 1, 0, 2] + pixel_array[..., 1, 0, 0])
+    dxs = 0.25 * (pixel_array[..., 2, 1, 2] - pixel_array[..., 2, 1, 0] -
+                  pixel_array[..., 0, 1, 2] + pixel_array[..., 0, 1, 0])
+    dys = 0.25 * (pixel_array[..., 2, 2, 1] - pixel_array[..., 2, 0, 1] -
+                  pixel_array[..., 0, 2, 1] + pixel_array[..., 0, 0, 1])
 
-    return np.array([[dxx, dxy, dxs],
-                    [dxy, dyy, dys],
-                    [dxs, dys, dss]])
+    return np.stack([np.stack([dxx, dxy, dxs], axis=-1),
+                     np.stack([dxy, dyy, dys], axis=-1),
+                     np.stack([dxs, dys, dss], axis=-1)], axis=-2)
 
 def find_extrema(i, j, image_index, octave_index, num_intervals, dog_images_in_octave,
                  sigma, contrast_threshold, image_border_width):
     """
     Iteratively refine pixel positions of scale-space extrema via quadratic fit
     around each extremum's neighbors.
+
+    Reference implementation for a single candidate, see localize_keypoints_in_octave.
     """
     image_shape = dog_images_in_octave[0].shape
 
@@ -317,12 +548,130 @@ def find_extrema(i, j, image_index, octave_index, num_intervals, dog_images_in_o
 
     return
 
+def get_pixel_cubes(dog_volume, layer_idxs, row_idxs, col_idxs):
+    """
+    Return the 3x3x3 neighbourhoods of the given pixels of {dog_volume} as an (n, 3, 3, 3) array,
+    normalized into [0, 1] range.
+    """
+    offsets = np.arange(-1, 2)
+    pixel_cubes = dog_volume[layer_idxs[:, None, None, None] + offsets[:, None, None],
+                             row_idxs[:, None, None, None] + offsets[:, None],
+                             col_idxs[:, None, None, None] + offsets]
+
+    return pixel_cubes.astype('float32') / 255.0
+
+def solve_extremum_updates(hessians, gradients):
+    """
+    Solve hessian * update = -gradient for a stack of 3x3 systems at once.
+    """
+    try:
+        return -np.linalg.solve(hessians, gradients[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # At least one Hessian is singular. Use the least squares solution, like find_extrema.
+        return -(np.linalg.pinv(hessians) @ gradients[..., None])[..., 0]
+
+def localize_keypoints_in_octave(layer_idxs, row_idxs, col_idxs, octave_index, num_intervals,
+                                 dog_images_in_octave, sigma, contrast_threshold, image_border_width,
+                                 origin=(0, 0)):
+    """
+    Batched version of find_extrema for all candidates (layer_idxs[n], row_idxs[n], col_idxs[n])
+    in one octave. The quadratic fit is done for all candidates, which have not converged yet,
+    at once. Then the contrast and edge tests are applied as masks.
+
+    Return an array of the accepted keypoints and an array of the image (layer) index each one
+    was localized in, in the order of the candidates. The keypoint coordinates are shifted by
+    the (row, col) {origin} of the octave's image, which must be a multiple of 2 ** octave_index.
+    """
+    dog_volume = np.asarray(dog_images_in_octave)
+    num_rows, num_cols = dog_volume.shape[1:]
+    num_candidates = len(layer_idxs)
+
+    image_idxs = np.array(layer_idxs, dtype=np.intp)
+    i_idxs = np.array(row_idxs, dtype=np.intp)
+    j_idxs = np.array(col_idxs, dtype=np.intp)
+
+    # Result of the last quadratic fit of every candidate.
+    center_px = np.zeros(num_candidates, dtype='float32')
+    gradients = np.zeros((num_candidates, 3), dtype='float32')
+    hessians = np.zeros((num_candidates, 3, 3), dtype='float32')
+    extremum_updates = np.zeros((num_candidates, 3), dtype='float32')
+
+    # Candidates which are still moving, and candidates whose extremum moved outside the image.
+    active = np.arange(num_candidates)
+    outside = np.zeros(num_candidates, dtype=bool)
+
+    num_attempts_until_convergence = 3
+    for _ in range(num_attempts_until_convergence):
+        if len(active) == 0:
+            break
+
+        pixel_cubes = get_pixel_cubes(dog_volume, image_idxs[active], i_idxs[active], j_idxs[active])
+        center_px[active] = pixel_cubes[:, 1, 1, 1]
+        gradients[active] = do_gradient(pixel_cubes)
+        hessians[active] = do_hessian(pixel_cubes)
+        extremum_updates[active] = solve_extremum_updates(hessians[active], gradients[active])
+
+        # Drop the candidates with no significant change in intensity from the active set.
+        moving = np.any(np.abs(extremum_updates[active]) >= 0.5, axis=1)
+        active = active[moving]
+
+        # Clip before casting, so that huge updates from near-singular Hessians don't overflow.
+        steps = np.clip(np.round(extremum_updates[active]), -num_rows - num_cols, num_rows + num_cols)
+        steps = steps.astype(np.intp)
+        j_idxs[active] += steps[:, 0]
+        i_idxs[active] += steps[:, 1]
+        image_idxs[active] += steps[:, 2]
+
+        # make sure the new pixel_cube will lie entirely within the image
+        is_outside = (i_idxs[active] < image_border_width) | \
+                     (i_idxs[active] >= num_rows - image_border_width) | \
+                     (j_idxs[active] < image_border_width) | \
+                     (j_idxs[active] >= num_cols - image_border_width) | \
+                     (image_idxs[active] < 1) | (image_idxs[active] > num_intervals)
+        outside[active[is_outside]] = True
+        active = active[~is_outside]
+
+    # Same as find_extrema, candidates which are still moving after the last attempt are kept.
+    f_vals = center_px + 0.5 * np.einsum('ij,ij->i', gradients, extremum_updates)
+
+    xy_hessian_trace = hessians[:, 0, 0] + hessians[:, 1, 1]
+    xy_hessian_det = hessians[:, 0, 0] * hessians[:, 1, 1] - hessians[:, 0, 1] ** 2
+    eigenvalue_ratio = 10
+    accepted = ~outside & \
+               (np.abs(f_vals) * num_intervals >= contrast_threshold) & \
+               (xy_hessian_det > 0) & \
+               (eigenvalue_ratio * (xy_hessian_trace ** 2) < ((eigenvalue_ratio + 1) ** 2) * xy_hessian_det)
+
+    # Construct the keypoints for the accepted candidates.
+    # Cast the indexes to float32 to get the same float32 arithmetic as find_extrema.
+    extremum_updates = extremum_updates[accepted]
+    image_idxs = image_idxs[accepted]
+    keypoints = np.zeros(len(image_idxs), dtype=KEYPOINT_DTYPE)
+    # Shift by the origin before the float32 arithmetic, so that the result doesn't depend on it.
+    j_idxs = j_idxs + origin[1] // (2 ** octave_index)
+    i_idxs = i_idxs + origin[0] // (2 ** octave_index)
+    keypoints['x'] = (j_idxs[accepted].astype('float32') + extremum_updates[:, 0]) * (2 ** octave_index)
+    keypoints['y'] = (i_idxs[accepted].astype('float32') + extremum_updates[:, 1]) * (2 ** octave_index)
+    keypoints['octave'] = octave_index + image_idxs * (2 ** 8) + \
+                          np.round((extremum_updates[:, 2] + 0.5) * 255).astype(int) * (2 ** 16)
+    # octave_index + 1 because the input image was doubled. The power is taken in float64, because
+    # numpy's vectorized float32 power is less accurate than the scalar one used by find_extrema.
+    scale_exponent = (image_idxs.astype('float32') + extremum_updates[:, 2]) / np.float32(num_intervals)
+    keypoints['size'] = sigma * (2.0 ** scale_exponent.astype(np.float64)).astype('float32') * \
+                        (2 ** (octave_index + 1))
+    keypoints['response'] = np.abs(f_vals[accepted])
+
+    return keypoints, image_idxs
+
 
 ################################################################################
 # (3) Orientation assignment
 ################################################################################
-def assign_orientations(keypoint, octave_index, gaussian_image):
-    """Compute orientations for each keypoint
+def assign_orientations(keypoint, octave_index, gradient_map, origin=(0, 0)):
+    """Compute orientations for each keypoint, given the (magnitude, orientation)
+    gradient_map of the Gaussian image the keypoint was localized in, whose top-left
+    pixel is at {origin} (row, col) of the input image.
+    Return an array with one keypoint per dominant orientation.
     """
     # Constants from the lecture notes.
     radius_factor = 3
@@ -330,35 +679,36 @@ def assign_orientations(keypoint, octave_index, gaussian_image):
     peak_ratio = 0.8
     scale_factor = 1.5
 
-    keypoints_with_orientations = []
-    image_shape = gaussian_image.shape
+    orientations = []
+    gradient_magnitude, gradient_orientation = gradient_map
+    image_shape = gradient_magnitude.shape
 
-    scale = scale_factor * keypoint.size / np.float32(2 ** (octave_index + 1))
+    scale = scale_factor * keypoint['size'] / np.float32(2 ** (octave_index + 1))
     radius = int(round(radius_factor * scale))
     weight_factor = -0.5 / (scale ** 2)
-    raw_histogram = np.zeros(num_bins)
-    smooth_histogram = np.zeros(num_bins)
-
-    for i in range(-radius, radius + 1):
-        region_y = int(round(keypoint.pt[1] / np.float32(2 ** octave_index))) + i
-        if region_y > 0 and region_y < image_shape[0] - 1:
-            for j in range(-radius, radius + 1):
-                region_x = int(round(keypoint.pt[0] / np.float32(2 ** octave_index))) + j
-                if region_x > 0 and region_x < image_shape[1] - 1:
-                    dx = gaussian_image[region_y, region_x + 1] - gaussian_image[region_y, region_x - 1]
-                    dy = gaussian_image[region_y - 1, region_x] - gaussian_image[region_y + 1, region_x]
-
-                    gradient_magnitude = np.sqrt(dx * dx + dy * dy)
-                    gradient_orientation = np.rad2deg(np.arctan2(dy, dx))
-
-                    weight = np.exp(weight_factor * (i ** 2 + j ** 2))
-                    histogram_index = int(round(gradient_orientation * num_bins / 360.0))
-                    raw_histogram[histogram_index % num_bins] += weight * gradient_magnitude
-
-    for n in range(num_bins):
-        smooth_histogram[n] = (6 * raw_histogram[n] +
-                               4 * (raw_histogram[n - 1] + raw_histogram[(n + 1) % num_bins]) +
-                               raw_histogram[n - 2] + raw_histogram[(n + 2) % num_bins]) / 16.
+
+    # All (i, j) offsets of the neighbourhood in row-major order, i.e. the order of the
+    # pixel-by-pixel scan, without the pixels that have no gradient.
+    offsets = np.arange(-radius, radius + 1)
+    i, j = np.meshgrid(offsets, offsets, indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    region_y = int(round(keypoint['y'] / np.float32(2 ** octave_index))) - origin[0] // (2 ** octave_index) + i
+    region_x = int(round(keypoint['x'] / np.float32(2 ** octave_index))) - origin[1] // (2 ** octave_index) + j
+    in_image = (region_y > 0) & (region_y < image_shape[0] - 1) & \
+               (region_x > 0) & (region_x < image_shape[1] - 1)
+    i, j = i[in_image], j[in_image]
+    region_y, region_x = region_y[in_image], region_x[in_image]
+
+    # Distances are cast to float32 to keep the float32 weights of the scalar computation.
+    weight = np.exp(weight_factor * (i ** 2 + j ** 2).astype('float32'))
+    histogram_idxs = np.round(gradient_orientation[region_y, region_x] * num_bins / 360.0).astype(int)
+    raw_histogram = np.bincount(histogram_idxs % num_bins,
+                                weights=weight * gradient_magnitude[region_y, region_x],
+                                minlength=num_bins).astype(np.float64)
+
+    smooth_histogram = (6 * raw_histogram +
+                        4 * (np.roll(raw_histogram, 1) + np.roll(raw_histogram, -1)) +
+                        np.roll(raw_histogram, 2) + np.roll(raw_histogram, -2)) / 16.
 
     # Find peaks.
     orientation_max = max(smooth_histogram)
@@ -380,8 +730,10 @@ def assign_orientations(keypoint, octave_index, gaussian_image):
                 # Deal with float32 ULP errors beyond 360.0
                 orientation = 0
 
-            new_keypoint = cv2.KeyPoint(*keypoint.pt, keypoint.size, orientation, keypoint.response, keypoint.octave)
-            keypoints_with_orientations.append(new_keypoint)
+            orientations.append(orientation)
+
+    keypoints_with_orientations = np.repeat(keypoint[None], len(orientations))
+    keypoints_with_orientations['angle'] = orientations
 
     return keypoints_with_orientations
 
@@ -389,26 +741,31 @@ def assign_orientations(keypoint, octave_index, gaussian_image):
 ################################################################################
 # Duplicate Keypoint removal
 ################################################################################
-def cmp_keypoints(keypoint1, keypoint2):
-    """
-    Return True if keypoint1 is less than keypoint2
-    """
-    # The order of these matters. First check x, y coordinates, then size,
-    # angle, response and octave. Use the class_id as a tie breaker.
-    if keypoint1.pt[0] != keypoint2.pt[0]:
-        return keypoint1.pt[0] - keypoint2.pt[0]
-    if keypoint1.pt[1] != keypoint2.pt[1]:
-        return keypoint1.pt[1] - keypoint2.pt[1]
-    if keypoint1.size != keypoint2.size:
-        return keypoint2.size - keypoint1.size
-    if keypoint1.angle != keypoint2.angle:
-        return keypoint1.angle - keypoint2.angle
-    if keypoint1.response != keypoint2.response:
-        return keypoint2.response - keypoint1.response
-    if keypoint1.octave != keypoint2.octave:
-        return keypoint2.octave - keypoint1.octave
-
-    return keypoint2.class_id - keypoint1.class_id
+def sort_keypoints(keypoints):
+    """
+    Return the indices that sort {keypoints} in the order remove_duplicates keeps them in.
+    """
+    # The order of these matters. First sort by x, y coordinates, then by size (descending),
+    # angle, response (descending) and octave (descending). np.lexsort sorts by the last key first.
+    return np.lexsort((-keypoints['octave'], -keypoints['response'], keypoints['angle'],
+                       -keypoints['size'], keypoints['y'], keypoints['x']))
+
+def get_unique_keypoint_idxs(keypoints):
+    """
+    Return the indices of the keypoints remove_duplicates keeps, in the order it keeps them in.
+    """
+    order = sort_keypoints(keypoints)
+    keypoints = keypoints[order]
+
+    # Identical keypoints will be next to each other in the sorted sequence.
+    # It is enough to compare each keypoint to the previous keypoint.
+    is_unique = np.ones(len(keypoints), dtype=bool)
+    is_unique[1:] = (keypoints['x'][1:] != keypoints['x'][:-1]) | \
+                    (keypoints['y'][1:] != keypoints['y'][:-1]) | \
+                    (keypoints['size'][1:] != keypoints['size'][:-1]) | \
+                    (keypoints['angle'][1:] != keypoints['angle'][:-1])
+
+    return order[is_unique]
 
 def remove_duplicates(keypoints):
     """
@@ -417,155 +774,232 @@ def remove_duplicates(keypoints):
     if len(keypoints) < 2:
         return keypoints
 
-    keypoints.sort(key=cmp_to_key(cmp_keypoints))
-    unique_keypoints = [keypoints[0]]
+    return keypoints[get_unique_keypoint_idxs(keypoints)]
 
-    # Identical keypoints will be next to each other in the sorted sequence.
-    # It is enough to compare 'next_keypoint' to the previous keypoint.
-    for next_keypoint in keypoints[1:]:
-        last_unique_keypoint = unique_keypoints[-1]
-        if last_unique_keypoint.pt[0] != next_keypoint.pt[0] or \
-           last_unique_keypoint.pt[1] != next_keypoint.pt[1] or \
-           last_unique_keypoint.size != next_keypoint.size or \
-           last_unique_keypoint.angle != next_keypoint.angle:
-            unique_keypoints.append(next_keypoint)
+def get_strongest_keypoint_idxs(keypoints, max_keypoints=None):
+    """
+    Return the indices of the {max_keypoints} keypoints with the largest response, in their original order.
+    Keypoints with the same response are kept in their original order. Return all indices if {max_keypoints}
+    is None.
+    """
+    if max_keypoints is None or len(keypoints) <= max_keypoints:
+        return np.arange(len(keypoints))
 
-    return unique_keypoints
+    strongest = np.argsort(-keypoints['response'], kind='stable')[:max_keypoints]
+    return np.sort(strongest)
 
 
 ################################################################################
 # (4) Keypoint descriptor calculation
 ################################################################################
-def gen_descriptors(keypoints, gaussian_images):
+def gen_descriptor_window(angle, hist_width, half_width, window_width=4):
     """
-    Generate descriptors for each keypoint
+    Compute the geometry of a descriptor window rotated by {angle} degrees, which doesn't
+    depend on the keypoint position. Return (row, col, row_bin, col_bin, weight) arrays for the
+    (row, col) offsets, in row-major order, which fall into the window_width x window_width histogram.
+    """
+    cos_angle = np.cos(np.deg2rad(angle))
+    sin_angle = np.sin(np.deg2rad(angle))
+    weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
+
+    # All (row, col) offsets of the window, in row-major order, rotated by the keypoint angle.
+    offsets = np.arange(-half_width, half_width + 1)
+    row, col = np.meshgrid(offsets, offsets, indexing='ij')
+    row, col = row.ravel(), col.ravel()
+    row_rot = col * sin_angle + row * cos_angle
+    col_rot = col * cos_angle - row * sin_angle
+    row_bin = (row_rot / hist_width) + 0.5 * window_width - 0.5
+    col_bin = (col_rot / hist_width) + 0.5 * window_width - 0.5
+
+    in_window = (row_bin > -1) & (row_bin < window_width) & (col_bin > -1) & (col_bin < window_width)
+    row_rot, col_rot = row_rot[in_window], col_rot[in_window]
+    weight = np.exp(weight_multiplier * ((row_rot / hist_width) ** 2 + (col_rot / hist_width) ** 2))
+
+    return row[in_window], col[in_window], row_bin[in_window], col_bin[in_window], weight
+
+def accumulate_descriptor_histograms(row_bin, col_bin, magnitude, orientation_bin, descriptor_idxs,
+                                     num_descriptors, num_bins=8, window_width=4):
+    """
+    Distribute the weighted gradient {magnitude} of every sample among the histogram tensors of
+    {num_descriptors} descriptors, where sample n belongs to descriptor {descriptor_idxs[n]}.
+    Return an array of shape (num_descriptors, window_width + 2, window_width + 2, num_bins).
+    """
+    # Smoothing via (reverse) trilinear interpolation. Take the center
+    # value of the cube and distribute it among its eight neighbors.
+    row_bin_floor = np.floor(row_bin).astype(int)
+    col_bin_floor = np.floor(col_bin).astype(int)
+    orientation_bin_floor = np.floor(orientation_bin).astype(int)
+    row_fraction = row_bin - row_bin_floor
+    col_fraction = col_bin - col_bin_floor
+    orientation_fraction = orientation_bin - orientation_bin_floor
+    orientation_bin_floor %= num_bins
+
+    c1 = magnitude * row_fraction
+    c0 = magnitude * (1 - row_fraction)
+    c11 = c1 * col_fraction
+    c10 = c1 * (1 - col_fraction)
+    c01 = c0 * col_fraction
+    c00 = c0 * (1 - col_fraction)
+
+    # One (num_samples, 8) array of contributions and one of flat indexes into the
+    # histogram tensors. First two dimensions are increased by 2 to account for border effects.
+    contributions = np.stack([c00 * (1 - orientation_fraction), c00 * orientation_fraction,
+                              c01 * (1 - orientation_fraction), c01 * orientation_fraction,
+                              c10 * (1 - orientation_fraction), c10 * orientation_fraction,
+                              c11 * (1 - orientation_fraction), c11 * orientation_fraction], axis=1)
+    histogram_shape = (num_descriptors, window_width + 2, window_width + 2, num_bins)
+    next_orientation_bin = (orientation_bin_floor + 1) % num_bins
+    bin_idxs = np.stack([
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 1, col_bin_floor + 1, orientation_bin_floor), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 1, col_bin_floor + 1, next_orientation_bin), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 1, col_bin_floor + 2, orientation_bin_floor), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 1, col_bin_floor + 2, next_orientation_bin), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 2, col_bin_floor + 1, orientation_bin_floor), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 2, col_bin_floor + 1, next_orientation_bin), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 2, col_bin_floor + 2, orientation_bin_floor), histogram_shape),
+        np.ravel_multi_index((descriptor_idxs, row_bin_floor + 2, col_bin_floor + 2, next_orientation_bin), histogram_shape)],
+        axis=1)
+
+    # bincount adds up the contributions in order, sample by sample, so the sums are
+    # exactly the same as adding them to the tensor one at a time.
+    # (bincount returns ints for an empty window, hence the cast.)
+    histogram_tensors = np.bincount(bin_idxs.ravel(), weights=contributions.ravel(),
+                                    minlength=np.prod(histogram_shape)).astype(np.float64)
+
+    return histogram_tensors.reshape(histogram_shape)
+
+def normalize_descriptor(histogram_tensor, descriptor_max_value=0.2):
+    """
+    Turn a histogram tensor into a 128-d descriptor vector in the [0, 255] range.
+    """
+    # Remove histogram borders.
+    descriptor_vector = histogram_tensor[1:-1, 1:-1, :].flatten()
+    # Threshold and normalize descriptor_vector.
+    threshold = np.linalg.norm(descriptor_vector) * descriptor_max_value
+    descriptor_vector[descriptor_vector > threshold] = threshold
+    descriptor_vector /= max(np.linalg.norm(descriptor_vector), 1e-7)
+
+    # Multiply by 512, round, and saturate between 0 and 255 to convert from
+    # float32 to unsigned char (OpenCV convention)
+    descriptor_vector = np.round(512 * descriptor_vector)
+    descriptor_vector[descriptor_vector < 0] = 0
+    descriptor_vector[descriptor_vector > 255] = 255
+
+    return descriptor_vector
+
+def normalize_descriptors(histogram_tensors, descriptor_max_value=0.2):
+    """
+    Vectorized normalize_descriptor for an array of histogram tensors.
+    Return an array of shape (num_descriptors, 128).
+    """
+    descriptor_vectors = histogram_tensors[:, 1:-1, 1:-1, :].reshape(len(histogram_tensors), -1)
+    threshold = np.linalg.norm(descriptor_vectors, axis=1, keepdims=True) * descriptor_max_value
+    descriptor_vectors = np.minimum(descriptor_vectors, threshold)
+    descriptor_vectors /= np.maximum(np.linalg.norm(descriptor_vectors, axis=1, keepdims=True), 1e-7)
+
+    return np.clip(np.round(512 * descriptor_vectors), 0, 255)
+
+def gen_descriptors(keypoints, gaussian_images, gradient_maps=None, first_octave=0, origin=(0, 0)):
+    """
+    Generate descriptors for each keypoint. Keypoints of flat patches, whose descriptor
+    is all zeros, are dropped. Return the descriptors and the keypoints they belong to.
+
+    {first_octave} and {origin} have the same meaning as in identify_keypoints.
+    """
+    descriptors = gen_descriptor_vectors(keypoints, gaussian_images, gradient_maps, first_octave, origin)
+    is_used = np.any(descriptors != 0.0, axis=1)
+
+    return descriptors[is_used], keypoints[is_used]
+
+def gen_strongest_descriptors(keypoints, gen_vectors, max_keypoints=None):
+    """
+    Same as gen_descriptors, but keep only the {max_keypoints} strongest keypoints (see get_strongest_keypoint_idxs)
+    among those whose descriptor isn't all zeros, so that there are min({max_keypoints}, available) features.
+    {gen_vectors}(keypoints) returns the descriptor of each keypoint, e.g. gen_descriptor_vectors.
+
+    The descriptors are computed strongest first, in rounds of as many keypoints as are expected to give the
+    missing descriptors at the rate of non-zero descriptors so far, so that only a few more keypoints than
+    needed get descriptors.
+    """
+    if max_keypoints is None:
+        descriptors = gen_vectors(keypoints)
+        is_used = np.any(descriptors != 0.0, axis=1)
+        return descriptors[is_used], keypoints[is_used]
+
+    order = np.argsort(-keypoints['response'], kind='stable')
+    descriptors = np.zeros((len(keypoints), 128), dtype='float32')
+    is_used = np.zeros(len(keypoints), dtype=bool)
+    num_described, num_used = 0, 0
+    while num_used < max_keypoints and num_described < len(keypoints):
+        # Smoothed, so that the first round describes exactly {max_keypoints} keypoints.
+        used_rate = (num_used + 1) / (num_described + 1)
+        batch = order[num_described:num_described + int(np.ceil((max_keypoints - num_used) / used_rate))]
+        descriptors[batch] = gen_vectors(keypoints[batch])
+        is_used[batch] = np.any(descriptors[batch] != 0.0, axis=1)
+        num_described += len(batch)
+        num_used = np.count_nonzero(is_used)
+
+    # The last round can give more descriptors than needed, keep the strongest.
+    described = order[:num_described]
+    used_idxs = np.sort(described[is_used[described]][:max_keypoints])
+    return descriptors[used_idxs], keypoints[used_idxs]
+
+def gen_descriptor_vectors(keypoints, gaussian_images, gradient_maps=None, first_octave=0, origin=(0, 0)):
+    """
+    Same as gen_descriptors, but return the descriptor of every keypoint, including the all-zero ones.
     """
     # Constants from the lecture notes and Lowe's SIFT paper.
     num_bins = 8
     scale_multiplier = 3
-    descriptor_max_value = 0.2
     window_width = 4
 
-    descriptors = []
-    keypoints_used = []
+    if gradient_maps is None:
+        gradient_maps = gen_gradient_maps(gaussian_images)
+
+    descriptors = np.zeros((len(keypoints), 128), dtype='float32')
 
-    for keypoint in keypoints:
+    for keypoint_idx, keypoint in enumerate(keypoints):
         octave, layer, scale = unpack_octave(keypoint)
-        gaussian_image = gaussian_images[octave + 1, layer]
-        num_rows, num_cols = gaussian_image.shape
+        gradient_magnitude, gradient_orientation = gradient_maps[octave + 1 - first_octave][layer]
+        num_rows, num_cols = gradient_magnitude.shape
 
-        point = np.round(scale * np.array(keypoint.pt)).astype('int')
+        point = np.round(scale * np.array([keypoint['x'], keypoint['y']], dtype=np.float64)).astype('int')
+        point -= [origin[1] // (2 ** (octave + 1)), origin[0] // (2 ** (octave + 1))]
         bins_per_degree = num_bins / 360.0
-        angle = 360.0 - keypoint.angle
-        cos_angle = np.cos(np.deg2rad(angle))
-        sin_angle = np.sin(np.deg2rad(angle))
-        weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
-
-        row_bin_list = []
-        col_bin_list = []
-        magnitude_list = []
-        orientation_bin_list = []
-        # First two dimensions are increased by 2 to account for border effects.
-        histogram_tensor = np.zeros((window_width + 2, window_width + 2, num_bins))
+        angle = 360.0 - float(keypoint['angle'])
 
         # Descriptor window size (described by half_width) follows OpenCV convention.
-        hist_width = scale_multiplier * 0.5 * scale * keypoint.size
+        hist_width = scale_multiplier * 0.5 * scale * keypoint['size']
         # sqrt(2) corresponds to diagonal length of a pixel
         half_width = int(round(hist_width * np.sqrt(2) * (window_width + 1) * 0.5))
         # Ensure half_width lies within image.
         half_width = int(min(half_width, np.sqrt(num_rows ** 2 + num_cols ** 2)))
 
-        for row in range(-half_width, half_width + 1):
-            for col in range(-half_width, half_width + 1):
-                row_rot = col * sin_angle + row * cos_angle
-                col_rot = col * cos_angle - row * sin_angle
-                row_bin = (row_rot / hist_width) + 0.5 * window_width - 0.5
-                col_bin = (col_rot / hist_width) + 0.5 * window_width - 0.5
-
-                if row_bin > -1 and row_bin < window_width and col_bin > -1 and col_bin < window_width:
-                    window_row = int(round(point[1] + row))
-                    window_col = int(round(point[0] + col))
-                    if window_row > 0 and window_row < num_rows - 1 and window_col > 0 and window_col < num_cols - 1:
-                        # Use local image gradients at the selected scale.
-                        dx = gaussian_image[window_row, window_col + 1] - \
-                             gaussian_image[window_row, window_col - 1]
-                        dy = gaussian_image[window_row - 1, window_col] - \
-                             gaussian_image[window_row + 1, window_col]
-
-                        gradient_magnitude = np.sqrt(dx * dx + dy * dy)
-                        gradient_orientation = np.rad2deg(np.arctan2(dy, dx)) % 360
-                        weight = np.exp(weight_multiplier * ((row_rot / hist_width) ** 2 + (col_rot / hist_width) ** 2))
-
-                        row_bin_list.append(row_bin)
-                        col_bin_list.append(col_bin)
-                        magnitude_list.append(weight * gradient_magnitude)
-                        orientation_bin_list.append((gradient_orientation - angle) * bins_per_degree)
-
-        iter_struct = zip(row_bin_list, col_bin_list, magnitude_list, orientation_bin_list)
-        for row_bin, col_bin, magnitude, orientation_bin in iter_struct:
-            # Smoothing via (reverse) trilinear interpolation. Take the center
-            # value of the cube and distribute it among its eight neighbors.
-            row_bin_floor, col_bin_floor, orientation_bin_floor = \
-                np.floor([row_bin, col_bin, orientation_bin]).astype(int)
-            row_fraction = row_bin - row_bin_floor
-            col_fraction =  col_bin - col_bin_floor
-            orientation_fraction = orientation_bin - orientation_bin_floor
-
-            if orientation_bin_floor < 0:
-                orientation_bin_floor += num_bins
-            if orientation_bin_floor >= num_bins:
-                orientation_bin_floor -= num_bins
-
-            c1 = magnitude * row_fraction
-            c0 = magnitude * (1 - row_fraction)
-            c11 = c1 * col_fraction
-            c10 = c1 * (1 - col_fraction)
-            c01 = c0 * col_fraction
-            c00 = c0 * (1 - col_fraction)
-            c111 = c11 * orientation_fraction
-            c110 = c11 * (1 - orientation_fraction)
-            c101 = c10 * orientation_fraction
-            c100 = c10 * (1 - orientation_fraction)
-            c011 = c01 * orientation_fraction
-            c010 = c01 * (1 - orientation_fraction)
-            c001 = c00 * orientation_fraction
-            c000 = c00 * (1 - orientation_fraction)
-
-            histogram_tensor[row_bin_floor + 1, col_bin_floor + 1, orientation_bin_floor] += c000
-            histogram_tensor[row_bin_floor + 1, col_bin_floor + 1, (orientation_bin_floor + 1) % num_bins] += c001
-            histogram_tensor[row_bin_floor + 1, col_bin_floor + 2, orientation_bin_floor] += c010
-            histogram_tensor[row_bin_floor + 1, col_bin_floor + 2, (orientation_bin_floor + 1) % num_bins] += c011
-            histogram_tensor[row_bin_floor + 2, col_bin_floor + 1, orientation_bin_floor] += c100
-            histogram_tensor[row_bin_floor + 2, col_bin_floor + 1, (orientation_bin_floor + 1) % num_bins] += c101
-            histogram_tensor[row_bin_floor + 2, col_bin_floor + 2, orientation_bin_floor] += c110
-            histogram_tensor[row_bin_floor + 2, col_bin_floor + 2, (orientation_bin_floor + 1) % num_bins] += c111
-
-        # Remove histogram borders.
-        descriptor_vector = histogram_tensor[1:-1, 1:-1, :].flatten()
-        # Threshold and normalize descriptor_vector.
-        threshold = np.linalg.norm(descriptor_vector) * descriptor_max_value
-        descriptor_vector[descriptor_vector > threshold] = threshold
-        descriptor_vector /= max(np.linalg.norm(descriptor_vector), 1e-7)
-
-        # Multiply by 512, round, and saturate between 0 and 255 to convert from
-        # float32 to unsigned char (OpenCV convention)
-        descriptor_vector = np.round(512 * descriptor_vector)
-        descriptor_vector[descriptor_vector < 0] = 0
-        descriptor_vector[descriptor_vector > 255] = 255
-
-        if not np.all(descriptor_vector == 0.0):
-            descriptors.append(descriptor_vector)
-            keypoints_used.append(keypoint)
-
-    return np.array(descriptors, dtype='float32'), keypoints_used
+        row, col, row_bin, col_bin, weight = gen_descriptor_window(angle, hist_width, half_width, window_width)
+        window_row = point[1] + row
+        window_col = point[0] + col
+        in_image = (window_row > 0) & (window_row < num_rows - 1) & (window_col > 0) & (window_col < num_cols - 1)
+        window_row, window_col = window_row[in_image], window_col[in_image]
+
+        # Use local image gradients at the selected scale.
+        magnitude = weight[in_image] * gradient_magnitude[window_row, window_col]
+        orientation_bin = ((gradient_orientation[window_row, window_col] % 360) - angle) * bins_per_degree
+
+        histogram_tensor = accumulate_descriptor_histograms(row_bin[in_image], col_bin[in_image],
+                                                            magnitude, orientation_bin,
+                                                            np.zeros(len(magnitude), dtype=int), 1,
+                                                            num_bins, window_width)[0]
+        descriptors[keypoint_idx] = normalize_descriptor(histogram_tensor)
+
+    return descriptors
 
 def unpack_octave(keypoint):
     """
     Compute octave, layer, and scale from a keypoint
     """
     # Put octave back into int8 range
-    octave = keypoint.octave & 255
-    layer = (keypoint.octave >> 8) & 255
+    octave = int(keypoint['octave']) & 255
+    layer = (int(keypoint['octave']) >> 8) & 255
 
     if octave >= 128:
         octave = octave | -128
@@ -577,12 +1011,15 @@ def unpack_octave(keypoint):
 ################################################################################
 # SIFT main function
 ################################################################################
-def extract_SIFT_features(img, sigma=1.6):
+def extract_SIFT_features(img, sigma=1.6, max_keypoints=None):
     """
     Extract the SIFT features from the input image.
 
-    Returns the extracted keypoints and the generated SIFT descriptors.
-    One keypoint is mapped to one descriptor.
+    Returns the generated SIFT descriptors and the extracted keypoints, as an array of
+    KEYPOINT_DTYPE records (see to_cv2_keypoints). One keypoint is mapped to one descriptor.
+    If {max_keypoints} is given, only the keypoints with the largest response get descriptors,
+    so that there are {max_keypoints} features per image, or fewer if the image has fewer
+    (see gen_strongest_descriptors).
     """
     # SIFT uses only a monochrome intensity image.
     if len(img.shape) == 3:
@@ -594,41 +1031,547 @@ def extract_SIFT_features(img, sigma=1.6):
 
     # Gaussian image pyramid.
     sigmas = gen_gaussian_sigmas_in_octaves(sigma)
-    gaussian_images = apply_gaussian_kernels(img, num_octaves, sigmas)
-    dog_images = do_dog(gaussian_images)
+    gaussian_images, dog_images = gen_pyramid(img, num_octaves, sigmas)
+
+    gradient_maps = gen_gradient_maps(gaussian_images)
 
-    keypoints = identify_keypoints(gaussian_images, dog_images)
+    keypoints = identify_keypoints(gaussian_images, dog_images, gradient_maps)
     keypoints = remove_duplicates(keypoints)
 
-    descriptors, keypoints_used = gen_descriptors(keypoints, gaussian_images)
+    # Prune before the descriptors, which are the most expensive step per keypoint.
+    gen_vectors = partial(gen_descriptor_vectors, gaussian_images=gaussian_images, gradient_maps=gradient_maps)
+    return gen_strongest_descriptors(keypoints, gen_vectors, max_keypoints)
 
-    return descriptors, keypoints_used
 
+################################################################################
+# Multithreaded SIFT
+################################################################################
+def identify_keypoints_in_octave(octave_index, gaussian_imgs_in_octave, dog_imgs_in_octave):
+    """
+    Run steps (1)-(3) on a single octave of the pyramid.
+    Return the octave's gradient maps and its keypoints, without duplicates.
+    """
+    gradient_magnitude, gradient_orientation = gen_gradient_map(gaussian_imgs_in_octave)
+    gradient_maps_in_octave = list(zip(gradient_magnitude, gradient_orientation))
 
-if __name__ == "__main__":
-    start_time = time.time()
+    keypoints = identify_keypoints([gaussian_imgs_in_octave], [dog_imgs_in_octave], [gradient_maps_in_octave],
+                                   first_octave=octave_index)
 
-    # Extract SIFT descriptors from training and test images. Store the descriptors in seperate
-    # binary files based on type and class, e.g. trainig_descriptors/cars, test_descriptors/cars, ..
-    for training_or_test in ['Training', 'Test']:
-        for class_name in CLASSES:
-            class_imgs = load_images_in_directory(f'{DATASET_DIR}/{training_or_test}/{class_name}')
-            for fname, img in class_imgs.items():
-                descriptors, keypoints = extract_SIFT_features(img)
+    return gradient_maps_in_octave, remove_duplicates(keypoints)
+
+def describe_octave(octave_index, octave_future, next_octave_future=None):
+    """
+    Run step (4) on the keypoints of a single octave, given the futures of identify_keypoints_in_octave
+    for the octave and for the next one, whose gradient maps the descriptors are computed from.
+    Return the keypoints and all their descriptors (see gen_descriptor_vectors).
+    """
+    gradient_maps_in_octave, keypoints = octave_future.result()
+    gradient_maps = [gradient_maps_in_octave]
+    if next_octave_future is not None:
+        gradient_maps.append(next_octave_future.result()[0])
+
+    return keypoints, gen_descriptor_vectors(keypoints, None, gradient_maps, first_octave=octave_index)
+
+def gen_descriptor_vectors_by_octave(keypoints, gradient_maps, executor):
+    """
+    Same as gen_descriptor_vectors given the {gradient_maps} of all octaves, but the keypoints
+    of each octave are described in a separate task of {executor}.
+    """
+    octaves = keypoints['octave'] & 255
+    descriptors = np.zeros((len(keypoints), 128), dtype='float32')
+
+    futures = []
+    for octave_index in np.unique(octaves):
+        in_octave = octaves == octave_index
+        futures.append((in_octave, executor.submit(gen_descriptor_vectors, keypoints[in_octave], None,
+                                                   gradient_maps[octave_index:octave_index + 2],
+                                                   first_octave=octave_index)))
+    for in_octave, future in futures:
+        descriptors[in_octave] = future.result()
+
+    return descriptors
+
+def extract_SIFT_features_threaded(img, sigma=1.6, num_threads=None, max_keypoints=None):
+    """
+    Same as extract_SIFT_features, but lower the latency for a single image by using {num_threads}
+    threads (default: one per CPU). Each blur is split into blocks which are blurred concurrently and,
+    as soon as an octave is ready, its keypoints are found while the next octaves are built. As soon as
+    the next octave's gradient maps are ready too, the octave's descriptors are computed.
+    Only NumPy releases the GIL, so the speedup depends on how much time is spent in NumPy.
+    With {max_keypoints}, the keypoints of all octaves are found first, and only the strongest get
+    descriptors (see gen_strongest_descriptors), the keypoints of each octave in a separate thread.
+
+    The result is identical to extract_SIFT_features: each step works on independent octaves
+    or keypoints, and the results are merged in the same order.
+    """
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    num_octaves = int(round(math.log(min(img.shape), 2) - 1))
+    sigmas = gen_gaussian_sigmas_in_octaves(sigma)
+    num_threads = num_threads or os.cpu_count()
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        octave_futures, descriptor_futures = [], []
+        octaves = iter_gaussian_octaves(img, num_octaves, sigmas, executor, with_dog=True)
+        for octave_index, (gaussian_imgs_in_octave, dog_imgs_in_octave) in enumerate(octaves):
+            octave_futures.append(executor.submit(identify_keypoints_in_octave, octave_index,
+                                                  gaussian_imgs_in_octave, dog_imgs_in_octave))
+            # The pool runs the tasks in the order they were submitted, so the futures a task
+            # waits for have already started and it can't deadlock.
+            if octave_index > 0 and max_keypoints is None:
+                descriptor_futures.append(executor.submit(describe_octave, octave_index - 1,
+                                                          octave_futures[-2], octave_futures[-1]))
+
+        if max_keypoints is not None:
+            # Which keypoints get descriptors depends on the keypoints of all octaves.
+            gradient_maps, keypoints = zip(*[future.result() for future in octave_futures])
+            keypoints = remove_duplicates(np.concatenate(keypoints))
+            gen_vectors = partial(gen_descriptor_vectors_by_octave, gradient_maps=gradient_maps, executor=executor)
+            return gen_strongest_descriptors(keypoints, gen_vectors, max_keypoints)
+
+        if octave_futures:
+            descriptor_futures.append(executor.submit(describe_octave, len(octave_futures) - 1, octave_futures[-1]))
+
+        # Collect in octave order, so that the merged keypoints don't depend on the timing.
+        keypoints, descriptors = zip(*[future.result() for future in descriptor_futures])
+
+    keypoints, descriptors = np.concatenate(keypoints), np.concatenate(descriptors)
+    # Duplicates can only be found across octaves when the octaves are merged.
+    idxs = get_unique_keypoint_idxs(keypoints)
+    keypoints, descriptors = keypoints[idxs], descriptors[idxs]
+
+    # Same as gen_descriptors, drop the keypoints of flat patches.
+    is_used = np.any(descriptors != 0.0, axis=1)
+    return descriptors[is_used], keypoints[is_used]
+
+
+################################################################################
+# Tiled SIFT
+################################################################################
+# Rough peak memory of extract_SIFT_features per pixel of the input image (the float32 pyramid,
+# DoG and gradient maps of all octaves, plus the float64 temporaries of the blurs).
+SIFT_BYTES_PER_PIXEL = 200
+# Largest orientation and descriptor window radius, in pixels of the octave they are computed in.
+TILE_WINDOW_BORDER = 48
+DEFAULT_MEMORY_BUDGET = 512 * 2 ** 20
+
+def get_tile_margin(num_tiled_octaves, sigmas):
+    """
+    Return the margin (in pixels of the input image) that tiles need so that the first
+    {num_tiled_octaves} octaves of a tile are the same as those of the whole image.
+    """
+    # Pixels next to the border of a tile are blurred with missing neighbours. Each layer is blurred
+    # from the previous one, so these errors reach the sum of the kernel radii into an octave. The base
+    # of every octave is taken from the previous octave, halving its errors, so they reach at most
+    # twice that into each octave (in pixels of that octave).
+    blur_radius = 2 * sum(len(gen_gaussian_kernel_1D(sigma)) // 2 for sigma in sigmas[1:])
+    step = 2 ** num_tiled_octaves
+    # Keypoints of the last tiled octave use gradient maps of one octave up, which are computed
+    # from the whole image, so the deepest tiled windows are in octave num_tiled_octaves - 1.
+    margin = (2 ** (num_tiled_octaves - 1)) * (blur_radius + TILE_WINDOW_BORDER)
+
+    # Tiles (and their margins) must start at multiples of step, to downsample in step with the whole image.
+    return -(-margin // step) * step
+
+def plan_tiles(img_shape, num_octaves, sigmas, memory_budget):
+    """
+    Choose how to split an image of {img_shape} so that no step needs more than {memory_budget} bytes.
+    Return (num_tiled_octaves, tile_size, margin): the first num_tiled_octaves octaves are computed
+    in square tiles of tile_size pixels, each cropped with margin extra pixels on every side,
+    and the remaining octaves on the whole (downsampled) image.
+    Return num_tiled_octaves == 0 if the whole image fits in the budget.
+
+    A tile is processed with its margins, so the margins count against the budget. Tiles are never
+    smaller than their margin, otherwise most of the time would be spent on the margins: each pixel
+    of the image is then processed at most 9 times. Raise ValueError if the budget is too small
+    for that, with the smallest budget which isn't.
+    """
+    num_pixels = img_shape[0] * img_shape[1]
+    if num_pixels * SIFT_BYTES_PER_PIXEL <= memory_budget:
+        return 0, max(img_shape), 0
+
+    max_crop_size = int(math.sqrt(memory_budget / SIFT_BYTES_PER_PIXEL))
+    min_memory_budget = num_pixels * SIFT_BYTES_PER_PIXEL
+    for num_tiled_octaves in range(1, num_octaves):
+        step = 2 ** num_tiled_octaves
+        margin = get_tile_margin(num_tiled_octaves, sigmas)
+        # The crop of a tile, i.e. the tile and its margins, must fit in the budget.
+        tile_size = (max_crop_size - 2 * margin) // step * step
+        untiled_memory = num_pixels / 4 ** num_tiled_octaves * SIFT_BYTES_PER_PIXEL
+
+        if tile_size >= margin and untiled_memory <= memory_budget:
+            return num_tiled_octaves, tile_size, margin
+        min_memory_budget = min(min_memory_budget, max((3 * margin) ** 2 * SIFT_BYTES_PER_PIXEL, untiled_memory))
+
+    raise ValueError(f'Memory budget of {memory_budget / 2 ** 20:.1f} MB is too small for an image of shape '
+                     f'{img_shape}, it needs at least {min_memory_budget / 2 ** 20:.1f} MB.')
+
+def get_tiles(img_shape, tile_size, margin):
+    """
+    Yield the (row, col) index of every tile of an image of {img_shape}, with the (rows, cols) slices
+    of its core and of its crop, i.e. the core with {margin} extra pixels on every side.
+    """
+    for tile_row, row_start in enumerate(range(0, img_shape[0], tile_size)):
+        for tile_col, col_start in enumerate(range(0, img_shape[1], tile_size)):
+            core_rows = slice(row_start, min(row_start + tile_size, img_shape[0]))
+            core_cols = slice(col_start, min(col_start + tile_size, img_shape[1]))
+            crop_rows = slice(max(core_rows.start - margin, 0), min(core_rows.stop + margin, img_shape[0]))
+            crop_cols = slice(max(core_cols.start - margin, 0), min(core_cols.stop + margin, img_shape[1]))
+
+            yield (tile_row, tile_col), (core_rows, core_cols), (crop_rows, crop_cols)
+
+def get_tile_idxs(coords, tile_size, num_tiles):
+    """
+    Return the index of the tile (along one axis) that each of {coords} belongs to.
+    Coordinates outside of the image belong to the closest tile.
+    """
+    return np.clip(np.floor(coords / tile_size), 0, num_tiles - 1).astype(int)
+
+def iter_SIFT_features_tiled(img, sigma=1.6, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Same as extract_SIFT_features, but compute the largest octaves in overlapping tiles so that
+    no step needs (roughly) more than {memory_budget} bytes, on top of the image and the keypoints.
+    Yield the descriptors and keypoints in (descriptors, keypoints) chunks, one per tile, in no
+    particular order. Sort them with sort_keypoints to get the order of extract_SIFT_features.
+
+    The result is the same as extract_SIFT_features, except for keypoints whose localization
+    moves them further than the margin of a tile, which can be lost or gained at tile boundaries,
+    and keypoints right at a threshold, which rounding differences between the blurs of a tile and of
+    the whole image can flip. E.g. on a 1200x1000 image with 2381 keypoints, 8 keypoints are only in
+    one of the results with a budget of 64 MB (1 tiled octave), and 56 with 32 MB (2 tiled octaves).
+    """
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    num_octaves = int(round(math.log(min(img.shape), 2) - 1))
+    sigmas = gen_gaussian_sigmas_in_octaves(sigma)
 
-                # Store a single keypoint as [(x, y), diameter].
-                # keypoints[i] corresponds to descriptors[i]
-                keypoints = [[k.pt, k.size] for k in keypoints]
+    num_tiled_octaves, tile_size, margin = plan_tiles(img.shape, num_octaves, sigmas, memory_budget)
+    if num_tiled_octaves == 0:
+        yield extract_SIFT_features(img, sigma)
+        return
 
-                fname = fname.split('.')[0]
-                d_file = f'{DATASET_DIR}/{training_or_test.lower()}/{class_name}/{fname}_descriptors.npy'
-                k_file = f'{DATASET_DIR}/{training_or_test.lower()}/{class_name}/{fname}_keypoints.npy'
-                with open(d_file, 'wb') as f:
-                    np.save(f, descriptors)
-                with open(k_file, 'wb') as f:
-                    np.save(f, keypoints)
+    step = 2 ** num_tiled_octaves
+    num_tiles = (-(-img.shape[0] // tile_size), -(-img.shape[1] // tile_size))
+    tiles = list(get_tiles(img.shape, tile_size, margin))
 
-                print(f'Finished {fname} of {class_name} of {training_or_test} at minute {(time.time() - start_time)//60}')
+    # Size of the base of the first octave that is computed on the whole image.
+    base_shape = img.shape
+    for _ in range(num_tiled_octaves):
+        base_shape = (int(base_shape[0] / 2), int(base_shape[1] / 2))
+    octave_base = np.empty(base_shape, dtype='float32')
 
+    # (1) Find the keypoints of the tiled octaves, and assemble the next octave base from the tiles.
+    keypoints = []
+    for tile_idx, (core_rows, core_cols), (crop_rows, crop_cols) in tiles:
+        origin = (crop_rows.start, crop_cols.start)
+        gaussian_images = apply_gaussian_kernels(img[crop_rows, crop_cols], num_tiled_octaves + 1, sigmas)
+        tiled_gaussian_images = gaussian_images[:num_tiled_octaves]
+
+        tile_keypoints = identify_keypoints(tiled_gaussian_images, do_dog(tiled_gaussian_images),
+                                            gen_gradient_maps(tiled_gaussian_images), origin=origin)
+        # Keep only the keypoints in the core of the tile, the margins belong to other tiles.
+        in_core = (get_tile_idxs(tile_keypoints['y'], tile_size, num_tiles[0]) == tile_idx[0]) & \
+                  (get_tile_idxs(tile_keypoints['x'], tile_size, num_tiles[1]) == tile_idx[1])
+        keypoints.append(tile_keypoints[in_core])
+
+        base_rows = slice(core_rows.start // step, min(-(-core_rows.stop // step), base_shape[0]))
+        base_cols = slice(core_cols.start // step, min(-(-core_cols.stop // step), base_shape[1]))
+        octave_base[base_rows, base_cols] = gaussian_images[num_tiled_octaves][0][
+            base_rows.start - crop_rows.start // step:base_rows.stop - crop_rows.start // step,
+            base_cols.start - crop_cols.start // step:base_cols.stop - crop_cols.start // step]
+        del gaussian_images, tiled_gaussian_images
+
+    # (2) The remaining octaves fit in memory as a whole.
+    gaussian_images = apply_gaussian_kernels(octave_base, num_octaves - num_tiled_octaves, sigmas)
+    gradient_maps = gen_gradient_maps(gaussian_images)
+    keypoints.append(identify_keypoints(gaussian_images, do_dog(gaussian_images), gradient_maps,
+                                        first_octave=num_tiled_octaves))
+    keypoints = remove_duplicates(np.concatenate(keypoints))
+
+    # Descriptors are computed from the gradient maps one octave up from the keypoint's octave.
+    octaves = keypoints['octave'] & 255
+    is_untiled = octaves >= num_tiled_octaves - 1
+    yield gen_descriptors(keypoints[is_untiled], gaussian_images, gradient_maps, first_octave=num_tiled_octaves)
+    del gaussian_images, gradient_maps
+
+    # (3) Compute the other descriptors tile by tile. Same as in gen_descriptors, a descriptor window
+    # is centred at twice the keypoint position, so group the keypoints by the tile of the window.
+    keypoints, octaves = keypoints[~is_untiled], octaves[~is_untiled]
+    window_y = np.round(keypoints['y'].astype(np.float64) / 2 ** octaves) * 2 ** (octaves + 1)
+    window_x = np.round(keypoints['x'].astype(np.float64) / 2 ** octaves) * 2 ** (octaves + 1)
+    window_tile_rows = get_tile_idxs(window_y, tile_size, num_tiles[0])
+    window_tile_cols = get_tile_idxs(window_x, tile_size, num_tiles[1])
+
+    for tile_idx, _, (crop_rows, crop_cols) in tiles:
+        in_tile = (window_tile_rows == tile_idx[0]) & (window_tile_cols == tile_idx[1])
+        if not np.any(in_tile):
+            continue
+
+        gaussian_images = apply_gaussian_kernels(img[crop_rows, crop_cols], num_tiled_octaves, sigmas)
+        yield gen_descriptors(keypoints[in_tile], gaussian_images, origin=(crop_rows.start, crop_cols.start))
+        del gaussian_images
+
+def extract_SIFT_features_tiled(img, sigma=1.6, memory_budget=DEFAULT_MEMORY_BUDGET, max_keypoints=None):
+    """
+    Collect the chunks of iter_SIFT_features_tiled in the same order as extract_SIFT_features.
+    If {max_keypoints} is given, keep the same features as extract_SIFT_features. Unlike there, all
+    keypoints get descriptors first, since computing them again for another round would blur the tiles again.
+    """
+    descriptors, keypoints = zip(*iter_SIFT_features_tiled(img, sigma, memory_budget))
+    descriptors, keypoints = np.concatenate(descriptors), np.concatenate(keypoints)
+    order = sort_keypoints(keypoints)
+    order = order[get_strongest_keypoint_idxs(keypoints[order], max_keypoints)]
+
+    return descriptors[order], keypoints[order]
+
+
+################################################################################
+# Dense SIFT
+################################################################################
+# Keypoint diameters of dense features. They are smaller than the diameter of the keypoints which
+# gen_histograms maps to their codewords by default, see hp.DENSE_KP_DIAMETER_THRESHOLD.
+DENSE_SIZES = (4.0, 6.0, 8.0)
+
+def gen_orientation_channels(gradient_magnitude, gradient_orientation, angle, num_bins=8):
+    """
+    Split the gradient magnitude of every pixel between its two closest orientation bins relative
+    to {angle} degrees, the same way as accumulate_descriptor_histograms.
+    Return an array of shape (num_bins, rows, cols).
+    """
+    orientation_bin = ((gradient_orientation % 360) - angle) * (num_bins / 360.0)
+    orientation_bin_floor = np.floor(orientation_bin)
+    orientation_fraction = orientation_bin - orientation_bin_floor
+    orientation_bin_floor = orientation_bin_floor.astype(int) % num_bins
+
+    channels = np.zeros((num_bins,) + gradient_magnitude.shape)
+    rows, cols = np.indices(gradient_magnitude.shape)
+    np.add.at(channels, (orientation_bin_floor, rows, cols), gradient_magnitude * (1 - orientation_fraction))
+    np.add.at(channels, ((orientation_bin_floor + 1) % num_bins, rows, cols), gradient_magnitude * orientation_fraction)
+
+    return channels
+
+def gen_window_coefficients(hist_width, half_width, window_width=4):
+    """
+    Compute the geometry of an upright descriptor window along one axis. Return the offsets which fall
+    into the window, and an array of shape (num_offsets, window_width) of the weight of each offset in
+    each histogram bin, i.e. its Gaussian weight times its share of the bin (see gen_descriptor_window).
+    """
+    weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
+
+    offsets = np.arange(-half_width, half_width + 1)
+    bins = offsets / hist_width + 0.5 * window_width - 0.5
+    in_window = (bins > -1) & (bins < window_width)
+    offsets, bins = offsets[in_window], bins[in_window]
+    weight = np.exp(weight_multiplier * (offsets / hist_width) ** 2)
+
+    # The first and last bins are the borders which normalize_descriptor removes.
+    bin_floor = np.floor(bins).astype(int)
+    bin_fraction = bins - bin_floor
+    coefficients = np.zeros((len(offsets), window_width + 2))
+    coefficients[np.arange(len(offsets)), bin_floor + 1] += weight * (1 - bin_fraction)
+    coefficients[np.arange(len(offsets)), bin_floor + 2] += weight * bin_fraction
+
+    return offsets, coefficients[:, 1:-1]
+
+def extract_dense_SIFT_features(img, stride=8, sizes=DENSE_SIZES, max_samples=2 ** 22):
+    """
+    Extract upright SIFT descriptors on a regular grid, every {stride} pixels, at each keypoint
+    diameter in {sizes}, without detecting keypoints. The cost only depends on the image size.
+
+    Returns the descriptors and the keypoints, in the same format as extract_SIFT_features.
+    A descriptor is the same as gen_descriptors would generate for an upright keypoint of the same
+    size at the same position of the input image blurred to match the size, i.e. with sigma = size / 2,
+    as the size of a keypoint is twice the blur of the Gaussian image it was found in (up to floating
+    point rounding, which can change a few entries by 1).
+
+    All windows of a size have the same geometry, and the weight of a sample in an upright window is
+    the product of a weight along its row and one along its column. So the gradient magnitudes are
+    split into orientation channels once per size, and the histograms of all grid points are summed
+    with two matrix products, first along the rows of the window and then along its columns,
+    gathering no more than {max_samples} gradient samples at once.
+    """
+    # Constants from the lecture notes and Lowe's SIFT paper.
+    num_bins = 8
+    scale_multiplier = 3
+    window_width = 4
+
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-    print(f'Finished all in {(time.time() - start_time)//60} minutes.')
+    num_rows, num_cols = img.shape
+    grid_rows = np.arange(stride // 2, num_rows, stride)
+    grid_cols = np.arange(stride // 2, num_cols, stride)
+    grid_y, grid_x = np.meshgrid(grid_rows, grid_cols, indexing='ij')
+    grid_y, grid_x = grid_y.ravel(), grid_x.ravel()
+
+    # Upright keypoints, i.e. keypoint.angle == 0.
+    angle = 360.0
+
+    descriptors = []
+    keypoints = []
+    for size in sizes:
+        # Blur once per size. All grid points of a size share the gradients of its Gaussian image.
+        gaussian_image = separable_convolution(img, gen_gaussian_kernel_1D(size / 2, normalise=True)).astype('float32')
+        gradient_magnitude, gradient_orientation = gen_gradient_map(gaussian_image)
+
+        hist_width = scale_multiplier * 0.5 * size
+        half_width = int(round(hist_width * np.sqrt(2) * (window_width + 1) * 0.5))
+        half_width = int(min(half_width, np.sqrt(num_rows ** 2 + num_cols ** 2)))
+        offsets, coefficients = gen_window_coefficients(hist_width, half_width, window_width)
+
+        # Same as gen_descriptors, samples on the border or outside of the image don't count.
+        channels = gen_orientation_channels(gradient_magnitude, gradient_orientation, angle, num_bins)
+        channels[:, [0, -1], :] = 0
+        channels[:, :, [0, -1]] = 0
+        channels = np.pad(channels, ((0, 0), (half_width, half_width), (half_width, half_width)))
+
+        # (1) Sum along the window rows of every grid column, in chunks of columns.
+        # (num_bins, padded rows, grid columns, window_width) array.
+        col_sums = np.empty((num_bins, channels.shape[1], len(grid_cols), window_width))
+        chunk_size = max(1, max_samples // (num_bins * channels.shape[1] * len(offsets)))
+        for chunk_start in range(0, len(grid_cols), chunk_size):
+            window_cols = grid_cols[chunk_start:chunk_start + chunk_size, None] + offsets + half_width
+            col_sums[:, :, chunk_start:chunk_start + chunk_size] = channels[:, :, window_cols] @ coefficients
+
+        # (2) Sum along the window columns of every grid row.
+        # (grid rows, grid columns, row bin, column bin, orientation bin) array.
+        window_rows = grid_rows[:, None] + offsets + half_width
+        histograms = np.einsum('oynxc,nr->yxrco', col_sums[:, window_rows], coefficients)
+
+        # normalize_descriptors expects the border bins too.
+        histogram_tensors = np.pad(histograms.reshape(-1, window_width, window_width, num_bins),
+                                   ((0, 0), (1, 1), (1, 1), (0, 0)))
+        descriptor_vectors = normalize_descriptors(histogram_tensors)
+
+        # Same as gen_descriptors, drop the descriptors of flat patches.
+        non_zero = np.any(descriptor_vectors != 0.0, axis=1)
+        descriptors.append(descriptor_vectors[non_zero])
+        size_keypoints = np.zeros(np.count_nonzero(non_zero), dtype=KEYPOINT_DTYPE)
+        size_keypoints['x'] = grid_x[non_zero]
+        size_keypoints['y'] = grid_y[non_zero]
+        size_keypoints['size'] = size
+        keypoints.append(size_keypoints)
+
+    return np.concatenate(descriptors).astype('float32'), np.concatenate(keypoints)
+
+
+################################################################################
+# Batch feature extraction
+################################################################################
+def get_feature_fnames(img_path):
+    """
+    Given the path to an image, return the paths of its descriptors and keypoints files.
+    """
+    fname = os.path.splitext(img_path)[0]
+    return f'{fname}_descriptors.npy', f'{fname}_keypoints.npy'
+
+def is_extracted(img_path):
+    """
+    Return True if both feature files of the image exist and are newer than the image, and the
+    keypoints file isn't older than the descriptors file, i.e. both were written by the same run
+    (see extract_and_save_SIFT_features).
+    """
+    img_mtime = os.path.getmtime(img_path)
+    d_file, k_file = get_feature_fnames(img_path)
+    return all(os.path.exists(f) and os.path.getmtime(f) >= img_mtime for f in [d_file, k_file]) and \
+           os.path.getmtime(k_file) >= os.path.getmtime(d_file)
+
+def extract_and_save_SIFT_features(img_path, dense=False, memory_budget=None, max_keypoints=None, num_threads=None):
+    """
+    Extract the SIFT features of a single image and store them next to the image.
+    If {dense} is True, extract dense SIFT features instead of detecting keypoints.
+    If {memory_budget} (in bytes) is given, large images are processed in tiles (see iter_SIFT_features_tiled).
+    If {max_keypoints} is given, keep that many features with the largest response (see gen_strongest_descriptors).
+    If {num_threads} is given, the image is processed by that many threads (see extract_SIFT_features_threaded).
+    Both files are written to temporary files first and then renamed, the keypoints last, so an interrupted
+    run never leaves broken files, or new descriptors next to old keypoints, behind (see is_extracted).
+    """
+    if dense and max_keypoints is not None:
+        raise ValueError('Dense features have a fixed number of keypoints, max_keypoints must be None.')
+
+    img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+    if dense:
+        descriptors, keypoints = extract_dense_SIFT_features(img)
+    elif memory_budget is not None:
+        descriptors, keypoints = extract_SIFT_features_tiled(img, memory_budget=memory_budget,
+                                                             max_keypoints=max_keypoints)
+    elif num_threads is not None:
+        descriptors, keypoints = extract_SIFT_features_threaded(img, num_threads=num_threads,
+                                                                max_keypoints=max_keypoints)
+    else:
+        descriptors, keypoints = extract_SIFT_features(img, max_keypoints=max_keypoints)
+
+    # Store a single keypoint as [(x, y), diameter].
+    # keypoints[i] corresponds to descriptors[i]
+    keypoints = to_saved_keypoints(keypoints)
+
+    d_file, k_file = get_feature_fnames(img_path)
+    save_to_pickles_atomically([d_file, k_file], [descriptors, keypoints])
+
+    return img_path
+
+def extract_dataset_features(num_workers=mp.cpu_count(), overwrite=False, dense=False, memory_budget=None,
+                             max_keypoints=None, num_threads=None):
+    """
+    Extract SIFT features from all training and test images over a pool of {num_workers} processes.
+    Images whose features are newer than the image itself are skipped, unless {overwrite} is True,
+    so an interrupted run can be resumed. If {dense} is True, extract dense SIFT features.
+    {memory_budget}, {max_keypoints} and {num_threads} are passed to extract_and_save_SIFT_features.
+    """
+    start_time = time.time()
+
+    img_paths = []
+    for training_or_test in ['Training', 'Test']:
+        for class_name in CLASSES:
+            class_dir = f'{DATASET_DIR}/{training_or_test}/{class_name}'
+            for fname in sorted(os.listdir(class_dir)):
+                if fname.endswith(f'.{DEFAULT_IMAGE_FORMAT}'):
+                    img_paths.append(f'{class_dir}/{fname}')
+
+    todo_img_paths = [p for p in img_paths if overwrite or not is_extracted(p)]
+    print(f'Extracting features of {len(todo_img_paths)} images, '
+          f'{len(img_paths) - len(todo_img_paths)} are up to date.')
+
+    with mp.Pool(num_workers) as pool:
+        # Results come back as soon as any worker finishes, the order of images doesn't matter.
+        finished = pool.imap_unordered(partial(extract_and_save_SIFT_features, dense=dense,
+                                                     memory_budget=memory_budget, max_keypoints=max_keypoints,
+                                                     num_threads=num_threads),
+                                             todo_img_paths)
+        for num_done, img_path in enumerate(finished, 1):
+            elapsed = time.time() - start_time
+            imgs_per_sec = num_done / elapsed
+            eta = (len(todo_img_paths) - num_done) / imgs_per_sec
+            print(f'Finished {img_path} ({num_done}/{len(todo_img_paths)}), '
+                  f'{imgs_per_sec:.2f} images/sec, ETA {eta/60:.1f} minutes.')
+
+    print(f'Finished all in {(time.time() - start_time)/60} minutes.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract SIFT features from the training and test images.')
+    parser.add_argument('-w', '--workers', help='number of worker processes', type=int, default=mp.cpu_count())
+    parser.add_argument('--overwrite', help='also extract images whose features are up to date',
+                        action='store_true')
+    parser.add_argument('--dense', help='extract descriptors on a dense grid instead of detecting keypoints '
+                        '(use with --overwrite to replace existing features)', action='store_true')
+    parser.add_argument('--memory-budget', help='process images in tiles to use at most about this many MB '
+                        'per worker', type=int, default=None)
+    parser.add_argument('-n', '--max-keypoints', help='keep at most this many keypoints with the largest '
+                        'response per image', type=int, default=None)
+    parser.add_argument('-t', '--threads', help='extract each image with this many threads, for a lower latency '
+                        'per image (use with fewer workers)', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None and (args.dense or args.memory_budget is not None):
+        parser.error('--threads does not apply to --dense or --memory-budget')
+    if args.dense and args.max_keypoints is not None:
+        parser.error('--max-keypoints does not apply to --dense, which extracts every grid point')
+    memory_budget = args.memory_budget * 2 ** 20 if args.memory_budget is not None else None
+
+    # Store the descriptors and keypoints of every image in seperate binary files
+    # next to the image, e.g. Training/cars/0001_descriptors.npy
+    extract_dataset_features(num_workers=args.workers, overwrite=args.overwrite, dense=args.dense,
+                             memory_budget=memory_budget, max_keypoints=args.max_keypoints,
+                             num_threads=args.threads)
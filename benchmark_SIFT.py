@@ -0,0 +1,208 @@
+"""
+CW1-COMP338 - Benchmarks for Step 1. Feature extraction
+
+Thepnathi Chindalaksanaloet, 201123978
+Robert Szafarczyk, 201307211
+"""
+
+import argparse
+import time
+import math
+import os
+import cv2
+import numpy as np
+
+import helper as hp
+import SIFT
+
+################################################################################
+# Gaussian blur
+################################################################################
+def check_blur_parity(img, sigma=1.6, rtol=1e-13, max_size=128):
+    """
+    Check that separable_convolution gives the same result as the reference 2D convolution with
+    gen_gaussian_kernel, and with the normalised kernels the pyramid is built with, for every sigma of
+    the pyramid, on (at most {max_size} x {max_size} pixels of) {img}.
+    The results may differ by floating point rounding only, i.e. by at most {rtol} times the largest
+    value of the reference. Return True if they do for every sigma.
+    """
+    img = img[:max_size, :max_size].astype(np.float64)
+    sigmas = SIFT.gen_gaussian_sigmas_in_octaves(sigma)
+
+    all_same = True
+    for normalise in [False, True]:
+        for pyramid_sigma in sigmas:
+            kernel_1D = SIFT.gen_gaussian_kernel_1D(pyramid_sigma, normalise=normalise)
+            kernel_2D = np.outer(kernel_1D, kernel_1D) if normalise else SIFT.gen_gaussian_kernel(pyramid_sigma)
+
+            start_time = time.time()
+            reference = SIFT.convolution(img, kernel_2D)
+            reference_time = time.time() - start_time
+
+            start_time = time.time()
+            separable = SIFT.separable_convolution(img, kernel_1D)
+            separable_time = time.time() - start_time
+
+            max_difference = np.max(np.abs(separable - reference))
+            tolerance = rtol * np.max(np.abs(reference))
+            all_same &= max_difference <= tolerance
+            print(f'Sigma {pyramid_sigma:.3f}{" (normalised)" if normalise else ""}: max difference '
+                  f'{max_difference:.3g} (tolerance {tolerance:.3g}), 2D {reference_time*1000:.1f} ms, '
+                  f'separable {separable_time*1000:.2f} ms, same: {max_difference <= tolerance}')
+
+    return all_same
+
+
+################################################################################
+# Scale-space extrema detection
+################################################################################
+def find_extremum_candidates_by_loop(dog_images_in_octave, threshold, image_border_width):
+    """
+    The pixel-by-pixel scan with is_px_extremum, which find_extremum_candidates_in_octave replaces.
+    """
+    candidates = []
+    img_tripple = zip(dog_images_in_octave, dog_images_in_octave[1:], dog_images_in_octave[2:])
+    for image_index, (first_image, second_image, third_image) in enumerate(img_tripple):
+        for i in range(image_border_width, first_image.shape[0] - image_border_width):
+            for j in range(image_border_width, first_image.shape[1] - image_border_width):
+                if SIFT.is_px_extremum(first_image[i-1:i+2, j-1:j+2],
+                                       second_image[i-1:i+2, j-1:j+2],
+                                       third_image[i-1:i+2, j-1:j+2],
+                                       threshold):
+                    candidates.append((image_index + 1, i, j))
+
+    return candidates
+
+def benchmark_candidate_detection(img, sigma=1.6, contrast_threshold=0.04, num_intervals=3,
+                                  image_border_width=5):
+    """
+    Time the candidate keypoint detection of each octave of {img}, both vectorized and
+    pixel-by-pixel, and check that both find the same candidates.
+    """
+    threshold = np.floor(0.5 * contrast_threshold / num_intervals * 255)
+    num_octaves = int(round(math.log(min(img.shape), 2) - 1))
+    sigmas = SIFT.gen_gaussian_sigmas_in_octaves(sigma)
+    gaussian_images = SIFT.apply_gaussian_kernels(img, num_octaves, sigmas)
+    dog_images = SIFT.do_dog(gaussian_images)
+
+    for octave_index, dog_images_in_octave in enumerate(dog_images):
+        start_time = time.time()
+        layers, rows, cols = SIFT.find_extremum_candidates_in_octave(dog_images_in_octave, threshold,
+                                                                     image_border_width)
+        vectorized_time = time.time() - start_time
+
+        start_time = time.time()
+        loop_candidates = find_extremum_candidates_by_loop(dog_images_in_octave, threshold,
+                                                           image_border_width)
+        loop_time = time.time() - start_time
+
+        same = loop_candidates == list(zip(layers.tolist(), rows.tolist(), cols.tolist()))
+        print(f'Octave {octave_index} {dog_images_in_octave[0].shape}: {len(layers)} candidates, '
+              f'vectorized {vectorized_time*1000:.2f} ms, loop {loop_time*1000:.2f} ms, '
+              f'same candidates: {same}')
+
+################################################################################
+# Single-image latency
+################################################################################
+def time_per_image(extract_func, imgs, repeats):
+    """
+    Return the time (in seconds) of every call of {extract_func}, {repeats} times on each of {imgs}.
+    """
+    times = []
+    for _ in range(repeats):
+        for img in imgs:
+            start_time = time.perf_counter()
+            extract_func(img)
+            times.append(time.perf_counter() - start_time)
+
+    return np.array(times)
+
+def benchmark_latency(imgs, num_threads=os.cpu_count(), repeats=5):
+    """
+    Compare the p50/p99 time per image of extract_SIFT_features and extract_SIFT_features_threaded,
+    and check that both give the same features.
+    """
+    extract_funcs = {
+        'sequential': SIFT.extract_SIFT_features,
+        f'{num_threads} threads': lambda img: SIFT.extract_SIFT_features_threaded(img, num_threads=num_threads),
+    }
+
+    for name, extract_func in extract_funcs.items():
+        # Warm up, e.g. the thread pool and the first calls into BLAS.
+        extract_func(imgs[0])
+        times = time_per_image(extract_func, imgs, repeats)
+        print(f'{name}: p50 {np.percentile(times, 50)*1000:.1f} ms, p99 {np.percentile(times, 99)*1000:.1f} ms, '
+              f'over {len(times)} runs')
+
+    same = all(np.array_equal(a, b) for img in imgs
+               for a, b in zip(SIFT.extract_SIFT_features(img),
+                               SIFT.extract_SIFT_features_threaded(img, num_threads=num_threads)))
+    print(f'Same features: {same}')
+
+################################################################################
+# Keypoint budget
+################################################################################
+def check_max_keypoints(img, max_keypoints_list=(1, 10, 50, 100, 1000), num_threads=2, memory_budget=8 * 2 ** 20):
+    """
+    Check that extract_SIFT_features, extract_SIFT_features_threaded with {num_threads} threads and
+    extract_SIFT_features_tiled with {memory_budget} bytes return min(max_keypoints, available) features
+    of {img} for each of {max_keypoints_list}, where available is the number of features without a limit,
+    and that these are the features with the largest response. Return True if they do for every limit.
+    """
+    extract_funcs = {
+        'sequential': SIFT.extract_SIFT_features,
+        f'{num_threads} threads': lambda img, max_keypoints=None:
+            SIFT.extract_SIFT_features_threaded(img, num_threads=num_threads, max_keypoints=max_keypoints),
+        f'tiled {memory_budget / 2 ** 20:g} MB': lambda img, max_keypoints=None:
+            SIFT.extract_SIFT_features_tiled(img, memory_budget=memory_budget, max_keypoints=max_keypoints),
+    }
+
+    all_correct = True
+    for name, extract_func in extract_funcs.items():
+        all_descriptors, all_keypoints = extract_func(img)
+        for max_keypoints in max_keypoints_list:
+            start_time = time.time()
+            descriptors, keypoints = extract_func(img, max_keypoints=max_keypoints)
+            extract_time = time.time() - start_time
+
+            strongest = SIFT.get_strongest_keypoint_idxs(all_keypoints, max_keypoints)
+            correct = len(descriptors) == min(max_keypoints, len(all_descriptors)) and \
+                      np.array_equal(keypoints, all_keypoints[strongest]) and \
+                      np.array_equal(descriptors, all_descriptors[strongest])
+            all_correct &= correct
+            print(f'{name}: {len(descriptors)} of {len(all_descriptors)} features with max_keypoints={max_keypoints} '
+                  f'in {extract_time*1000:.1f} ms, correct: {correct}')
+
+    return all_correct
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the steps of SIFT feature extraction.')
+    parser.add_argument('imgs', help='paths to the images to benchmark on', nargs='+')
+    parser.add_argument('--latency', help='benchmark the time per image of multithreaded extraction',
+                        action='store_true')
+    parser.add_argument('--parity', help='check that the separable blur gives the same result as the 2D '
+                        'convolution', action='store_true')
+    parser.add_argument('--max-keypoints', help='check that extraction with each of these keypoint budgets returns '
+                        'the strongest features', type=int, nargs='+')
+    parser.add_argument('-t', '--threads', help='number of threads', type=int, default=os.cpu_count())
+    parser.add_argument('-r', '--repeats', help='number of times to extract each image', type=int, default=5)
+    args = parser.parse_args()
+
+    imgs = [cv2.imread(img_path, cv2.IMREAD_GRAYSCALE) for img_path in args.imgs]
+
+    if args.parity:
+        print("Checking the separable blur against the 2D convolution... \n" + hp.LONG_LOCOMOTIVE)
+        for img in imgs:
+            check_blur_parity(img)
+    elif args.max_keypoints:
+        print("Checking the keypoint budget... \n" + hp.LONG_LOCOMOTIVE)
+        for img in imgs:
+            check_max_keypoints(img, args.max_keypoints, args.threads)
+    elif args.latency:
+        print("Benchmarking time per image... \n" + hp.LONG_LOCOMOTIVE)
+        benchmark_latency(imgs, args.threads, args.repeats)
+    else:
+        print("Benchmarking scale-space extrema detection per octave... \n" + hp.LONG_LOCOMOTIVE)
+        for img in imgs:
+            benchmark_candidate_detection(img)
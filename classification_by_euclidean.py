@@ -84,6 +84,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Classify the class of images using euclidean distance between histograms.')
     parser.add_argument('-e', help='use codebook generated using euclidean distance', action='store_true')
     parser.add_argument('-s', help='use small codebook', action='store_true')
+    parser.add_argument('-t', help='use vocabulary tree instead of codebook', action='store_true')
+    parser.add_argument('--weighting', help='use the histograms generated with gen_histograms.py --weighting',
+                        choices=hp.HISTOGRAM_WEIGHTING_SUFFIXES.keys(), default='l1')
     parser.add_argument('--training', help='classify training images', action='store_true')
     args = parser.parse_args()
 
@@ -95,14 +98,19 @@ if __name__ == "__main__":
     else:
         label_func = label_all_test_images
 
-    if args.e and args.s:
-        result = label_func(hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT, k=23)
+    if args.e and args.t:
+        hist_ext, k = hp.HISTOGRAM_EUCLIDEAN_TREE_FILE_EXT, 1
+    elif args.t:
+        hist_ext, k = hp.HISTOGRAM_TREE_FILE_EXT, 1
+    elif args.e and args.s:
+        hist_ext, k = hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT, 23
     elif args.e:
-        result = label_func(hp.HISTOGRAM_EUCLIDEAN_FILE_EXT, k=1)
+        hist_ext, k = hp.HISTOGRAM_EUCLIDEAN_FILE_EXT, 1
     elif args.s:
-        result = label_func(hp.HISTOGRAM_SMALL_FILE_EXT, k=24)
+        hist_ext, k = hp.HISTOGRAM_SMALL_FILE_EXT, 24
     else:
-        result = label_func(hp.HISTOGRAM_FILE_EXT, k=3)
+        hist_ext, k = hp.HISTOGRAM_FILE_EXT, 3
+    result = label_func(hp.get_weighted_histogram_ext(hist_ext, args.weighting), k=k)
 
 
     for key in result:
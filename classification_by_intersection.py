@@ -76,18 +76,26 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Classify the class of images using histogram intersetion.')
     parser.add_argument('-e', help='use codebook generated using euclidean distance', action='store_true')
     parser.add_argument('-s', help='use small codebook', action='store_true')
+    parser.add_argument('-t', help='use vocabulary tree instead of codebook', action='store_true')
+    parser.add_argument('--weighting', help='use the histograms generated with gen_histograms.py --weighting',
+                        choices=hp.HISTOGRAM_WEIGHTING_SUFFIXES.keys(), default='l1')
     args = parser.parse_args()
 
     print("Classification using histogram intersetion... \n" + hp.LONG_LOCOMOTIVE)
 
-    if args.e and args.s:
-        result = label_all_test_images(hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT)
+    if args.e and args.t:
+        hist_ext = hp.HISTOGRAM_EUCLIDEAN_TREE_FILE_EXT
+    elif args.t:
+        hist_ext = hp.HISTOGRAM_TREE_FILE_EXT
+    elif args.e and args.s:
+        hist_ext = hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT
     elif args.e:
-        result = label_all_test_images(hp.HISTOGRAM_EUCLIDEAN_FILE_EXT)
+        hist_ext = hp.HISTOGRAM_EUCLIDEAN_FILE_EXT
     elif args.s:
-        result = label_all_test_images(hp.HISTOGRAM_SMALL_FILE_EXT)
+        hist_ext = hp.HISTOGRAM_SMALL_FILE_EXT
     else:
-        result = label_all_test_images(hp.HISTOGRAM_FILE_EXT)
+        hist_ext = hp.HISTOGRAM_FILE_EXT
+    result = label_all_test_images(hp.get_weighted_histogram_ext(hist_ext, args.weighting))
 
 
     for key in result:
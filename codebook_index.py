@@ -0,0 +1,247 @@
+"""
+CW1-COMP338 - KD-tree index of a codebook, to find the closest codeword of a descriptor without
+computing its distance to every word.
+
+Thepnathi Chindalaksanaloet, 201123978
+Robert Szafarczyk, 201307211
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+
+import helper as hp
+
+# Smaller codebooks are always searched by computing all distances with matrix products, even if they
+# have an index. In 128 dimensions an exact search of the index is slower than that for any size we
+# tried (up to 10,000 words), only searching a few leaves is faster.
+MIN_INDEXED_WORDS = 4096
+
+################################################################################
+# KD-tree
+################################################################################
+# The words are split in two at the median of the dimension where they are most spread out, and the
+# halves are split again, down to 2 ** depth leaves of at most about leaf_size words. The nodes are
+# stored level by level, starting with the root, so that the children of node n are 2n+1 and 2n+2.
+# The cell of a node is the box which contains its words. The cell of a child is the cell of its parent
+# cut in the split dimension, so the squared distance of a descriptor to the cell of a child is the
+# distance to the cell of its parent, updated in that dimension only.
+# An index is a dictionary of:
+#   'words': the codebook, used to break ties
+#   'cell_mins', 'cell_maxs': the box of all words, i.e. the cell of the root
+#   'split_dims': dimension in which each node is split from its parent (the root's is unused)
+#   'parent_mins', 'parent_maxs', 'mins', 'maxs': interval of the cell of the parent and of the node in its split_dim
+#   'leaf_words': (num_leaves, max leaf size, num_dims) words of each leaf, padded with zeros
+#   'leaf_word_idxs': (num_leaves, max leaf size) index in the codebook of each word of a leaf, -1 for padding
+#   'max_leaf_checks': number of leaves to search, None to search until the result is exact
+
+def get_index_fname(codebook_fname):
+    return f'{os.path.splitext(codebook_fname)[0]}_index.npy'
+
+def build_index(codebook, leaf_size=32, max_leaf_checks=None):
+    """
+    Build a KD-tree index of {codebook}, with leaves of at most about {leaf_size} words.
+    {max_leaf_checks} is the default number of leaves to search (see get_idxs_of_1_NN_with_index).
+    """
+    words = np.asarray(codebook, dtype=np.float64)
+    depth = int(np.ceil(np.log2(max(len(words) / leaf_size, 1))))
+    num_nodes = 2 ** (depth + 1) - 1
+
+    split_dims = np.zeros(num_nodes, dtype=int)
+    parent_mins, parent_maxs = np.zeros(num_nodes), np.zeros(num_nodes)
+    mins, maxs = np.zeros(num_nodes), np.zeros(num_nodes)
+    # The word indexes and cell of each node of the current level.
+    nodes_word_idxs = [np.arange(len(words))]
+    nodes_cells = [(words.min(axis=0), words.max(axis=0))]
+
+    for level in range(depth):
+        children_word_idxs, children_cells = [], []
+        for i, (word_idxs, (cell_mins, cell_maxs)) in enumerate(zip(nodes_word_idxs, nodes_cells)):
+            node = 2 ** level - 1 + i
+            node_words = words[word_idxs]
+            split_dim = np.argmax(node_words.max(axis=0) - node_words.min(axis=0)) if len(word_idxs) else 0
+            order = np.argsort(node_words[:, split_dim], kind='stable')
+            median = len(word_idxs) // 2
+            split_value = node_words[order[median], split_dim] if len(word_idxs) else cell_mins[split_dim]
+
+            for child, child_word_idxs in [(2 * node + 1, word_idxs[order[:median]]),
+                                           (2 * node + 2, word_idxs[order[median:]])]:
+                child_mins, child_maxs = cell_mins.copy(), cell_maxs.copy()
+                if child == 2 * node + 1:
+                    child_maxs[split_dim] = split_value
+                else:
+                    child_mins[split_dim] = split_value
+
+                split_dims[child] = split_dim
+                parent_mins[child], parent_maxs[child] = cell_mins[split_dim], cell_maxs[split_dim]
+                mins[child], maxs[child] = child_mins[split_dim], child_maxs[split_dim]
+                children_word_idxs.append(child_word_idxs)
+                children_cells.append((child_mins, child_maxs))
+
+        nodes_word_idxs, nodes_cells = children_word_idxs, children_cells
+
+    max_leaf_size = max(len(word_idxs) for word_idxs in nodes_word_idxs)
+    leaf_words = np.zeros((len(nodes_word_idxs), max_leaf_size, words.shape[1]))
+    leaf_word_idxs = np.full((len(nodes_word_idxs), max_leaf_size), -1)
+    for i, word_idxs in enumerate(nodes_word_idxs):
+        leaf_words[i, :len(word_idxs)] = words[word_idxs]
+        leaf_word_idxs[i, :len(word_idxs)] = word_idxs
+
+    return {'words': words, 'cell_mins': words.min(axis=0), 'cell_maxs': words.max(axis=0),
+            'split_dims': split_dims, 'parent_mins': parent_mins, 'parent_maxs': parent_maxs,
+            'mins': mins, 'maxs': maxs, 'leaf_words': leaf_words, 'leaf_word_idxs': leaf_word_idxs,
+            'max_leaf_checks': max_leaf_checks}
+
+def get_leaf_distances(descriptors, index):
+    """
+    Return the squared distance of each row of the matrix {descriptors} to the cell of each leaf of
+    the {index}, which no word of the leaf can be closer than.
+    """
+    gaps = np.maximum(index['cell_mins'] - descriptors, 0) + np.maximum(descriptors - index['cell_maxs'], 0)
+    distances = np.einsum('ij,ij->i', gaps, gaps)[:, None]
+
+    # Update the distances level by level, in the split dimension of each node only.
+    num_levels = int(np.log2(len(index['split_dims']) + 1))
+    for level in range(1, num_levels):
+        nodes = np.arange(2 ** level - 1, 2 ** (level + 1) - 1)
+        values = descriptors[:, index['split_dims'][nodes]]
+        parent_gaps = np.maximum(index['parent_mins'][nodes] - values, 0) + \
+                      np.maximum(values - index['parent_maxs'][nodes], 0)
+        gaps = np.maximum(index['mins'][nodes] - values, 0) + np.maximum(values - index['maxs'][nodes], 0)
+        distances = np.repeat(distances, 2, axis=1) - parent_gaps ** 2 + gaps ** 2
+
+    return distances
+
+def get_idxs_of_1_NN_with_index(descriptors, index, max_leaf_checks=-1, max_chunk_elements=2 ** 22):
+    """
+    Return the index of the closest word of the indexed codebook (by euclidean distance) of each row of
+    the matrix {descriptors}, searching the leaves best-bin-first, i.e. in the order of the distance of a
+    descriptor to their cells.
+    If {max_leaf_checks} is None, stop when no other leaf can have a closer word, and the result is the
+    same as hp.get_idxs_of_1_NN. Otherwise, search at most {max_leaf_checks} leaves per descriptor, which is
+    faster but approximate. By default, use the 'max_leaf_checks' of the {index}.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float64)
+    leaf_words, leaf_word_idxs = index['leaf_words'], index['leaf_word_idxs']
+    num_leaves, leaf_size, num_dims = leaf_words.shape
+    if max_leaf_checks == -1:
+        max_leaf_checks = index['max_leaf_checks']
+    num_checks = num_leaves if max_leaf_checks is None else min(max_leaf_checks, num_leaves)
+    max_word_norm = np.einsum('ij,ij->i', index['words'], index['words']).max()
+
+    closest_idxs = np.empty(len(descriptors), dtype=int)
+    chunk_size = max(max_chunk_elements // max(num_leaves, leaf_size * num_dims), 1)
+    for chunk_start in range(0, len(descriptors), chunk_size):
+        chunk = descriptors[chunk_start:chunk_start + chunk_size]
+        rows = np.arange(len(chunk))
+
+        leaf_distances = get_leaf_distances(chunk, index)
+        leaf_order = np.argsort(leaf_distances, axis=1, kind='stable')
+        # Same bound of the rounding error of the squared distances as in hp.get_idxs_of_1_NN.
+        error_bounds = 1e-12 * (np.einsum('ij,ij->i', chunk, chunk) + max_word_norm)
+
+        # The two smallest squared distances found so far.
+        best, second_best = np.full(len(chunk), np.inf), np.full(len(chunk), np.inf)
+        best_idxs = np.zeros(len(chunk), dtype=int)
+        for check in range(num_checks):
+            leaves = leaf_order[:, check]
+            to_check = np.nonzero(leaf_distances[rows, leaves] <= best + error_bounds)[0]
+            if len(to_check) == 0:
+                break
+            leaves = leaves[to_check]
+
+            differences = leaf_words[leaves] - chunk[to_check, None, :]
+            distances = np.einsum('ijk,ijk->ij', differences, differences)
+            distances[leaf_word_idxs[leaves] < 0] = np.inf
+            if leaf_size > 1:
+                two_closest = np.partition(distances, 1, axis=1)[:, :2]
+            else:
+                two_closest = np.concatenate([distances, np.full((len(distances), 1), np.inf)], axis=1)
+            leaf_best_idxs = leaf_word_idxs[leaves, np.argmin(distances, axis=1)]
+
+            second_best[to_check] = np.minimum(np.maximum(best[to_check], two_closest[:, 0]),
+                                               np.minimum(second_best[to_check], two_closest[:, 1]))
+            is_closer = two_closest[:, 0] < best[to_check]
+            best_idxs[to_check[is_closer]] = leaf_best_idxs[is_closer]
+            best[to_check] = np.minimum(best[to_check], two_closest[:, 0])
+
+        closest_idxs[chunk_start:chunk_start + len(chunk)] = best_idxs
+        # Where the two closest words are too close to tell apart, fall back to the scalar distance.
+        for i in np.nonzero(second_best - best <= error_bounds)[0]:
+            closest_idxs[chunk_start + i] = hp.get_idx_of_1_NN(chunk[i], index['words'],
+                                                               dist_func=hp.euclidean_distance)
+
+    return closest_idxs
+
+def load_codebook(codebook_fname, min_indexed_words=MIN_INDEXED_WORDS):
+    """
+    Load the codebook {codebook_fname}. If it has at least {min_indexed_words} words and an index
+    (see get_index_fname) of the same words, return the index instead. An index of other words, e.g.
+    of the codebook before it was trained again, is ignored with a warning.
+    """
+    codebook = hp.load_pickled_list(codebook_fname)
+    if isinstance(codebook, list) and len(codebook) >= min_indexed_words and \
+       os.path.exists(get_index_fname(codebook_fname)):
+        index = hp.load_pickled_list(get_index_fname(codebook_fname))
+        if not np.array_equal(index['words'], np.asarray(codebook, dtype=np.float64)):
+            print(f'Warning: {get_index_fname(codebook_fname)} was built from other words than {codebook_fname}, '
+                  f'ignoring it. Run codebook_index.py again to rebuild it.')
+            return codebook
+
+        print(f'Using the index of {codebook_fname}.')
+        return index
+
+    return codebook
+
+
+################################################################################
+# Evaluation
+################################################################################
+def evaluate_index(descriptors, codebook, index, leaf_checks_list):
+    """
+    Print the recall (fraction of {descriptors} assigned to the same word as by brute force) and
+    the speedup over brute force of an exact search of {index}, and of searching each number of
+    leaves in {leaf_checks_list}.
+    """
+    start_time = time.time()
+    brute_force_idxs = hp.get_idxs_of_1_NN(descriptors, codebook, dist_func=hp.euclidean_distance)
+    brute_force_time = time.time() - start_time
+    print(f'Brute force: {brute_force_time:.3f} s')
+
+    for max_leaf_checks in [None] + leaf_checks_list:
+        start_time = time.time()
+        closest_idxs = get_idxs_of_1_NN_with_index(descriptors, index, max_leaf_checks=max_leaf_checks)
+        index_time = time.time() - start_time
+
+        recall = np.mean(closest_idxs == brute_force_idxs)
+        checks = 'all needed' if max_leaf_checks is None else max_leaf_checks
+        print(f'Leaf checks: {checks}, recall {recall:.4f}, {index_time:.3f} s, '
+              f'speedup {brute_force_time / index_time:.2f}x')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a KD-tree index of each codebook, and compare its recall '
+                                     'and speed with brute force on the test descriptors.')
+    parser.add_argument('--leaf-size', help='maximum number of words per leaf', type=int, default=32)
+    parser.add_argument('-c', '--checks', help='number of leaves the histograms search, instead of as many as '
+                        'needed for the exact result', type=int)
+    parser.add_argument('--evaluate', help='also evaluate this many leaf checks', type=int, nargs='*',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('codebooks', help='codebook files', nargs='*',
+                        default=[hp.CODEBOOK_FILE, hp.CODEBOOK_SMALL_FILE,
+                                 hp.CODEBOOK_EUCLIDEAN_FILE, hp.CODEBOOK_EUCLIDEAN_SMALL_FILE])
+    args = parser.parse_args()
+
+    test_descriptors = np.concatenate([np.load(fname, allow_pickle=True).reshape(-1, 128)
+                                       for fname in hp.get_descriptors_fnames('Test')])
+
+    for codebook_fname in args.codebooks:
+        codebook = np.asarray(hp.load_pickled_list(codebook_fname), dtype=np.float64)
+        start_time = time.time()
+        index = build_index(codebook, leaf_size=args.leaf_size, max_leaf_checks=args.checks)
+        hp.save_to_pickle(get_index_fname(codebook_fname), index)
+        print(f'{hp.LONG_LOCOMOTIVE}\nIndexed the {len(codebook)} words of {codebook_fname} into '
+              f'{len(index["leaf_words"])} leaves in {time.time() - start_time:.3f} s.')
+
+        evaluate_index(test_descriptors, codebook, index, args.evaluate)
@@ -5,96 +5,802 @@ Thepnathi Chindalaksanaloet, 201123978
 Robert Szafarczyk, 201307211
 """
 
+import argparse
+import json
 import random, time
 import cv2
 import numpy as np
 import multiprocessing as mp
+import os
 
 import helper as hp
 
+################################################################################
+# Assignment worker pool
+################################################################################
+# Shared arrays of a worker process, attached once by init_assignment_worker.
+worker_arrays = {}
+
+def init_assignment_worker(descriptors_spec, cluster_idxs_spec):
+    """
+    Attach a worker process to the shared descriptors and cluster indexes arrays,
+    given the (name, shape, dtype) returned by hp.to_shared_array.
+    """
+    worker_arrays['descriptors_shm'], worker_arrays['descriptors'] = hp.attach_shared_array(*descriptors_spec)
+    worker_arrays['cluster_idxs_shm'], worker_arrays['cluster_idxs'] = hp.attach_shared_array(*cluster_idxs_spec)
+
+def assign_block(block):
+    """
+    Given a tuple of (start, stop, codebook, dist_func), find the nearest cluster of the shared
+    descriptors[start:stop] and write their indexes to the shared cluster indexes.
+    """
+    start, stop, codebook, dist_func = block
+    worker_arrays['cluster_idxs'][start:stop] = \
+        hp.get_idxs_of_1_NN(worker_arrays['descriptors'][start:stop], codebook, dist_func=dist_func)
+
+def start_assignment_pool(feature_descriptors, num_workers):
+    """
+    Start a pool of {num_workers} processes which assign the {feature_descriptors} to clusters for
+    assign_with_pool. The workers attach to a shared copy of the descriptors once and write the cluster
+    indexes of their block to shared memory, so only the codebook is sent to the workers in each iteration.
+    """
+    descriptors_shm, descriptors, descriptors_spec = hp.to_shared_array(feature_descriptors)
+    cluster_idxs_shm, cluster_idxs, cluster_idxs_spec = \
+        hp.to_shared_array(np.zeros(len(feature_descriptors), dtype=int))
+    pool = mp.Pool(num_workers, initializer=init_assignment_worker, initargs=(descriptors_spec, cluster_idxs_spec))
+
+    # One contiguous block of descriptors per worker.
+    return {'pool': pool, 'descriptors_shm': descriptors_shm, 'descriptors': descriptors,
+            'cluster_idxs_shm': cluster_idxs_shm, 'cluster_idxs': cluster_idxs,
+            'block_bounds': np.linspace(0, len(feature_descriptors), num_workers + 1).astype(int)}
+
+def assign_with_pool(assignment_pool, codebook, dist_func):
+    """
+    Return the index of the nearest cluster of {codebook} of every descriptor, found by the workers of
+    the {assignment_pool} returned by start_assignment_pool.
+    """
+    block_bounds = assignment_pool['block_bounds']
+    assignment_pool['pool'].map(assign_block, [(start, stop, codebook, dist_func)
+                                               for start, stop in zip(block_bounds[:-1], block_bounds[1:])])
+
+    # Copy, so that the pool can be used for another codebook while this result is still needed.
+    return assignment_pool['cluster_idxs'].copy()
+
+def stop_assignment_pool(assignment_pool):
+    """
+    Stop the workers of {assignment_pool} and free its shared memory.
+    """
+    assignment_pool['pool'].close()
+    assignment_pool['pool'].join()
+    # The arrays must be released before their shared memory is closed.
+    del assignment_pool['descriptors'], assignment_pool['cluster_idxs']
+    for shm in [assignment_pool['descriptors_shm'], assignment_pool['cluster_idxs_shm']]:
+        shm.close()
+        shm.unlink()
+
+
+################################################################################
+# Accelerated assignment
+################################################################################
+# Elkan's algorithm keeps an upper bound of the distance of each descriptor to its cluster centre,
+# and a lower bound of its distance to every centre. Both metrics obey the triangle inequality, so
+# when a centre moves by some distance, the bounds can't change by more than that distance.
+# The vectorized distances are rounded, so the bounds are widened by a slack larger than the error.
+
+def get_distance_slack(descriptors, codebook, dist_func, descriptor_norms=None):
+    """
+    Return a bound of the rounding error of the vectorized distances between {descriptors} and {codebook}.
+    {descriptor_norms} are the hp.get_vector_norms of the descriptors, computed if not given.
+    """
+    if descriptor_norms is None:
+        descriptor_norms = hp.get_vector_norms(descriptors, dist_func)
+    max_norm = descriptor_norms.max() + hp.get_vector_norms(codebook, dist_func).max()
+
+    return 1e-6 * max_norm
+
+def get_closest_from_distances(descriptors, codebook, distances, dist_func, slack):
+    """
+    Given the {distances} from {descriptors} to each centre of {codebook}, with an error less than
+    {slack} (or np.inf for centres that can't be the closest), return the index of the closest centre
+    of each descriptor. Same as hp.get_idxs_of_1_NN, which decides when two centres are too close to tell.
+    """
+    closest_cluster_idxs = np.argmin(distances, axis=1)
+
+    if distances.shape[1] > 1:
+        two_closest = np.partition(distances, 1, axis=1)
+        is_tie = two_closest[:, 1] - two_closest[:, 0] <= 2 * slack
+        closest_cluster_idxs[is_tie] = hp.get_idxs_of_1_NN(descriptors[is_tie], codebook, dist_func=dist_func)
+
+    return closest_cluster_idxs
+
+def init_distance_bounds(descriptors, codebook, dist_func, slack, max_chunk_elements=2 ** 22):
+    """
+    Compute all distances between {descriptors} and {codebook} once.
+    Return the index of the closest centre, and the upper and lower bounds of the distances.
+    """
+    lower_bounds = np.empty((len(descriptors), len(codebook)))
+    chunk_size = max(1, max_chunk_elements // codebook.size)
+    for chunk_start in range(0, len(descriptors), chunk_size):
+        lower_bounds[chunk_start:chunk_start + chunk_size] = \
+            hp.get_distance_matrix(descriptors[chunk_start:chunk_start + chunk_size], codebook, dist_func=dist_func)
+
+    closest_cluster_idxs = get_closest_from_distances(descriptors, codebook, lower_bounds, dist_func, slack)
+    upper_bounds = lower_bounds[np.arange(len(descriptors)), closest_cluster_idxs] + slack
+    lower_bounds -= slack
+
+    return closest_cluster_idxs, upper_bounds, lower_bounds
+
+def update_assignments_with_bounds(descriptors, codebook, closest_cluster_idxs, upper_bounds, lower_bounds,
+                                   dist_func, slack, max_chunk_elements=2 ** 22):
+    """
+    Reassign the {descriptors} to their closest centre of {codebook}, computing only the distances
+    that could change the assignment. {closest_cluster_idxs}, {upper_bounds} and {lower_bounds}
+    are updated in place. Return the number of computed distances.
+    """
+    # A centre can't be closer to a descriptor than its own centre, if it is at least twice
+    # as far from the descriptor's centre as the descriptor.
+    half_centre_distances = hp.get_distance_matrix(codebook, codebook, dist_func=dist_func) / 2 - slack
+    np.fill_diagonal(half_centre_distances, np.inf)
+    to_check = np.nonzero(upper_bounds >= half_centre_distances.min(axis=1)[closest_cluster_idxs])[0]
+
+    # Tighten the upper bounds, which is usually enough to rule out most centres.
+    own_centres = closest_cluster_idxs[to_check]
+    own_distances = hp.get_paired_distances(descriptors[to_check], codebook[own_centres], dist_func=dist_func)
+    upper_bounds[to_check] = own_distances + slack
+    lower_bounds[to_check, own_centres] = own_distances - slack
+
+    # Only the (descriptor, centre) pairs that pass both tests could be closer than the own centre.
+    # Pairs that are ruled out are strictly further, so the closest centre stays the same as
+    # the one computing all distances would find.
+    is_candidate = (lower_bounds[to_check] <= upper_bounds[to_check, None]) & \
+                   (half_centre_distances[own_centres] <= upper_bounds[to_check, None])
+    candidate_rows, candidate_centres = np.nonzero(is_candidate)
+
+    candidate_distances = np.empty(len(candidate_rows))
+    chunk_size = max(1, max_chunk_elements // descriptors.shape[1])
+    for chunk_start in range(0, len(candidate_rows), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        candidate_distances[chunk] = hp.get_paired_distances(descriptors[to_check[candidate_rows[chunk]]],
+                                                             codebook[candidate_centres[chunk]],
+                                                             dist_func=dist_func)
+    lower_bounds[to_check[candidate_rows], candidate_centres] = candidate_distances - slack
+
+    # Pick the closest of the own centre and the candidates of each descriptor that has any.
+    rows, candidate_rows = np.unique(candidate_rows, return_inverse=True)
+    distances = np.full((len(rows), len(codebook)), np.inf)
+    distances[candidate_rows, candidate_centres] = candidate_distances
+    distances[np.arange(len(rows)), own_centres[rows]] = own_distances[rows]
+
+    descriptor_idxs = to_check[rows]
+    closest_cluster_idxs[descriptor_idxs] = get_closest_from_distances(descriptors[descriptor_idxs], codebook,
+                                                                       distances, dist_func, slack)
+    upper_bounds[descriptor_idxs] = distances[np.arange(len(rows)), closest_cluster_idxs[descriptor_idxs]] + slack
+
+    return len(to_check) + len(candidate_rows)
+
+
+################################################################################
+# Seeding
+################################################################################
+def seed_random(feature_descriptors, num_words, dist_func):
+    """
+    Randomly choose {num_words} feature descriptors (with replacement) as cluster centres.
+    """
+    return feature_descriptors[np.random.choice(len(feature_descriptors), num_words)]
+
+def seed_k_means_pp(feature_descriptors, num_words, dist_func, weights=None):
+    """
+    k-means++ seeding. Choose each next cluster centre among {feature_descriptors} with a probability
+    proportional to its (weighted) squared distance to the closest centre chosen so far.
+    """
+    weights = np.ones(len(feature_descriptors)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    centre_idxs = [np.random.choice(len(feature_descriptors), p=weights / weights.sum())]
+    closest_distances = hp.get_distance_matrix(feature_descriptors, feature_descriptors[centre_idxs], dist_func)[:, 0]
+    for _ in range(1, num_words):
+        probabilities = weights * closest_distances ** 2
+        if probabilities.sum() == 0:
+            # All descriptors are already centres, fall back to the weights.
+            probabilities = weights
+        centre_idxs.append(np.random.choice(len(feature_descriptors), p=probabilities / probabilities.sum()))
+
+        new_distances = hp.get_distance_matrix(feature_descriptors, feature_descriptors[centre_idxs[-1:]], dist_func)
+        closest_distances = np.minimum(closest_distances, new_distances[:, 0])
+
+    return feature_descriptors[centre_idxs]
+
+def get_closest_distances(feature_descriptors, centres, dist_func, assignment_pool=None):
+    """
+    Return the distance of each of {feature_descriptors} to its closest centre of {centres}.
+    If {assignment_pool} (see start_assignment_pool) is given, its workers find the closest centres.
+    """
+    if assignment_pool is not None:
+        closest_idxs = assign_with_pool(assignment_pool, centres, dist_func)
+        return hp.get_paired_distances(feature_descriptors, centres[closest_idxs], dist_func=dist_func)
+
+    closest_distances = np.full(len(feature_descriptors), np.inf)
+    for chunk_start in range(0, len(centres), 500):
+        distances = hp.get_distance_matrix(feature_descriptors, centres[chunk_start:chunk_start + 500], dist_func)
+        closest_distances = np.minimum(closest_distances, distances.min(axis=1))
+
+    return closest_distances
+
+def seed_k_means_parallel(feature_descriptors, num_words, dist_func, oversampling=2.0, num_rounds=5,
+                          assignment_pool=None):
+    """
+    k-means|| seeding. In each of {num_rounds} rounds, sample about {oversampling} * {num_words}
+    candidate centres at once, each descriptor with a probability proportional to its squared distance
+    to the closest candidate so far. Then reduce the candidates to {num_words} centres with k-means++,
+    weighting each candidate by the number of descriptors closest to it.
+    If {assignment_pool} (see start_assignment_pool) is given, its workers find the closest candidates
+    of the descriptors in each round, otherwise the rounds run in this process. The final k-means++
+    on the candidates always runs in this process.
+    """
+    # Same as seed_k_means_pp, sample by the squared distances. The distance functions return plain
+    # distances (e.g. hp.euclidean_distance is not squared), so they are squared here.
+    candidates = feature_descriptors[np.random.choice(len(feature_descriptors), 1)]
+    closest_squared_distances = hp.get_distance_matrix(feature_descriptors, candidates, dist_func)[:, 0] ** 2
+
+    for _ in range(num_rounds):
+        cost = np.sum(closest_squared_distances)
+        if cost == 0:
+            break
+        probabilities = np.minimum(oversampling * num_words * closest_squared_distances / cost, 1)
+        new_candidates = feature_descriptors[np.random.random(len(feature_descriptors)) < probabilities]
+
+        candidates = np.concatenate([candidates, new_candidates])
+        if len(new_candidates) > 0:
+            closest_squared_distances = np.minimum(closest_squared_distances, get_closest_distances(
+                feature_descriptors, new_candidates, dist_func, assignment_pool) ** 2)
+
+    if len(candidates) <= num_words:
+        # Too few distinct descriptors, top up with random ones.
+        return np.concatenate([candidates, seed_random(feature_descriptors, num_words - len(candidates), dist_func)])
+
+    if assignment_pool is not None:
+        closest_idxs = assign_with_pool(assignment_pool, candidates, dist_func)
+    else:
+        closest_idxs = hp.get_idxs_of_1_NN(feature_descriptors, candidates, dist_func=dist_func)
+    weights = np.bincount(closest_idxs, minlength=len(candidates))
+    return seed_k_means_pp(candidates, num_words, dist_func, weights=weights)
+
+SEEDING_FUNCS = {
+    'random': seed_random,
+    'k-means++': seed_k_means_pp,
+    'k-means||': seed_k_means_parallel,
+}
+
+
+################################################################################
+# Checkpoints
+################################################################################
+def get_checkpoint_fname(fname):
+    return f'{os.path.splitext(fname)[0]}_checkpoint.npy'
+
+def save_checkpoint(fname, checkpoint):
+    """
+    Save the {checkpoint} dictionary of the codebook {fname} atomically, so that a crash while saving
+    leaves the previous checkpoint intact.
+    """
+    hp.save_to_pickle_atomically(get_checkpoint_fname(fname), checkpoint)
+
+def load_checkpoint(fname, dist_func, num_words, fingerprint):
+    """
+    Load the checkpoint of the codebook {fname}, and check that it was trained with the same
+    {dist_func} and {num_words} on descriptors with the same {fingerprint}.
+    """
+    checkpoint = np.load(get_checkpoint_fname(fname), allow_pickle=True).item()
+
+    if checkpoint['dist_func'] != dist_func.__name__ or len(checkpoint['codebook']) != num_words:
+        raise ValueError(f'{get_checkpoint_fname(fname)} is for {len(checkpoint["codebook"])} words with '
+                         f'{checkpoint["dist_func"]}, not {num_words} words with {dist_func.__name__}.')
+    if checkpoint['fingerprint'] != fingerprint:
+        raise ValueError(f'{get_checkpoint_fname(fname)} was trained on different descriptors, '
+                         f'warm-start from its codebook instead.')
+
+    return checkpoint
+
+
 ################################################################################
 # Step 2. Dictionary generation
 ################################################################################
-def find_closest_neighbour_idx(neighbours_candidate_dist_func):
+def update_codebook(feature_descriptors, codebook, closest_cluster_idxs, distances):
     """
-    Given a tuple of (neighbours, candidate, dist_func),
-    return the index of the 1-kNN of candidate in neighbours.
+    Return the new cluster centres, i.e. the mean of each cluster's descriptors and its old centre,
+    where {closest_cluster_idxs} and {distances} are the cluster of each descriptor and the distance
+    to its centre. The centres of empty clusters are moved to the descriptors furthest from their
+    centres. Also return the indexes of the empty clusters.
     """
-    neighbours, candidate, dist_func = neighbours_candidate_dist_func
+    new_centers = hp.update_centres(codebook, feature_descriptors, closest_cluster_idxs)
+
+    empty_clusters = np.nonzero(np.bincount(closest_cluster_idxs, minlength=len(codebook)) == 0)[0]
+    furthest_idxs = np.argsort(-distances, kind='stable')[:len(empty_clusters)]
+    new_centers[empty_clusters[:len(furthest_idxs)]] = feature_descriptors[furthest_idxs]
 
-    return hp.get_idx_of_1_NN(candidate, neighbours, dist_func=dist_func)
+    return new_centers, empty_clusters
 
-def gen_codebook(feature_descriptors, fname, dist_func=hp.sad, num_words=500, max_iter=10):
+def train_codebook(feature_descriptors, fname, dist_func=hp.sad, num_words=500, max_iter=10, accelerated=False,
+                   init='random', tol=None, resume=False, initial_codebook=None, assignment_pool=None,
+                   fingerprint=None, descriptor_norms=None):
     """
-    Cluser feuture_descriptors into {num_words} clusters.
-    The generated codebook is saved to a file {fname} after each each iteration.
+    Generator which trains the codebook {fname} from the matrix {feature_descriptors} like gen_codebook,
+    one iteration per next(), and yields the log record of each iteration. Return the codebook.
+    If {fname} is None, the codebook is only trained in memory: nothing is saved, logged or printed,
+    and there are no checkpoints to resume from.
+    If {assignment_pool} (see start_assignment_pool) is given, its workers assign the descriptors to
+    clusters. The {fingerprint} and {descriptor_norms} (see hp.get_vector_norms) of the descriptors
+    are computed if not given.
     """
-    start_time = time.time()
+    in_memory = fname is None
+    # The fingerprint is only needed for the checkpoints.
+    if fingerprint is None and not in_memory:
+        fingerprint = hp.get_fingerprint(feature_descriptors)
+    if descriptor_norms is None:
+        descriptor_norms = hp.get_vector_norms(feature_descriptors, dist_func)
+    log_fname = None if in_memory else f'{os.path.splitext(fname)[0]}_log.jsonl'
+
+    if resume and not in_memory and os.path.exists(get_checkpoint_fname(fname)):
+        checkpoint = load_checkpoint(fname, dist_func, num_words, fingerprint)
+        if checkpoint['finished']:
+            print(f'{fname} is already finished.')
+            return checkpoint['codebook']
+        np.random.set_state(checkpoint['rng_state'])
+        print(f'Resuming {fname} after iteration {checkpoint["iteration"]}.')
+    else:
+        if initial_codebook is not None:
+            codebook = np.array(initial_codebook)
+            if codebook.shape != (num_words, feature_descriptors.shape[1]):
+                raise ValueError(f'Initial codebook has shape {codebook.shape}, expected {num_words} words.')
+            print(f'Starting {fname} from the given {num_words} clusters.')
+        else:
+            # Initialise. Choose num_words feature descriptors as cluster centres.
+            # Only k-means|| can use the assignment pool.
+            seeding_kwargs = {'assignment_pool': assignment_pool} if init == 'k-means||' else {}
+            codebook = SEEDING_FUNCS[init](feature_descriptors, num_words, dist_func, **seeding_kwargs)
+            if not in_memory:
+                print(f'Seeded {num_words} clusters of {fname} with {init}.')
+
+        checkpoint = {'codebook': codebook, 'iteration': 0, 'rng_state': np.random.get_state(),
+                      'dist_func': dist_func.__name__, 'fingerprint': fingerprint, 'inertia': None,
+                      'cluster_idxs': None, 'finished': False}
+        if not in_memory:
+            save_checkpoint(fname, checkpoint)
+            # Start a new log for every run.
+            open(log_fname, 'w').close()
 
-    # Initialise. Randomly choose num_words feature descriptors as cluster centres.
-    codebook = []
-    random_idxs = np.random.choice(len(feature_descriptors), num_words)
-    for i in random_idxs:
-        codebook.append(feature_descriptors[i])
+    codebook = checkpoint['codebook']
+    previous_cluster_idxs = checkpoint['cluster_idxs']
+    previous_inertia = checkpoint['inertia']
 
     # Do clustering while there are any changes in any cluster centre, but not more than max_iter.
-    for iteration in range(1, max_iter+1):
-        # Find the indexes of the nearest cluster for each descriptor.
-        # This step is easily parallelizable.
-        with mp.Pool(mp.cpu_count()) as pool:
-            # pool.map takes one argument.
-            map_input = [(codebook, descriptor, dist_func) for descriptor in feature_descriptors]
-            closest_cluster_idxs = pool.map(find_closest_neighbour_idx, map_input)
-
-        # Collect all the descrtiptors mapped to the same keyword from the calculated indexes.
-        cluster_vectors_map = [[word] for word in codebook]
-        for i in range(len(closest_cluster_idxs)):
-            # pool.map results are ordered,
-            # i.e. the output closest_cluster_idxs[i] corresponds to the descriptor[i]
-            cluster_vectors_map[closest_cluster_idxs[i]].append(feature_descriptors[i])
-
-        # Calculate new cluster centers. This is also easily parallelizable.
-        with mp.Pool(mp.cpu_count()) as pool:
-            new_centers = pool.map(hp.mean, cluster_vectors_map)
+    first_iteration = checkpoint['iteration'] + 1
+    for iteration in range(first_iteration, max_iter+1):
+        iteration_start_time = time.time()
+        # Find the indexes of the nearest cluster for all descriptors at once.
+        num_distances = len(feature_descriptors) * num_words
+        if accelerated and iteration == first_iteration:
+            slack = get_distance_slack(feature_descriptors, codebook, dist_func, descriptor_norms)
+            closest_cluster_idxs, upper_bounds, lower_bounds = \
+                init_distance_bounds(feature_descriptors, codebook, dist_func, slack)
+        elif accelerated:
+            num_distances = update_assignments_with_bounds(feature_descriptors, codebook, closest_cluster_idxs,
+                                                           upper_bounds, lower_bounds, dist_func, slack)
+        elif assignment_pool is None:
+            closest_cluster_idxs = hp.get_idxs_of_1_NN(feature_descriptors, codebook, dist_func=dist_func,
+                                                       candidate_norms=descriptor_norms)
+        else:
+            closest_cluster_idxs = assign_with_pool(assignment_pool, codebook, dist_func)
+
+        distances = hp.get_paired_distances(feature_descriptors, codebook[closest_cluster_idxs],
+                                            dist_func=dist_func)
+        inertia = distances.sum()
+        if previous_cluster_idxs is None:
+            num_reassigned = len(feature_descriptors)
+        else:
+            num_reassigned = int(np.count_nonzero(closest_cluster_idxs != previous_cluster_idxs))
+        previous_cluster_idxs = closest_cluster_idxs.copy()
+
+        # Calculate new cluster centers, i.e. the mean of each cluster's descriptors and its old centre.
+        new_centers, empty_clusters = update_codebook(feature_descriptors, codebook, closest_cluster_idxs,
+                                                      distances)
 
         # Compare to previous iteration codebook
-        diff = abs(np.array(codebook) - np.array(new_centers))
+        diff = abs(codebook - new_centers)
+
+        if accelerated:
+            # Moving the centres changes the distances by at most how much the centres moved.
+            shifts = hp.get_paired_distances(codebook, new_centers, dist_func=dist_func) + slack
+            upper_bounds += shifts[closest_cluster_idxs]
+            lower_bounds -= shifts
+            slack = max(slack, get_distance_slack(feature_descriptors, new_centers, dist_func, descriptor_norms))
 
         # Assign new centers.
-        for i in range(len(codebook)):
-            codebook[i] = new_centers[i]
+        codebook = new_centers
+
+        if not in_memory:
+            hp.save_to_pickle_atomically(fname, codebook)
+
+        relative_improvement = None
+        if previous_inertia is not None and previous_inertia > 0:
+            relative_improvement = (previous_inertia - inertia) / previous_inertia
+        previous_inertia = inertia
 
-        hp.save_to_pickle(fname, codebook)
-        print(f'Finished iteration {iteration} at minute {(time.time() - start_time)/60}.')
+        log_record = {'codebook': fname, 'iteration': iteration, 'inertia': float(inertia),
+                      'relative_improvement': relative_improvement, 'num_reassigned': num_reassigned,
+                      'num_empty_clusters': len(empty_clusters), 'num_distances': int(num_distances),
+                      'seconds': time.time() - iteration_start_time}
+        if not in_memory:
+            with open(log_fname, 'a') as f:
+                f.write(json.dumps(log_record) + '\n')
 
         # Stop if the improvements are very small.
-        delta = 1.0
-        if np.all(diff < delta):
+        if tol is not None:
+            converged = relative_improvement is not None and relative_improvement < tol
+        else:
+            delta = 1.0
+            converged = np.all(diff < delta)
+
+        if not in_memory:
+            save_checkpoint(fname, {'codebook': codebook, 'iteration': iteration,
+                                    'rng_state': np.random.get_state(), 'dist_func': dist_func.__name__,
+                                    'fingerprint': fingerprint, 'inertia': inertia,
+                                    'cluster_idxs': previous_cluster_idxs,
+                                    'finished': converged or iteration == max_iter})
+        yield log_record
+
+        if converged:
             break
 
     return codebook
 
+def gen_codebook(feature_descriptors, fname, dist_func=hp.sad, num_words=500, max_iter=10, num_workers=1,
+                 accelerated=False, init='random', tol=None, resume=False, initial_codebook=None):
+    """
+    Cluser feuture_descriptors into {num_words} clusters.
+    The generated codebook is saved to a file {fname} after each each iteration, and the inertia
+    (sum of distances of descriptors to their cluster centre), number of reassigned descriptors,
+    number of empty clusters, number of computed distances and time of each iteration are appended
+    to {fname}_log.jsonl.
+    {init} is the seeding method, one of SEEDING_FUNCS. Clusters that end up empty are re-seeded
+    with the descriptors furthest from their centres.
+    Stop when the inertia improves by less than {tol} (relative), or if {tol} is None, when no
+    coordinate of any cluster centre changes by more than 1.0.
+    If {num_workers} > 1, descriptors are assigned to clusters by a pool of {num_workers} processes,
+    which also runs the rounds of k-means|| seeding.
+    If {accelerated} is True, use Elkan's algorithm (in a single process) to skip the distances
+    that can't change the assignment. The result is the same, but it needs memory for
+    len(feature_descriptors) * num_words distance bounds.
+
+    After seeding and after each iteration, the state of the training is saved to a checkpoint next
+    to {fname}. If {resume} is True and there is a checkpoint, continue from it instead, with the same
+    result as if the training hadn't stopped. If {initial_codebook} is given, start from it instead
+    of seeding, e.g. to update an existing codebook with new descriptors.
+    """
+    start_time = time.time()
+    # One row per descriptor.
+    feature_descriptors = np.asarray(feature_descriptors)
+
+    assignment_pool = None
+    if num_workers > 1 and not accelerated:
+        assignment_pool = start_assignment_pool(feature_descriptors, num_workers)
+
+    training = train_codebook(feature_descriptors, fname, dist_func=dist_func, num_words=num_words,
+                              max_iter=max_iter, accelerated=accelerated, init=init, tol=tol, resume=resume,
+                              initial_codebook=initial_codebook, assignment_pool=assignment_pool)
+    try:
+        while True:
+            try:
+                log_record = next(training)
+            except StopIteration as stop:
+                return stop.value
+
+            print(f'Finished iteration {log_record["iteration"]} at minute {(time.time() - start_time)/60}, '
+                  f'inertia {log_record["inertia"]}, {log_record["num_reassigned"]} reassigned, '
+                  f'{log_record["num_empty_clusters"]} empty clusters, {log_record["num_distances"]} distances.')
+    finally:
+        if assignment_pool is not None:
+            stop_assignment_pool(assignment_pool)
+
+def gen_codebooks(feature_descriptors, codebook_configs, max_iter=10, num_workers=1, accelerated=False,
+                  init='random', tol=None, resume=False, warm_start=False):
+    """
+    Same as gen_codebook for each (fname, dist_func, num_words) tuple of {codebook_configs}, but the
+    descriptors are converted to a matrix, fingerprinted and their norms computed once, and a single pool
+    of {num_workers} processes is shared by all codebooks. The codebooks are trained interleaved, one
+    iteration of each in turn, and one line of progress is printed per round. If {accelerated} is True,
+    the distance bounds of all codebooks are in memory at once.
+    If {warm_start} is True, each codebook starts from its existing file.
+    Return the list of codebooks.
+    """
+    start_time = time.time()
+    # One row per descriptor.
+    feature_descriptors = np.asarray(feature_descriptors)
+    fingerprint = hp.get_fingerprint(feature_descriptors)
+    descriptor_norms = {dist_func: hp.get_vector_norms(feature_descriptors, dist_func)
+                        for _, dist_func, _ in codebook_configs}
+
+    assignment_pool = None
+    if num_workers > 1 and not accelerated:
+        assignment_pool = start_assignment_pool(feature_descriptors, num_workers)
+
+    trainings = {}
+    for fname, dist_func, num_words in codebook_configs:
+        initial_codebook = hp.load_pickled_list(fname) if warm_start else None
+        trainings[fname] = train_codebook(feature_descriptors, fname, dist_func=dist_func, num_words=num_words,
+                                          max_iter=max_iter, accelerated=accelerated, init=init, tol=tol,
+                                          resume=resume, initial_codebook=initial_codebook,
+                                          assignment_pool=assignment_pool, fingerprint=fingerprint,
+                                          descriptor_norms=descriptor_norms[dist_func])
+
+    codebooks = {}
+    try:
+        while trainings:
+            progress = []
+            for fname, training in list(trainings.items()):
+                try:
+                    log_record = next(training)
+                    progress.append(f'{os.path.basename(fname)} iteration {log_record["iteration"]} '
+                                    f'inertia {log_record["inertia"]:.6g}')
+                except StopIteration as stop:
+                    codebooks[fname] = stop.value
+                    del trainings[fname]
+                    progress.append(f'{os.path.basename(fname)} finished')
+
+            print(f'Minute {(time.time() - start_time)/60:.2f}: ' + ', '.join(progress) + '.')
+    finally:
+        # Stop the unfinished trainings before their descriptors are freed.
+        for training in trainings.values():
+            training.close()
+        if assignment_pool is not None:
+            stop_assignment_pool(assignment_pool)
+
+    return [codebooks[fname] for fname, _, _ in codebook_configs]
+
+################################################################################
+# Mini-batch k-means
+################################################################################
+def iter_descriptor_batches(descriptors_fnames, batch_size):
+    """
+    Yield batches of {batch_size} descriptors read from the {descriptors_fnames} files, one file at
+    a time and in a random order, so that only about one batch is in memory at once.
+    Loop over the files forever, in a new order every time.
+    """
+    buffered, num_buffered = [], 0
+    while True:
+        num_read = 0
+        for i in np.random.permutation(len(descriptors_fnames)):
+            descriptors = np.load(descriptors_fnames[i], allow_pickle=True).reshape(-1, 128)
+            buffered.append(descriptors)
+            num_buffered += len(descriptors)
+            num_read += len(descriptors)
+
+            while num_buffered >= batch_size:
+                buffered = np.concatenate(buffered)
+                yield buffered[:batch_size]
+                buffered, num_buffered = [buffered[batch_size:]], num_buffered - batch_size
+
+        if num_read == 0:
+            raise ValueError('There are no descriptors to read.')
+
+def get_mean_distance(descriptors, codebook, dist_func):
+    """
+    Return the mean distance of {descriptors} to their closest codeword.
+    """
+    closest_cluster_idxs = hp.get_idxs_of_1_NN(descriptors, codebook, dist_func=dist_func)
+
+    return np.mean(hp.get_paired_distances(descriptors, codebook[closest_cluster_idxs], dist_func=dist_func))
+
+def gen_codebook_mini_batch(descriptors_fnames, fname, dist_func=hp.sad, num_words=500, batch_size=4096,
+                            max_batches=2000, eval_every=20, held_out_fraction=0.05, max_held_out=20000,
+                            tol=1e-3, patience=3):
+    """
+    Cluster the descriptors stored in the {descriptors_fnames} files into {num_words} clusters with
+    mini-batch k-means, reading the files batch by batch instead of loading all descriptors.
+    Each cluster centre moves towards the mean of its descriptors in a batch with a learning rate of
+    (descriptors in the batch) / (all descriptors assigned to it so far), i.e. every centre is the
+    running mean of the descriptors assigned to it.
+
+    The descriptors of a {held_out_fraction} of the files (at most {max_held_out} of them) are not
+    used for training. Every {eval_every} batches, the codebook is saved to a file {fname} and the
+    mean distance of the held-out descriptors to their closest codeword is computed. Training stops
+    when it improves by less than {tol} (relative) {patience} times in a row, or after {max_batches}.
+    """
+    start_time = time.time()
+
+    # Hold out whole images, so that the held-out descriptors are new to the codebook.
+    shuffled_fnames = [descriptors_fnames[i] for i in np.random.permutation(len(descriptors_fnames))]
+    num_held_out_files = max(1, int(round(held_out_fraction * len(descriptors_fnames))))
+    held_out_descriptors = np.concatenate([np.load(f, allow_pickle=True).reshape(-1, 128)
+                                           for f in shuffled_fnames[:num_held_out_files]])
+    if len(held_out_descriptors) > max_held_out:
+        held_out_descriptors = held_out_descriptors[np.random.choice(len(held_out_descriptors), max_held_out,
+                                                                     replace=False)]
+    batches = iter_descriptor_batches(shuffled_fnames[num_held_out_files:], batch_size)
+
+    # Initialise. Randomly choose num_words descriptors of the first batches as cluster centres.
+    first_batches = [next(batches) for _ in range(-(-num_words // batch_size))]
+    first_batches = np.concatenate(first_batches)
+    codebook = first_batches[np.random.choice(len(first_batches), num_words, replace=False)].astype(np.float64)
+    cluster_sizes = np.zeros(num_words, dtype=int)
+
+    last_mean_distance = None
+    num_small_improvements = 0
+    for batch_idx, batch in enumerate(batches, 1):
+        closest_cluster_idxs = hp.get_idxs_of_1_NN(batch, codebook, dist_func=dist_func)
+
+        batch_cluster_sizes = np.bincount(closest_cluster_idxs, minlength=num_words)
+        batch_sums = np.zeros(codebook.shape)
+        np.add.at(batch_sums, closest_cluster_idxs, batch)
+
+        # Per-centre learning rates, centres with no descriptors in this batch don't move.
+        cluster_sizes += batch_cluster_sizes
+        in_batch = batch_cluster_sizes > 0
+        learning_rates = batch_cluster_sizes[in_batch] / cluster_sizes[in_batch]
+        batch_means = batch_sums[in_batch] / batch_cluster_sizes[in_batch, None]
+        codebook[in_batch] += learning_rates[:, None] * (batch_means - codebook[in_batch])
+
+        if batch_idx % eval_every == 0 or batch_idx == max_batches:
+            hp.save_to_pickle_atomically(fname, codebook)
+            mean_distance = get_mean_distance(held_out_descriptors, codebook, dist_func)
+            print(f'Finished batch {batch_idx} at minute {(time.time() - start_time)/60}, '
+                  f'held-out mean distance {mean_distance}.')
+
+            # Stop if the improvements are very small.
+            if last_mean_distance is not None and last_mean_distance - mean_distance < tol * last_mean_distance:
+                num_small_improvements += 1
+            else:
+                num_small_improvements = 0
+            last_mean_distance = mean_distance
+
+            if num_small_improvements >= patience:
+                break
+
+        if batch_idx == max_batches:
+            break
+
+    return codebook
+
+
+################################################################################
+# Vocabulary tree
+################################################################################
+def cluster_descriptors(feature_descriptors, num_words, dist_func=hp.sad, max_iter=10, init='k-means++', tol=1e-3):
+    """
+    Cluster {feature_descriptors} into {num_words} clusters in memory with train_codebook, the same way as
+    gen_codebook but without saving anything. Return the cluster centres and the log record of each iteration.
+    """
+    training = train_codebook(feature_descriptors, None, dist_func=dist_func, num_words=num_words,
+                              max_iter=max_iter, init=init, tol=tol)
+    log_records = []
+    while True:
+        try:
+            log_records.append(next(training))
+        except StopIteration as stop:
+            return stop.value, log_records
+
+def gen_vocabulary_tree(feature_descriptors, fname, dist_func=hp.sad, branching=10, depth=4, max_iter=10,
+                        init='k-means++', tol=1e-3):
+    """
+    Build a vocabulary tree with {branching} ** {depth} words (see helper.py) and save it to a file {fname}.
+    The descriptors are clustered into {branching} clusters, then the descriptors of each cluster are
+    clustered again, and so on down to level {depth}. A node with no more than {branching} descriptors
+    isn't clustered, its children are its descriptors, and copies of its centre for the rest.
+    The log record of each iteration of each clustered node (see gen_codebook) is written to {fname}_log.jsonl.
+    """
+    start_time = time.time()
+    feature_descriptors = np.asarray(feature_descriptors, dtype=np.float64)
+    log_fname = f'{os.path.splitext(fname)[0]}_log.jsonl'
+    # Start a new log for every run.
+    open(log_fname, 'w').close()
+
+    nodes = np.empty((hp.get_num_tree_nodes(branching, depth), feature_descriptors.shape[1]))
+    nodes[0] = hp.mean(feature_descriptors)
+    # The node of each descriptor at the current level.
+    node_idxs = np.zeros(len(feature_descriptors), dtype=int)
+
+    for level in range(depth):
+        # Group the descriptors by node.
+        order = np.argsort(node_idxs, kind='stable')
+        first_node, last_node = hp.get_num_tree_nodes(branching, level - 1), hp.get_num_tree_nodes(branching, level)
+        group_bounds = np.searchsorted(node_idxs[order], np.arange(first_node, last_node + 1))
+
+        num_leaf_nodes = 0
+        for node, group_start, group_stop in zip(range(first_node, last_node), group_bounds[:-1], group_bounds[1:]):
+            node_descriptors = feature_descriptors[order[group_start:group_stop]]
+            children = nodes[node * branching + 1:node * branching + branching + 1]
+
+            if len(node_descriptors) <= branching:
+                children[:] = nodes[node]
+                children[:len(node_descriptors)] = node_descriptors
+                num_leaf_nodes += 1
+            else:
+                children[:], log_records = cluster_descriptors(node_descriptors, branching, dist_func=dist_func,
+                                                               max_iter=max_iter, init=init, tol=tol)
+                with open(log_fname, 'a') as f:
+                    for log_record in log_records:
+                        f.write(json.dumps({**log_record, 'codebook': fname, 'node': node}) + '\n')
+
+        # Assign the descriptors to the children the same way as quantization does.
+        node_idxs = hp.get_idxs_of_closest_children(feature_descriptors, node_idxs, nodes, branching,
+                                                    dist_func=dist_func)
+        print(f'Finished level {level + 1} of {fname} at minute {(time.time() - start_time)/60}, '
+              f'{num_leaf_nodes}/{last_node - first_node} nodes had too few descriptors to cluster.')
+
+    tree = {'nodes': nodes, 'branching': branching, 'depth': depth, 'dist_func': dist_func.__name__}
+    hp.save_to_pickle_atomically(fname, tree)
+
+    return tree
+
+
 ################################################################################
 # Main
 ################################################################################
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the codebooks from the training descriptors.')
+    parser.add_argument('-w', '--workers', help='number of worker processes (default: one per CPU)', type=int)
+    parser.add_argument('--mini-batch', help='use mini-batch k-means, reading the descriptors file by file '
+                        'instead of loading all of them', action='store_true')
+    parser.add_argument('-b', '--batch-size', help='number of descriptors per mini-batch', type=int, default=4096)
+    parser.add_argument('--init', help='how to choose the initial cluster centres (default: k-means++)',
+                        choices=SEEDING_FUNCS.keys())
+    parser.add_argument('--tol', help='stop when the inertia (with --mini-batch, the held-out mean distance) '
+                        'improves by less than this (relative)', type=float, default=1e-3)
+    parser.add_argument('--resume', help='continue the training of each codebook from its checkpoint',
+                        action='store_true')
+    parser.add_argument('--warm-start', help='start from the existing codebooks instead of seeding new ones',
+                        action='store_true')
+    parser.add_argument('--accelerated', help="use Elkan's k-means, which skips distances that can't change "
+                        'the clusters (same result, single process)', action='store_true')
+    parser.add_argument('--tree', help='build vocabulary trees with BRANCHING ** DEPTH words instead of the '
+                        'flat codebooks', action='store_true')
+    parser.add_argument('--branching', help='number of children of each node of the vocabulary trees', type=int,
+                        default=10)
+    parser.add_argument('--depth', help='number of levels of the vocabulary trees', type=int, default=4)
+    args = parser.parse_args()
+    if args.mini_batch:
+        unsupported = [flag for flag, value in [('-w', args.workers), ('--init', args.init), ('--resume', args.resume),
+                                                ('--warm-start', args.warm_start), ('--accelerated', args.accelerated),
+                                                ('--tree', args.tree)] if value]
+        if unsupported:
+            parser.error(f'--mini-batch does not support {", ".join(unsupported)}')
+    if args.workers is None:
+        args.workers = mp.cpu_count()
+    if args.init is None:
+        args.init = 'k-means++'
+
     start_time = time.time()
 
-    # Merge the descriptors from one class into a single list.
-    # training_descriptors will hold ['class_name': descriptors_list] pairs
-    training_descriptors = hp.load_descriptors(test_or_train='Training', merge_in_class=True)
+    # Codebook file, distance function and number of words of each codebook.
+    codebook_configs = [
+        (hp.CODEBOOK_FILE, hp.sad, 500),
+        (hp.CODEBOOK_SMALL_FILE, hp.sad, 20),
+        (hp.CODEBOOK_EUCLIDEAN_FILE, hp.euclidean_distance, 500),
+        (hp.CODEBOOK_EUCLIDEAN_SMALL_FILE, hp.euclidean_distance, 20),
+    ]
 
-    # A single list for all feature descriptors from all classes.
-    all_descriptors = []
-    for descriptors in training_descriptors.values():
-        all_descriptors += descriptors
+    if args.mini_batch:
+        descriptors_fnames = hp.get_descriptors_fnames('Training')
+        for fname, dist_func, num_words in codebook_configs:
+            gen_codebook_mini_batch(descriptors_fnames, fname, dist_func=dist_func, num_words=num_words,
+                                    batch_size=args.batch_size, tol=args.tol)
+    else:
+        # Merge the descriptors from one class into a single list.
+        # training_descriptors will hold ['class_name': descriptors_list] pairs
+        training_descriptors = hp.load_descriptors(test_or_train='Training', merge_in_class=True)
 
-    codebook = gen_codebook(all_descriptors, hp.CODEBOOK_FILE, dist_func=hp.sad, num_words=500)
-    codebook_small = gen_codebook(all_descriptors, hp.CODEBOOK_SMALL_FILE, dist_func=hp.sad, num_words=20)
+        # A single list for all feature descriptors from all classes.
+        all_descriptors = []
+        for descriptors in training_descriptors.values():
+            all_descriptors += descriptors
 
-    codebook_euclidean = gen_codebook(all_descriptors, hp.CODEBOOK_EUCLIDEAN_FILE,
-                                      dist_func=hp.euclidean_distance, num_words=500)
-    codebook_small_euclidean = gen_codebook(all_descriptors, hp.CODEBOOK_EUCLIDEAN_SMALL_FILE,
-                                            dist_func=hp.euclidean_distance, num_words=20)
+        if args.tree:
+            for fname, dist_func in [(hp.CODEBOOK_TREE_FILE, hp.sad),
+                                     (hp.CODEBOOK_EUCLIDEAN_TREE_FILE, hp.euclidean_distance)]:
+                gen_vocabulary_tree(all_descriptors, fname, dist_func=dist_func, branching=args.branching,
+                                    depth=args.depth, init=args.init, tol=args.tol)
+        else:
+            # Train all codebooks at once on the same descriptors.
+            gen_codebooks(all_descriptors, codebook_configs, num_workers=args.workers, accelerated=args.accelerated,
+                          init=args.init, tol=args.tol, resume=args.resume, warm_start=args.warm_start)
 
     print(f'Finished program in {(time.time() - start_time)/60} minutes.')
@@ -5,6 +5,8 @@ Thepnathi Chindalaksanaloet, 201123978
 Robert Szafarczyk, 201307211
 """
 
+import argparse
+import os
 import cv2
 import numpy as np
 import time
@@ -12,114 +14,338 @@ import sys
 import re
 
 import helper as hp
+import codebook_index
 import multiprocessing as mp
 
+################################################################################
+# Quantization workers
+################################################################################
+# Shared arrays of a worker process, attached once by init_quantization_worker.
+worker_arrays = {}
+
+def share_codebooks(codebooks):
+    """
+    Copy the words of {codebooks}, or the arrays of vocabulary trees and KD-tree indexes, to shared memory.
+    Return the shared memory blocks, and the specs to pass to init_quantization_worker.
+    """
+    shms, codebooks_specs = [], []
+    for codebook in codebooks:
+        if isinstance(codebook, dict):
+            arrays_specs = {}
+            for key, value in codebook.items():
+                if isinstance(value, np.ndarray):
+                    shm, _, arrays_specs[key] = hp.to_shared_array(value)
+                    shms.append(shm)
+            params = {key: value for key, value in codebook.items() if key not in arrays_specs}
+            codebooks_specs.append((arrays_specs, params))
+        else:
+            shm, _, spec = hp.to_shared_array(np.asarray(codebook, dtype=np.float64))
+            shms.append(shm)
+            codebooks_specs.append((spec, None))
+
+    return shms, codebooks_specs
+
+def init_quantization_worker(descriptors_spec, codebooks_specs):
+    """
+    Attach a worker process to the shared descriptors and codebooks, given the (name, shape, dtype)
+    returned by hp.to_shared_array and the specs returned by share_codebooks.
+    """
+    worker_arrays['descriptors_shm'], worker_arrays['descriptors'] = hp.attach_shared_array(*descriptors_spec)
+
+    worker_arrays['codebooks_shms'], worker_arrays['codebooks'] = [], []
+    for spec, params in codebooks_specs:
+        if params is None:
+            shm, words = hp.attach_shared_array(*spec)
+            worker_arrays['codebooks_shms'].append(shm)
+            worker_arrays['codebooks'].append(words)
+        else:
+            codebook = dict(params)
+            for key, array_spec in spec.items():
+                shm, codebook[key] = hp.attach_shared_array(*array_spec)
+                worker_arrays['codebooks_shms'].append(shm)
+            worker_arrays['codebooks'].append(codebook)
+
+def quantize_block(block):
+    """
+    Given a tuple of (start, stop), return the word indexes of the shared descriptors[start:stop]
+    for each shared codebook.
+    """
+    start, stop = block
+    return quantize_descriptors(worker_arrays['descriptors'][start:stop], worker_arrays['codebooks'])
+
+def get_word_idx_type(num_words):
+    """
+    Return the smallest integer type which fits the indexes of {num_words} words.
+    """
+    return np.int16 if num_words <= np.iinfo(np.int16).max + 1 else np.int32
+
+def quantize_descriptors(descriptors, codebooks, num_workers=1, blocks_per_worker=4):
+    """
+    Return the word indexes of the rows of the matrix {descriptors} for each of the {codebooks}, as one
+    row per codebook of the smallest integer type that fits all words.
+    If {num_workers} > 1, the descriptors are split into {blocks_per_worker} blocks per worker and quantized
+    by a pool of {num_workers} processes. The workers attach to the descriptors and codebooks in shared
+    memory once, and only the bounds of the blocks and the word indexes are sent between processes.
+    """
+    word_idx_type = get_word_idx_type(max([hp.get_codebook_size(codebook) for codebook in codebooks]))
+
+    if num_workers <= 1:
+        return np.array(get_word_idxs(descriptors, codebooks), dtype=word_idx_type).reshape(len(codebooks), -1)
+
+    descriptors_shm, shared_descriptors, descriptors_spec = hp.to_shared_array(descriptors)
+    # The array must be released before its shared memory is closed.
+    del shared_descriptors
+    codebooks_shms, codebooks_specs = share_codebooks(codebooks)
+    try:
+        with mp.Pool(num_workers, initializer=init_quantization_worker,
+                     initargs=(descriptors_spec, codebooks_specs)) as pool:
+            block_bounds = np.linspace(0, len(descriptors), num_workers * blocks_per_worker + 1).astype(int)
+            blocks_word_idxs = pool.map(quantize_block, zip(block_bounds[:-1], block_bounds[1:]))
+    finally:
+        for shm in [descriptors_shm] + codebooks_shms:
+            shm.close()
+            shm.unlink()
+
+    return np.concatenate(blocks_word_idxs, axis=1)
+
+
+################################################################################
+# Cached word indexes
+################################################################################
+# The word indexes of the descriptors of each image are saved next to its descriptors, one file per
+# codebook, named after the fingerprint of the codebook. Histograms and keypoint maps can then be
+# generated again, e.g. with another weighting, without quantizing the descriptors.
+
+def get_word_idxs_fname(img_path, fingerprint):
+    return f'{img_path}{hp.WORD_IDXS_FILE_EXT.format(fingerprint)}'
+
+def is_cached(img_path, fingerprint):
+    """
+    Return True if the word indexes of the image {img_path} (without extension) for the codebook
+    with {fingerprint} exist and are newer than the descriptors of the image.
+    """
+    word_idxs_fname = get_word_idxs_fname(img_path, fingerprint)
+    return os.path.exists(word_idxs_fname) and \
+           os.path.getmtime(word_idxs_fname) >= os.path.getmtime(f'{img_path}_descriptors.npy')
+
+def save_word_idxs(img_paths, offsets, fingerprint, word_idxs):
+    """
+    Save the {word_idxs} of the descriptors of each of the images {img_paths}, i.e.
+    word_idxs[offsets[i]:offsets[i+1]] for image {i}, for the codebook with {fingerprint}.
+    """
+    for i, img_path in enumerate(img_paths):
+        # is_cached trusts any file newer than the descriptors, so it must never be half-written.
+        hp.save_to_pickle_atomically(get_word_idxs_fname(img_path, fingerprint),
+                                     word_idxs[offsets[i]:offsets[i + 1]])
+
+def load_word_idxs(img_paths, fingerprint):
+    """
+    Return the concatenated word indexes of the images {img_paths} for the codebook with {fingerprint}.
+    """
+    return np.concatenate([np.load(get_word_idxs_fname(img_path, fingerprint)) for img_path in img_paths])
+
+
 ###########################################################################
 # Step 3. Image representation with a histogram of codewords
 ################################################################################
-## Step 3.2
-def gen_single_img_histogram(img_descriptors_codebook_pair):
+def stack_descriptors(imgs_descriptors):
     """
-    Generate a histogram of codewords for a single image, which is represented by a list of features.
+    Concatenate the descriptors of many images, {imgs_descriptors}, into one matrix.
+    Return the matrix and the offsets of the images, i.e. the descriptors of image {i} are
+    the rows offsets[i]:offsets[i+1] of the matrix.
     """
-    img_descriptors, codebook = img_descriptors_codebook_pair
+    imgs_descriptors = [np.asarray(descriptors, dtype=np.float64).reshape(-1, 128) for descriptors in imgs_descriptors]
+    offsets = np.cumsum([0] + [len(descriptors) for descriptors in imgs_descriptors])
 
-    # Initially, each image will have a count of 0 for each codeword.
-    histogram_of_codewords = [0 for _ in range(len(codebook))]
+    return np.concatenate(imgs_descriptors), offsets
 
-    # Keep track of which descriptor idxs map to which code word.
-    descriptor_to_codeword_map = [[] for _ in range(len(codebook))]
-    map_descriptor = lambda word_idx, descriptor_idx : \
-                      descriptor_to_codeword_map[word_idx].append(descriptor_idx)
-
-    for idx, descriptor in enumerate(img_descriptors):
-        # Step 3.1
-        closest_cluster_idx = hp.get_idx_of_1_NN(descriptor, codebook, dist_func=hp.euclidean_distance)
-        histogram_of_codewords[closest_cluster_idx] += 1
+## Step 3.1
+def get_word_idxs(descriptors, codebooks):
+    """
+    Return the index of the codeword of each row of the matrix {descriptors} for each of the {codebooks},
+    i.e. the closest word of a codebook by euclidean distance, found with its KD-tree index if it is one (see
+    codebook_index.py), or the leaf found by descending a vocabulary tree.
+    """
+    word_idxs = [None for _ in codebooks]
+
+    # Stack the codebooks which are lists of words, to compute the distances to all of their words at once.
+    # The results are the same as hp.get_idx_of_1_NN for every descriptor and codebook.
+    flat_idxs = [i for i, codebook in enumerate(codebooks) if not isinstance(codebook, dict)]
+    if flat_idxs:
+        flat_codebooks = [np.asarray(codebooks[i], dtype=np.float64) for i in flat_idxs]
+        segment_offsets = np.cumsum([0] + [len(codebook) for codebook in flat_codebooks])
+        flat_word_idxs = hp.get_idxs_of_1_NN_per_segment(descriptors, np.concatenate(flat_codebooks), segment_offsets,
+                                                         dist_func=hp.euclidean_distance)
+        for j, i in enumerate(flat_idxs):
+            word_idxs[i] = flat_word_idxs[:, j]
+
+    for i, codebook in enumerate(codebooks):
+        if isinstance(codebook, dict) and 'leaf_words' in codebook:
+            word_idxs[i] = codebook_index.get_idxs_of_1_NN_with_index(descriptors, codebook)
+        elif isinstance(codebook, dict):
+            # Vocabulary tree, only the children of one node per level are compared with each descriptor.
+            word_idxs[i] = hp.get_idxs_of_tree_words(descriptors, codebook)
+
+    return word_idxs
 
-        map_descriptor(closest_cluster_idx, idx)
+## Step 3.2
+def gen_img_histograms(word_idxs, offsets, num_words):
+    """
+    Given the {word_idxs} of the descriptors of many images, where the descriptors of image {i} are
+    word_idxs[offsets[i]:offsets[i+1]], return a matrix with the histogram of codewords of each image.
+    """
+    num_imgs = len(offsets) - 1
+    img_idxs = np.repeat(np.arange(num_imgs), np.diff(offsets))
 
-    return histogram_of_codewords, descriptor_to_codeword_map
+    # Count all (image, word) pairs at once.
+    return np.bincount(img_idxs * num_words + word_idxs, minlength=num_imgs * num_words).reshape(num_imgs, num_words)
 
 ## Step 3.4
-def normalise_histogram(histogram):
+def normalise_histograms(histograms):
     """
-    Given a list {histogram}, where each element {i} represents the frequency of the bin {i},
-    return a normalised_histogram where each element {i} is equal to
+    Given a matrix {histograms}, where each element {i} of a row represents the frequency of the bin {i},
+    return the normalised histograms where each element {i} is equal to
     (frequency in bin {i}) / (total number of elements in all bins, i.e. L1 norm of the histogram)
     """
-    total_sum = np.sum(histogram)
-    for i in range(len(histogram)):
-        histogram[i] /= total_sum
+    return histograms / np.sum(histograms, axis=1, keepdims=True)
 
-    return histogram
+WEIGHTINGS = ['l1', 'l2', 'tf-idf']
+
+def get_idf(histograms):
+    """
+    Return the inverse document frequency of each word, i.e. the log of the number of {histograms}
+    (one per row of the matrix) over the number of histograms where the word appears.
+    """
+    num_histograms_with_word = np.count_nonzero(histograms, axis=0)
+    return np.log(len(histograms) / np.maximum(num_histograms_with_word, 1))
+
+def weight_histograms(histograms, weighting='l1', idf=None):
+    """
+    Return the matrix {histograms} of codeword counts weighted by {weighting}, one of WEIGHTINGS.
+    'l1' and 'l2' divide each histogram by its L1 or L2 norm. 'tf-idf' multiplies the L1 normalised
+    histograms, i.e. the term frequencies, by the {idf} of each word (see get_idf).
+    """
+    if weighting == 'l1':
+        return normalise_histograms(histograms)
+    if weighting == 'l2':
+        return histograms / np.linalg.norm(histograms, axis=1, keepdims=True)
+    if weighting == 'tf-idf':
+        return normalise_histograms(histograms) * idf
+    raise ValueError(f'Unknown weighting {weighting}, expected one of {WEIGHTINGS}.')
 
 
 def gen_histograms(training_descriptors, test_descriptors, training_keypoints, test_keypoints,
-                   codebook, hist_file_extension='_histogram.npy', kp_diameter_threshold=30):
+                   codebook, hist_file_extension='_histogram.npy', kp_diameter_threshold=hp.KP_DIAMETER_THRESHOLD,
+                   weighting='l1'):
     """
-    Generate a histogram for all images from the given codebook.
+    Generate a histogram for all images from the given codebook, which is either a list of words
+    or a vocabulary tree.
+    """
+    return gen_histograms_for_codebooks(training_descriptors, test_descriptors, training_keypoints, test_keypoints,
+                                        [codebook], [hist_file_extension], kp_diameter_threshold,
+                                        weighting=weighting)[0]
+
+def gen_histograms_for_codebooks(training_descriptors, test_descriptors, training_keypoints, test_keypoints,
+                                 codebooks, hist_file_extensions, kp_diameter_threshold=hp.KP_DIAMETER_THRESHOLD,
+                                 num_workers=1, weighting='l1'):
+    """
+    Same as gen_histograms for each of the {codebooks} and its histogram file extension in
+    {hist_file_extensions}, but the descriptors of each image are read and quantized only once for all codebooks.
+    If {num_workers} > 1, the descriptors of all images are quantized by a single pool of {num_workers}
+    processes (see quantize_descriptors).
+    The word indexes of the descriptors are cached (see is_cached), and only the codebooks without cached
+    word indexes are quantized. The histograms are weighted by {weighting} (see weight_histograms), with the
+    idf of the training images for 'tf-idf', and saved with the extension of the weighting (see
+    hp.get_weighted_histogram_ext), so that only the L1 histograms use the plain {hist_file_extensions}.
+    Return the list of keypoint maps of the codebooks.
     """
 
     start_time = time.time()
+    num_words = [hp.get_codebook_size(codebook) for codebook in codebooks]
+    fingerprints = [hp.get_codebook_fingerprint(codebook) for codebook in codebooks]
     # Keep track of indexes of keypoints which mapped to the same codeword. One dictionary of
-    # {img_fname: [keypoints]} pairs per codeword.
-    map_kps_to_codewords = [dict() for _ in range(len(codebook))]
+    # {img_fname: [keypoints]} pairs per codeword, for each codebook.
+    maps_kps_to_codewords = [[dict() for _ in range(n)] for n in num_words]
 
-    for train_or_test in ['Test', 'Training']:
-        descriptors_dict = training_descriptors if train_or_test == 'Training' else test_descriptors
+    # Stack the descriptors of all images, class by class.
+    classes, img_paths, imgs_descriptors = [], [], []
+    for train_or_test, descriptors_dict in [('Test', test_descriptors), ('Training', training_descriptors)]:
+        for img_class, descriptors_files in descriptors_dict.items():
+            classes.append((train_or_test, img_class, list(descriptors_files.keys())))
+            img_paths += [f'{hp.DATASET_DIR}/{train_or_test}/{img_class}/{img_id}' for img_id in descriptors_files]
+            imgs_descriptors += descriptors_files.values()
+    descriptors, offsets = stack_descriptors(imgs_descriptors)
+
+    # Quantize the descriptors of all images at once for the codebooks without cached word indexes.
+    all_word_idxs = [None for _ in codebooks]
+    uncached = [c for c, fingerprint in enumerate(fingerprints)
+                if not all(is_cached(img_path, fingerprint) for img_path in img_paths)]
+    if uncached:
+        uncached_word_idxs = quantize_descriptors(descriptors, [codebooks[c] for c in uncached],
+                                                  num_workers=num_workers)
+        for c, word_idxs in zip(uncached, uncached_word_idxs):
+            all_word_idxs[c] = word_idxs.astype(get_word_idx_type(num_words[c]))
+            save_word_idxs(img_paths, offsets, fingerprints[c], all_word_idxs[c])
+        print(f'Quantized {len(descriptors)} descriptors for {len(uncached)} codebooks '
+              f'in {(time.time() - start_time)/60} minutes.')
+    for c in range(len(codebooks)):
+        if all_word_idxs[c] is None:
+            all_word_idxs[c] = load_word_idxs(img_paths, fingerprints[c])
+    if len(uncached) < len(codebooks):
+        print(f'Loaded the cached word indexes of {len(codebooks) - len(uncached)} codebooks.')
+
+    # Count the histograms of all images at once.
+    is_training = np.repeat([train_or_test == 'Training' for train_or_test, _, _ in classes],
+                            [len(img_ids) for _, _, img_ids in classes])
+    for c, word_idxs in enumerate(all_word_idxs):
+        histograms = gen_img_histograms(word_idxs, offsets, num_words[c])
+        idf = get_idf(histograms[is_training]) if weighting == 'tf-idf' else None
+        weighted_histograms = weight_histograms(histograms, weighting, idf)
+
+        # Save each image histogram to a seperate file
+        for img_path, histogram in zip(img_paths, weighted_histograms):
+            hp.save_to_pickle(f'{img_path}{hp.get_weighted_histogram_ext(hist_file_extensions[c], weighting)}',
+                              histogram)
+
+    img_idx = 0
+    for train_or_test, img_class, img_ids in classes:
         keypoints_dict = training_keypoints if train_or_test == 'Training' else test_keypoints
 
-        for img_class, descriptors_files in descriptors_dict.items():
-            # Distribute all img_descriptors fromt this class accross available CPUs.
-            with mp.Pool(mp.cpu_count()) as pool:
-                # Pack input for map.
-                img_descriptors_codebook_pair = \
-                    [(descriptors, codebook) for descriptors in descriptors_files.values()]
-                img_histograms_descriptor_to_codeword_map_pairs = \
-                    pool.map(gen_single_img_histogram, img_descriptors_codebook_pair)
-
-                # Unpack output from map.
-                img_histograms, descriptor_to_codeword_maps = [], []
-                for hd in img_histograms_descriptor_to_codeword_map_pairs:
-                    img_histograms.append(hd[0])
-                    descriptor_to_codeword_maps.append(hd[1])
-
-                nor_img_histograms = pool.map(normalise_histogram, img_histograms)
-
-            # Save each image histogram to a seperate file
-            for i, img_id in enumerate(descriptors_files.keys()):
-                hist_fname = f'{hp.DATASET_DIR}/{train_or_test}/{img_class}/{img_id}{hist_file_extension}'
-                hp.save_to_pickle(hist_fname, nor_img_histograms[i])
-
-            for i, img_id in enumerate(descriptors_files.keys()):
-                # Use full img path, instead of id, for easier visualisation.
-                img_fname = f'{hp.DATASET_DIR}/{train_or_test}/{img_class}/{img_id}.jpg'
-                for word_idx, keypoint_idxs_list in enumerate(descriptor_to_codeword_maps[i]):
-                    # Get rid of small keypoints.
-                    filtered_keypoints = []
-                    for kp_idx in keypoint_idxs_list:
-                        # We have saved the keypoint as [(kp_x, (kp_y), kp_diameter]
-                        # Use the fact that there is a 1:1 mapping between descriptor and kypoint idxs.
-                        kp = keypoints_dict[img_class][img_id][kp_idx]
-                        if kp[1] > kp_diameter_threshold:
-                            filtered_keypoints.append(kp)
-
-                    map_kps_to_codewords[word_idx][img_fname] = filtered_keypoints
-
-            print(f'Finished {train_or_test}/{img_class} in {(time.time() - start_time)/60} minutes.')
-
-    return map_kps_to_codewords
+        for img_id in img_ids:
+            # Use full img path, instead of id, for easier visualisation.
+            img_fname = f'{img_paths[img_idx]}.jpg'
+            # We have saved the keypoint as [(kp_x, (kp_y), kp_diameter]
+            # Use the fact that there is a 1:1 mapping between descriptor and kypoint idxs.
+            keypoints = keypoints_dict[img_class][img_id]
 
+            # Get rid of small keypoints.
+            for kp_idx in range(offsets[img_idx + 1] - offsets[img_idx]):
+                if keypoints[kp_idx][1] > kp_diameter_threshold:
+                    for map_kps_to_codewords, word_idxs in zip(maps_kps_to_codewords, all_word_idxs):
+                        word_idx = word_idxs[offsets[img_idx] + kp_idx]
+                        map_kps_to_codewords[word_idx].setdefault(img_fname, []).append(keypoints[kp_idx])
+            img_idx += 1
 
-if __name__ == "__main__":
-    start_time = time.time()
+        print(f'Finished {train_or_test}/{img_class} in {(time.time() - start_time)/60} minutes.')
+
+    return maps_kps_to_codewords
 
-    codebook = hp.load_pickled_list(hp.CODEBOOK_FILE)
-    codebook_small = hp.load_pickled_list(hp.CODEBOOK_SMALL_FILE)
 
-    codebook_euclidean = hp.load_pickled_list(hp.CODEBOOK_EUCLIDEAN_FILE)
-    codebook_euclidean_small = hp.load_pickled_list(hp.CODEBOOK_EUCLIDEAN_SMALL_FILE)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the histograms of codewords of all images.')
+    parser.add_argument('-t', '--tree', help='use the vocabulary trees instead of the codebooks', action='store_true')
+    parser.add_argument('-w', '--workers', help='number of worker processes', type=int, default=mp.cpu_count())
+    parser.add_argument('--weighting', help='weighting of the histograms', choices=WEIGHTINGS, default='l1')
+    parser.add_argument('-d', '--diameter', help='only map keypoints larger than this diameter to their codewords '
+                        f'(default: {hp.KP_DIAMETER_THRESHOLD}, or {hp.DENSE_KP_DIAMETER_THRESHOLD} with --dense)',
+                        type=float)
+    parser.add_argument('--dense', help='the features were extracted with SIFT.py --dense, whose keypoints are all '
+                        'smaller than the default diameter', action='store_true')
+    args = parser.parse_args()
+    if args.diameter is None:
+        args.diameter = hp.DENSE_KP_DIAMETER_THRESHOLD if args.dense else hp.KP_DIAMETER_THRESHOLD
+
+    start_time = time.time()
 
     training_descriptors = hp.load_descriptors(test_or_train='Training', merge_in_class=False)
     test_descriptors = hp.load_descriptors(test_or_train='Test', merge_in_class=False)
@@ -127,30 +353,33 @@ if __name__ == "__main__":
     training_keypoints = hp.load_keypoints(test_or_train='Training', merge_in_class=False)
     test_keypoints = hp.load_keypoints(test_or_train='Test', merge_in_class=False)
 
-    # Generate histograms for the 500- and 20-word codebook where SAD was used as similarity function.
-    map_kps_to_codebook = gen_histograms(training_descriptors, test_descriptors,
-                                         training_keypoints, test_keypoints,
-                                         codebook,
-                                         hist_file_extension=hp.HISTOGRAM_FILE_EXT)
-    hp.save_to_pickle(hp.MAP_KPS_TO_CODEBOOK_FILE, map_kps_to_codebook)
-
-    map_kps_to_codebook_small = gen_histograms(training_descriptors, test_descriptors,
-                                               training_keypoints, test_keypoints,
-                                               codebook_small,
-                                               hist_file_extension=hp.HISTOGRAM_SMALL_FILE_EXT)
-    hp.save_to_pickle(hp.MAP_KPS_TO_CODEBOOK_SMALL_FILE, map_kps_to_codebook_small)
-
-    # # Generate histograms for the 500- and 20-word codebook where euclidean distance was used as similarity function.
-    map_kps_to_codebook_euclidean_small = gen_histograms(training_descriptors, test_descriptors,
+    # Codebook file, histograms file extension and keypoints map file of each codebook.
+    if args.tree:
+        # Vocabulary trees where SAD and euclidean distance were used as similarity function.
+        codebook_configs = [
+            (hp.CODEBOOK_TREE_FILE, hp.HISTOGRAM_TREE_FILE_EXT, hp.MAP_KPS_TO_CODEBOOK_TREE_FILE),
+            (hp.CODEBOOK_EUCLIDEAN_TREE_FILE, hp.HISTOGRAM_EUCLIDEAN_TREE_FILE_EXT,
+             hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_TREE_FILE),
+        ]
+    else:
+        # The 500- and 20-word codebooks where SAD and euclidean distance were used as similarity function.
+        codebook_configs = [
+            (hp.CODEBOOK_FILE, hp.HISTOGRAM_FILE_EXT, hp.MAP_KPS_TO_CODEBOOK_FILE),
+            (hp.CODEBOOK_SMALL_FILE, hp.HISTOGRAM_SMALL_FILE_EXT, hp.MAP_KPS_TO_CODEBOOK_SMALL_FILE),
+            (hp.CODEBOOK_EUCLIDEAN_SMALL_FILE, hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT,
+             hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_SMALL_FILE),
+            (hp.CODEBOOK_EUCLIDEAN_FILE, hp.HISTOGRAM_EUCLIDEAN_FILE_EXT, hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_FILE),
+        ]
+
+    # Generate the histograms of all codebooks in one pass over the descriptors.
+    # Large codebooks are searched with their KD-tree index, if one was built by codebook_index.py.
+    codebooks = [codebook_index.load_codebook(codebook_file) for codebook_file, _, _ in codebook_configs]
+    maps_kps_to_codebooks = gen_histograms_for_codebooks(training_descriptors, test_descriptors,
                                                          training_keypoints, test_keypoints,
-                                                         codebook_euclidean_small,
-                                                         hist_file_extension=hp.HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT)
-    hp.save_to_pickle(hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_SMALL_FILE, map_kps_to_codebook_euclidean_small)
-
-    map_kps_to_codebook_euclidean = gen_histograms(training_descriptors, test_descriptors,
-                                               training_keypoints, test_keypoints,
-                                               codebook_euclidean,
-                                               hist_file_extension=hp.HISTOGRAM_EUCLIDEAN_FILE_EXT)
-    hp.save_to_pickle(hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_FILE, map_kps_to_codebook_euclidean)
+                                                         codebooks, [ext for _, ext, _ in codebook_configs],
+                                                         kp_diameter_threshold=args.diameter,
+                                                         num_workers=args.workers, weighting=args.weighting)
+    for (_, _, map_kps_file), map_kps_to_codebook in zip(codebook_configs, maps_kps_to_codebooks):
+        hp.save_to_pickle(map_kps_file, map_kps_to_codebook)
 
     print(f'Finished program in {(time.time() - start_time)/60} minutes.')
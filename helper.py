@@ -10,7 +10,8 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import cv2
-import fnmatch, os, collections, re, math
+import fnmatch, os, collections, re, math, hashlib
+from multiprocessing import shared_memory
 from typing import List, Dict, Set
 
 ################################################################################
@@ -32,16 +33,34 @@ CODEBOOK_FILE = f'{DATASET_DIR}/Training/codebook.npy'
 CODEBOOK_SMALL_FILE = f'{DATASET_DIR}/Training/codebook_small.npy'
 CODEBOOK_EUCLIDEAN_FILE = f'{DATASET_DIR}/Training/codebook_euclidean.npy'
 CODEBOOK_EUCLIDEAN_SMALL_FILE = f'{DATASET_DIR}/Training/codebook_euclidean_small.npy'
+CODEBOOK_TREE_FILE = f'{DATASET_DIR}/Training/codebook_tree.npy'
+CODEBOOK_EUCLIDEAN_TREE_FILE = f'{DATASET_DIR}/Training/codebook_euclidean_tree.npy'
 
 MAP_KPS_TO_CODEBOOK_FILE = f'{DATASET_DIR}/map_kps_to_codebook.npy'
 MAP_KPS_TO_CODEBOOK_SMALL_FILE = f'{DATASET_DIR}/map_kps_to_codebook_small.npy'
 MAP_KPS_TO_CODEBOOK_EUCLIDEAN_FILE = f'{DATASET_DIR}/map_kps_to_codebook_euclidean.npy'
 MAP_KPS_TO_CODEBOOK_EUCLIDEAN_SMALL_FILE = f'{DATASET_DIR}/map_kps_to_codebook_euclidean_small.npy'
+MAP_KPS_TO_CODEBOOK_TREE_FILE = f'{DATASET_DIR}/map_kps_to_codebook_tree.npy'
+MAP_KPS_TO_CODEBOOK_EUCLIDEAN_TREE_FILE = f'{DATASET_DIR}/map_kps_to_codebook_euclidean_tree.npy'
 
 HISTOGRAM_FILE_EXT = "_histogram.npy"
 HISTOGRAM_SMALL_FILE_EXT = "_histogram_small.npy"
 HISTOGRAM_EUCLIDEAN_FILE_EXT = "_histogram_euclidean.npy"
 HISTOGRAM_EUCLIDEAN_SMALL_FILE_EXT = "_histogram_euclidean_small.npy"
+HISTOGRAM_TREE_FILE_EXT = "_histogram_tree.npy"
+HISTOGRAM_EUCLIDEAN_TREE_FILE_EXT = "_histogram_euclidean_tree.npy"
+# Suffix added to the histogram file extensions above for each weighting (see gen_histograms.weight_histograms),
+# so that the weightings don't overwrite each other. The default L1 histograms keep the extensions above.
+HISTOGRAM_WEIGHTING_SUFFIXES = {'l1': '', 'l2': '_l2', 'tf-idf': '_tfidf'}
+HISTOGRAM_L2_FILE_EXT = "_histogram_l2.npy"
+HISTOGRAM_TFIDF_FILE_EXT = "_histogram_tfidf.npy"
+# Word indexes of the descriptors of an image, formatted with the fingerprint of the codebook.
+WORD_IDXS_FILE_EXT = "_words_{}.npy"
+
+# Only keypoints larger than this diameter are mapped to their codewords. Dense features (see
+# SIFT.DENSE_SIZES) are all smaller, so their keypoints are mapped regardless of their diameter.
+KP_DIAMETER_THRESHOLD = 30
+DENSE_KP_DIAMETER_THRESHOLD = 0
 
 DEFAULT_IMAGE_FORMAT = "jpg"
 LONG_LOCOMOTIVE = "========================================="
@@ -104,6 +123,221 @@ def get_idx_of_1_NN(candidate, neighbours, dist_func=euclidean_distance):
 
     return min_idx
 
+def get_vector_norms(vectors, dist_func=euclidean_distance):
+    """
+    Vectorized dist_func(vector, 0) for every row of the matrix {vectors}, i.e. the L2 norm for
+    euclidean_distance and the L1 norm for sad.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+
+    if dist_func is euclidean_distance:
+        return np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    elif dist_func is sad:
+        return np.abs(vectors).sum(axis=1)
+    else:
+        raise ValueError(f'{dist_func.__name__} has no vectorized version.')
+
+def get_idxs_of_1_NN(candidates, neighbours, dist_func=euclidean_distance, max_chunk_elements=2 ** 22,
+                     candidate_norms=None):
+    """
+    Same as get_idx_of_1_NN for every row of the matrix {candidates}, but vectorized.
+    Only dist_func=euclidean_distance and dist_func=sad are supported.
+    Candidates are processed in chunks, so that no temporary array has more than {max_chunk_elements} elements.
+    {candidate_norms} are the get_vector_norms of the candidates, computed if not given.
+    Return an array with the index of the closest neighbour of each candidate.
+    """
+    return get_idxs_of_1_NN_per_segment(candidates, neighbours, [0, len(neighbours)], dist_func=dist_func,
+                                        max_chunk_elements=max_chunk_elements, candidate_norms=candidate_norms)[:, 0]
+
+def get_idxs_of_1_NN_per_segment(candidates, neighbours, segment_offsets, dist_func=euclidean_distance,
+                                 max_chunk_elements=2 ** 22, candidate_norms=None):
+    """
+    Same as get_idxs_of_1_NN for each segment neighbours[segment_offsets[j]:segment_offsets[j+1]] of the
+    matrix {neighbours}, e.g. several codebooks stacked on top of each other, but the distances to the
+    neighbours of all segments are computed at once.
+    Return an array with the index (within the segment) of the closest neighbour of each candidate
+    in each segment, one column per segment.
+    """
+    candidates = np.asarray(candidates, dtype=np.float64)
+    neighbours = np.asarray(neighbours, dtype=np.float64)
+    if candidate_norms is None:
+        candidate_norms = get_vector_norms(candidates, dist_func)
+
+    if dist_func is euclidean_distance:
+        # ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2, where ||x||^2 is the same for all neighbours of x.
+        # x.c is a single matrix product (BLAS) for the whole chunk.
+        neighbour_norms = np.einsum('ij,ij->i', neighbours, neighbours)
+        chunk_size = max_chunk_elements // len(neighbours)
+        get_scores = lambda chunk: neighbour_norms - 2 * (chunk @ neighbours.T)
+        get_error_bounds = lambda chunk_norms, segment_norms: chunk_norms ** 2 + segment_norms.max()
+    elif dist_func is sad:
+        # Broadcast to a (chunk_size, num_neighbours, num_dims) array of absolute differences.
+        neighbour_norms = np.abs(neighbours).sum(axis=1)
+        chunk_size = max_chunk_elements // (len(neighbours) * neighbours.shape[1])
+        get_scores = lambda chunk: np.abs(chunk[:, None, :] - neighbours[None, :, :]).sum(axis=2)
+        get_error_bounds = lambda chunk_norms, segment_norms: chunk_norms + segment_norms.max()
+    else:
+        raise ValueError(f'{dist_func.__name__} has no vectorized version.')
+
+    segments = list(zip(segment_offsets[:-1], segment_offsets[1:]))
+    closest_idxs = np.empty((len(candidates), len(segments)), dtype=int)
+    chunk_size = max(chunk_size, 1)
+    for chunk_start in range(0, len(candidates), chunk_size):
+        chunk = candidates[chunk_start:chunk_start + chunk_size]
+        chunk_norms = candidate_norms[chunk_start:chunk_start + len(chunk)]
+        scores = get_scores(chunk)
+
+        for j, (segment_start, segment_stop) in enumerate(segments):
+            segment_scores = scores[:, segment_start:segment_stop]
+            closest_idxs[chunk_start:chunk_start + len(chunk), j] = np.argmin(segment_scores, axis=1)
+
+            if segment_stop - segment_start < 2:
+                continue
+            # The vectorized distances are rounded differently than dist_func. Where the two closest
+            # neighbours are too close to tell apart, fall back to dist_func to get the same result.
+            two_closest = np.partition(segment_scores, 1, axis=1)
+            is_tie = two_closest[:, 1] - two_closest[:, 0] <= \
+                     1e-12 * get_error_bounds(chunk_norms, neighbour_norms[segment_start:segment_stop])
+            for i in np.nonzero(is_tie)[0]:
+                closest_idxs[chunk_start + i, j] = get_idx_of_1_NN(chunk[i], neighbours[segment_start:segment_stop],
+                                                                   dist_func=dist_func)
+
+    return closest_idxs
+
+def get_paired_distances(vectors1, vectors2, dist_func=euclidean_distance):
+    """
+    Vectorized dist_func(vectors1[i], vectors2[i]) for every row i of the matrices {vectors1} and {vectors2}.
+    Only dist_func=euclidean_distance and dist_func=sad are supported.
+    """
+    differences = np.asarray(vectors1, dtype=np.float64) - np.asarray(vectors2, dtype=np.float64)
+
+    if dist_func is euclidean_distance:
+        return np.sqrt(np.einsum('ij,ij->i', differences, differences))
+    elif dist_func is sad:
+        return np.abs(differences).sum(axis=1)
+    else:
+        raise ValueError(f'{dist_func.__name__} has no vectorized version.')
+
+def get_distance_matrix(vectors1, vectors2, dist_func=euclidean_distance):
+    """
+    Vectorized dist_func(vectors1[i], vectors2[j]) for every row i of the matrix {vectors1} and every
+    row j of the matrix {vectors2}, up to floating point rounding.
+    Only dist_func=euclidean_distance and dist_func=sad are supported.
+    """
+    vectors1 = np.asarray(vectors1, dtype=np.float64)
+    vectors2 = np.asarray(vectors2, dtype=np.float64)
+
+    if dist_func is euclidean_distance:
+        squared_distances = np.einsum('ij,ij->i', vectors1, vectors1)[:, None] - 2 * (vectors1 @ vectors2.T) + \
+                            np.einsum('ij,ij->i', vectors2, vectors2)
+        return np.sqrt(np.maximum(squared_distances, 0))
+    elif dist_func is sad:
+        return np.abs(vectors1[:, None, :] - vectors2[None, :, :]).sum(axis=2)
+    else:
+        raise ValueError(f'{dist_func.__name__} has no vectorized version.')
+
+def get_fingerprint(array):
+    """
+    Return a hex digest of the shape, type and values of {array}, which changes if any of them changes.
+    """
+    array = np.ascontiguousarray(array)
+    fingerprint = hashlib.sha1(f'{array.dtype.str}{array.shape}'.encode())
+    fingerprint.update(array.data)
+
+    return fingerprint.hexdigest()
+
+def update_centres(centres, vectors, cluster_idxs):
+    """
+    Return the new centre of each cluster, i.e. the mean of the cluster's old centre and of the
+    {vectors} in the cluster, where {cluster_idxs}[i] is the cluster of {vectors}[i].
+    Same as calling mean on [centre] + (vectors in the cluster) for every cluster.
+    """
+    # np.add.at adds the vectors one by one, in order, so the sums are rounded the same way as in mean.
+    sums = np.array(centres, dtype=np.result_type(centres, vectors))
+    np.add.at(sums, cluster_idxs, vectors)
+    counts = np.bincount(cluster_idxs, minlength=len(centres)) + 1
+
+    return (sums / counts[:, None]).astype(sums.dtype)
+
+DIST_FUNCS = {f.__name__: f for f in [euclidean_distance, sad]}
+
+
+################################################################################
+# Vocabulary tree
+################################################################################
+# A vocabulary tree is a dictionary {'nodes', 'branching', 'depth', 'dist_func'}. The rows of 'nodes'
+# are the cluster centres of all nodes level by level, starting with the root, so that the children
+# of node n are the nodes n*branching+1 ... n*branching+branching. The leaves are the words.
+
+def get_num_tree_nodes(branching, depth):
+    """
+    Return the number of nodes of a tree with {branching} children per node, down to level {depth}.
+    """
+    return sum(branching ** level for level in range(depth + 1))
+
+def get_idxs_of_closest_children(descriptors, node_idxs, nodes, branching, dist_func=euclidean_distance,
+                                 max_chunk_elements=2 ** 22):
+    """
+    Return the index of the child of node {node_idxs}[i] which is the closest to {descriptors}[i],
+    for every row i of the matrix {descriptors}.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float64)
+    child_idxs = node_idxs[:, None] * branching + np.arange(1, branching + 1)
+
+    closest_child_idxs = np.empty(len(descriptors), dtype=int)
+    chunk_size = max(max_chunk_elements // (branching * descriptors.shape[1]), 1)
+    for chunk_start in range(0, len(descriptors), chunk_size):
+        chunk = descriptors[chunk_start:chunk_start + chunk_size]
+        chunk_child_idxs = child_idxs[chunk_start:chunk_start + chunk_size]
+        # Pair every descriptor with each of its node's children.
+        distances = get_paired_distances(np.repeat(chunk, branching, axis=0), nodes[chunk_child_idxs.ravel()],
+                                         dist_func=dist_func)
+        closest = np.argmin(distances.reshape(-1, branching), axis=1)
+        closest_child_idxs[chunk_start:chunk_start + len(chunk)] = chunk_child_idxs[np.arange(len(chunk)), closest]
+
+    return closest_child_idxs
+
+def get_idxs_of_tree_words(descriptors, tree):
+    """
+    Return the index of the word of each row of the matrix {descriptors}, found by descending the
+    vocabulary {tree} to the closest child at every level, i.e. with branching * depth distances per
+    descriptor instead of one per word.
+    """
+    nodes, branching, depth = tree['nodes'], tree['branching'], tree['depth']
+    descriptors = np.asarray(descriptors, dtype=np.float64).reshape(-1, nodes.shape[1])
+
+    node_idxs = np.zeros(len(descriptors), dtype=int)
+    for _ in range(depth):
+        node_idxs = get_idxs_of_closest_children(descriptors, node_idxs, nodes, branching,
+                                                 dist_func=DIST_FUNCS[tree['dist_func']])
+
+    return node_idxs - get_num_tree_nodes(branching, depth - 1)
+
+def get_codebook_size(codebook):
+    """
+    Return the number of words of {codebook}, which is either a list of words, a vocabulary tree or
+    a KD-tree index (see codebook_index.py).
+    """
+    if isinstance(codebook, dict) and 'words' in codebook:
+        return len(codebook['words'])
+    if isinstance(codebook, dict):
+        return codebook['branching'] ** codebook['depth']
+    return len(codebook)
+
+def get_codebook_fingerprint(codebook):
+    """
+    Return a hex digest of {codebook} (see get_fingerprint), which is either a list of words, a vocabulary
+    tree or a KD-tree index. The digest of a tree or an index also covers its parameters.
+    """
+    if not isinstance(codebook, dict):
+        return get_fingerprint(np.asarray(codebook, dtype=np.float64))
+
+    fingerprint = hashlib.sha1()
+    for key, value in sorted(codebook.items()):
+        fingerprint.update(f'{key}={get_fingerprint(value) if isinstance(value, np.ndarray) else value};'.encode())
+
+    return fingerprint.hexdigest()
+
 
 ################################################################################
 # Get directory or file paths
@@ -118,6 +352,27 @@ def get_image_paths(image_format=DEFAULT_IMAGE_FORMAT, path=TEST_PATH):
                 image_paths[(class_name, directory)].append(file)
     return image_paths
 
+def get_descriptors_fnames(test_or_train):
+    """
+    Return the paths of the descriptors files of all images in the {test_or_train} dataset.
+    """
+    fnames = []
+    for class_name in CLASSES:
+        directory = f'{DATASET_DIR}/{test_or_train}/{class_name}'
+        for file in sorted(os.listdir(directory)):
+            if re.match(r'.*_descriptors' + re.escape('.npy'), file):
+                fnames.append(f'{directory}/{file}')
+
+    return fnames
+
+def get_weighted_histogram_ext(fname_ext=HISTOGRAM_FILE_EXT, weighting='l1'):
+    """
+    Return the extension of the histogram files with extension {fname_ext} weighted by {weighting},
+    e.g. HISTOGRAM_TFIDF_FILE_EXT for HISTOGRAM_FILE_EXT and 'tf-idf'.
+    """
+    root, ext = os.path.splitext(fname_ext)
+    return f'{root}{HISTOGRAM_WEIGHTING_SUFFIXES[weighting]}{ext}'
+
 def get_histogram_paths(fname_ext=HISTOGRAM_FILE_EXT):
     training_histogram_paths = collections.defaultdict(list)
     test_histogram_paths = collections.defaultdict(list)
@@ -260,6 +515,54 @@ def save_to_pickle(pickle_fname, data):
     with open(pickle_fname, 'wb') as f:
         np.save(f, data)
 
+def save_to_pickle_atomically(pickle_fname, data):
+    """
+    Same as save_to_pickle, but write to a temporary file first and then rename it,
+    so that {pickle_fname} is never left half-written if the program crashes.
+    """
+    # Drop the extension, so that the temporary file doesn't match the *.npy patterns we load.
+    tmp_fname = f'{os.path.splitext(pickle_fname)[0]}.{os.getpid()}.tmp'
+    save_to_pickle(tmp_fname, data)
+    os.replace(tmp_fname, pickle_fname)
+
+def save_to_pickles_atomically(pickle_fnames, datas):
+    """
+    Same as save_to_pickle_atomically for several files, but all of them are written to temporary
+    files before the first one is renamed. The files are renamed in order, so if the program crashes
+    in between, the last file is older than the others.
+    """
+    tmp_fnames = [f'{os.path.splitext(pickle_fname)[0]}.{os.getpid()}.tmp' for pickle_fname in pickle_fnames]
+    for tmp_fname, data in zip(tmp_fnames, datas):
+        save_to_pickle(tmp_fname, data)
+    for tmp_fname, pickle_fname in zip(tmp_fnames, pickle_fnames):
+        os.replace(tmp_fname, pickle_fname)
+
+
+################################################################################
+# Shared memory between processes
+################################################################################
+def to_shared_array(array):
+    """
+    Copy {array} to a new block of shared memory.
+    Return the SharedMemory block, the copy, and the (name, shape, dtype) needed to attach to it.
+    The caller must close() and unlink() the block when done.
+    """
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared_array[...] = array
+
+    return shm, shared_array, (shm.name, array.shape, array.dtype.str)
+
+def attach_shared_array(name, shape, dtype):
+    """
+    Attach to the shared array created by to_shared_array in a parent process.
+    Return the SharedMemory block and the array.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
 
 ################################################################################
 # Result visualisations
@@ -33,9 +33,16 @@ if __name__ == "__main__":
                                      to the same code word in the disctionary of visual words.')
     parser.add_argument('-e', help='use codebook generated using euclidean distance', action='store_true')
     parser.add_argument('-s', help='use small codebook', action='store_true')
+    parser.add_argument('-t', help='use vocabulary tree instead of codebook', action='store_true')
     args = parser.parse_args()
 
-    if args.e and args.s:
+    if args.e and args.t:
+        codebook_file = hp.CODEBOOK_EUCLIDEAN_TREE_FILE
+        map_kp_to_word_file = hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_TREE_FILE
+    elif args.t:
+        codebook_file = hp.CODEBOOK_TREE_FILE
+        map_kp_to_word_file = hp.MAP_KPS_TO_CODEBOOK_TREE_FILE
+    elif args.e and args.s:
         codebook_file = hp.CODEBOOK_EUCLIDEAN_SMALL_FILE
         map_kp_to_word_file = hp.MAP_KPS_TO_CODEBOOK_EUCLIDEAN_SMALL_FILE
     elif args.e:
@@ -48,11 +55,12 @@ if __name__ == "__main__":
         codebook_file = hp.CODEBOOK_FILE
         map_kp_to_word_file = hp.MAP_KPS_TO_CODEBOOK_FILE
 
+    codebook = hp.load_pickled_list(codebook_file)
+
     dictionary_dist_func = 'euclidean' if args.e else 'Sum Of Absolute Difference'
-    num_words = 20 if args.s else 500
+    num_words = hp.get_codebook_size(codebook)
     print(f'---> Dictionary of {num_words} visual words was clusterd using {dictionary_dist_func} distance function')
 
-    codebook = hp.load_pickled_list(codebook_file)
     map_kp_to_words = hp.load_pickled_list(map_kp_to_word_file)
 
     # Put most matched codewords and the corresponding keypoints to the front.